@@ -0,0 +1,98 @@
+"""Compare memory and time of execute/iter_execute row formats against dict rows
+
+    python benchmarks/bench_row_formats.py --rows 200000 --columns 12
+
+Uses a throwaway sqlite db unless --url is given (a table named
+bench_row_formats is created and dropped on that db)
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+import click
+import sql_helper as sqh
+
+
+TABLE = 'bench_row_formats'
+
+
+def _setup(sql, rows, columns):
+    column_defs = ', '.join(
+        'c{} {}'.format(i, 'int' if i % 3 == 0 else 'float' if i % 3 == 1 else 'varchar(20)')
+        for i in range(columns)
+    )
+    sql.execute('drop table if exists {}'.format(TABLE))
+    sql.execute('create table {} ({})'.format(TABLE, column_defs))
+    data = (
+        {
+            'c{}'.format(i): n if i % 3 == 0 else n / 3 if i % 3 == 1 else 'value-{}'.format(n)
+            for i in range(columns)
+        }
+        for n in range(rows)
+    )
+    sql.bulk_insert(TABLE, data, chunk_size=10000)
+
+
+def _measure(func):
+    """Return (seconds, peak bytes, retained bytes) for calling func"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    results = func()
+    seconds = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return seconds, peak, retained
+
+
+def _consume(iterable):
+    count = 0
+    for _ in iterable:
+        count += 1
+    return count
+
+
+@click.command()
+@click.option('--rows', default=100000, help='Number of rows in the benchmark table')
+@click.option('--columns', default=12, help='Number of columns in the benchmark table')
+@click.option('--batch-size', 'batch_size', default=1000, help='batch_size for iter_execute')
+@click.option('--url', default='', help='Database url (default is a temporary sqlite db)')
+def main(rows, columns, batch_size, url):
+    """Benchmark the row_format options of SQL.execute and SQL.iter_execute"""
+    tmp_path = ''
+    if not url:
+        fd, tmp_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        url = 'sqlite:///' + tmp_path
+    sql = sqh.SQL(url)
+    _setup(sql, rows, columns)
+    statement = 'select * from {}'.format(TABLE)
+    print('{} rows x {} columns\n'.format(rows, columns))
+    print('{:<28} {:>10} {:>14} {:>14}'.format('call', 'seconds', 'peak MB', 'retained MB'))
+    try:
+        for row_format in (None, 'tuple', 'record', 'columns'):
+            seconds, peak, retained = _measure(
+                lambda: sql.execute(statement, row_format=row_format)
+            )
+            print('{:<28} {:>10.3f} {:>14.1f} {:>14.1f}'.format(
+                'execute {}'.format(row_format or 'dict (default)'),
+                seconds, peak / 1e6, retained / 1e6
+            ))
+        for row_format in (None, 'tuple', 'record', 'columns'):
+            seconds, peak, retained = _measure(
+                lambda: _consume(sql.iter_execute(
+                    statement, batch_size=batch_size, row_format=row_format
+                ))
+            )
+            print('{:<28} {:>10.3f} {:>14.1f} {:>14.1f}'.format(
+                'iter_execute {}'.format(row_format or 'dict (default)'),
+                seconds, peak / 1e6, retained / 1e6
+            ))
+    finally:
+        sql.execute('drop table {}'.format(TABLE))
+        if tmp_path:
+            os.remove(tmp_path)
+
+
+if __name__ == '__main__':
+    main()
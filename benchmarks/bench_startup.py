@@ -0,0 +1,117 @@
+"""Benchmark startup latency: import sql_helper, construct SQL, and run the first statement
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --save startup.json
+    python benchmarks/bench_startup.py --compare startup.json --threshold 15
+
+Each repetition runs in a fresh python process so nothing is already
+imported. Uses a temporary sqlite db unless --url is given
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import click
+
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import sql_helper as sqh
+imported = time.perf_counter()
+sql = sqh.SQL(sys.argv[1], connect_timeout=5, pool_options={})
+constructed = time.perf_counter()
+sql.execute('select 1')
+first = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'construct': constructed - imported,
+    'first_statement': first - constructed,
+    'total': first - start,
+    'modules': sorted(m for m in ('bg_helper', 'settings_helper', 'input_helper', 'sqlalchemy.ext.asyncio') if m in sys.modules),
+}))
+"""
+PHASES = ('import', 'construct', 'first_statement', 'total')
+
+
+def _percentile(sorted_values, percent):
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+@click.command()
+@click.option('--repeat', default=15, help='Number of fresh processes to time')
+@click.option('--url', default='', help='Database url (default is a temporary sqlite db)')
+@click.option('--save', 'save_path', default='', help='Save results as a baseline json file')
+@click.option('--compare', 'compare_path', default='', help='Baseline json file to compare results against')
+@click.option('--threshold', default=15.0, help='Percent p50 increase that counts as a regression')
+def main(repeat, url, save_path, compare_path, threshold):
+    """Benchmark import, construction, and first statement latency of sql_helper"""
+    tmp_path = ''
+    if not url:
+        fd, tmp_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        url = 'sqlite:///' + tmp_path
+    runs = []
+    try:
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', SCRIPT, url])
+            runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
+
+    results = {}
+    print('{:<18} {:>10} {:>10} {:>10}'.format('phase', 'p50 ms', 'p95 ms', 'max ms'))
+    for phase in PHASES:
+        values = sorted(run[phase] for run in runs)
+        results[phase] = {
+            'p50': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'max': values[-1],
+        }
+        print('{:<18} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            phase, results[phase]['p50'] * 1000, results[phase]['p95'] * 1000,
+            results[phase]['max'] * 1000
+        ))
+    print('\nOptional modules imported: {}'.format(', '.join(runs[-1]['modules']) or 'none'))
+
+    if save_path:
+        with open(save_path, 'w') as fp:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'repeat': repeat,
+                },
+                'results': results,
+            }, fp, indent=2)
+        print('\nSaved baseline to {}'.format(save_path))
+    if compare_path:
+        with open(compare_path) as fp:
+            baseline = json.load(fp)['results']
+        regressions = []
+        print('\n{:<18} {:>12} {:>12} {:>9}'.format('phase', 'base p50 ms', 'p50 ms', 'change'))
+        for phase in PHASES:
+            if not baseline.get(phase, {}).get('p50'):
+                continue
+            base = baseline[phase]['p50']
+            change = (results[phase]['p50'] - base) / base * 100
+            flag = ''
+            if change > threshold:
+                flag = ' REGRESSION'
+                regressions.append(phase)
+            print('{:<18} {:>12.1f} {:>12.1f} {:>8.1f}%{}'.format(
+                phase, base * 1000, results[phase]['p50'] * 1000, change, flag
+            ))
+        if regressions:
+            print('\n{} phase(s) regressed by more than {}%'.format(len(regressions), threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Benchmark the execute, insert, and introspection hot paths
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --sizes 1,1000,1000000,10000000 --save baseline.json
+    python benchmarks/bench_suite.py --compare baseline.json --threshold 10
+    python benchmarks/bench_suite.py --target postgresql --target mysql
+
+Targets are sqlite-file (temporary file) and sqlite-memory by default;
+postgresql and mysql use postgresql_url and mysql_url from settings.ini.
+Tables named bench_narrow, bench_wide, and bench_insert are created and
+dropped on each target.
+
+The benchmarks are execute and iter_execute of each size against the narrow
+and wide tables, insert of single rows one at a time, bulk_insert of each
+size from 100 to 1,000,000 rows into bench_insert, and repeated calls of
+get_tables, get_columns, and get_indexes.
+
+For each benchmark, the latency of every repetition is recorded (p50, p95,
+p99, mean), along with rows per second (based on p50) and peak memory of one
+extra run traced with tracemalloc. Results can be saved as a baseline and
+later runs compared against it; the exit code is 1 if any p50 regressed by
+more than --threshold percent
+"""
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import click
+import sql_helper as sqh
+from sqlalchemy import __version__ as sa_version
+
+
+DEFAULT_SIZES = '1,100,10000,100000'
+WIDE_COLUMNS = 30
+INSERT_SINGLE_ROWS = 200
+INTROSPECTION_CALLS = 50
+
+
+def _percentile(sorted_values, percent):
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+def _narrow_row(n):
+    return {'id': n, 'value': n / 7, 'name': 'name-{}'.format(n)}
+
+
+def _wide_row(n):
+    row = {'id': n}
+    for i in range(1, WIDE_COLUMNS):
+        if i % 3 == 0:
+            row['c{}'.format(i)] = n + i
+        elif i % 3 == 1:
+            row['c{}'.format(i)] = (n + i) / 7
+        else:
+            row['c{}'.format(i)] = 'value-{}-{}'.format(n, i)
+    return row
+
+
+def _create_tables(sql):
+    _drop_tables(sql)
+    sql.execute('create table bench_narrow (id int, value float, name varchar(40))')
+    wide_defs = ['id int']
+    for i in range(1, WIDE_COLUMNS):
+        kind = 'int' if i % 3 == 0 else 'float' if i % 3 == 1 else 'varchar(40)'
+        wide_defs.append('c{} {}'.format(i, kind))
+    sql.execute('create table bench_wide ({})'.format(', '.join(wide_defs)))
+    sql.execute('create table bench_insert (id int, value float, name varchar(40))')
+
+
+def _drop_tables(sql):
+    for table in ('bench_narrow', 'bench_wide', 'bench_insert'):
+        sql.execute('drop table if exists {}'.format(table))
+
+
+def _populate(sql, max_size):
+    sql.bulk_insert('bench_narrow', (_narrow_row(n) for n in range(max_size)), chunk_size=10000)
+    sql.bulk_insert(
+        'bench_wide', (_wide_row(n) for n in range(min(max_size, 1000000))),
+        chunk_size=5000
+    )
+
+
+def _measure(func, repeat):
+    """Return dict of latency stats (seconds) and peak memory (bytes) for calling func"""
+    func()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies.sort()
+    return {
+        'repeat': repeat,
+        'p50': _percentile(latencies, 50),
+        'p95': _percentile(latencies, 95),
+        'p99': _percentile(latencies, 99),
+        'mean': sum(latencies) / len(latencies),
+        'peak_bytes': peak,
+    }
+
+
+def _benchmarks(sql, sizes):
+    """Yield (name, rows per call, func) for each benchmark"""
+    for size in sizes:
+        yield (
+            'execute_narrow_{}'.format(size), size,
+            lambda size=size: sql.execute('select id, value, name from bench_narrow limit {}'.format(size))
+        )
+        if size <= 1000000:
+            yield (
+                'execute_wide_{}'.format(size), size,
+                lambda size=size: sql.execute('select * from bench_wide limit {}'.format(size))
+            )
+        yield (
+            'iter_execute_narrow_{}'.format(size), size,
+            lambda size=size: sum(1 for _ in sql.iter_execute(
+                'select id, value, name from bench_narrow limit {}'.format(size),
+                batch_size=10000
+            ))
+        )
+
+    def insert_single():
+        for n in range(INSERT_SINGLE_ROWS):
+            sql.insert('bench_insert', _narrow_row(n))
+        sql.execute('delete from bench_insert')
+
+    yield 'insert_single_{}'.format(INSERT_SINGLE_ROWS), INSERT_SINGLE_ROWS, insert_single
+    for size in sizes:
+        if size < 100 or size > 1000000:
+            continue
+
+        def insert_bulk(size=size):
+            sql.bulk_insert('bench_insert', (_narrow_row(n) for n in range(size)), chunk_size=10000)
+            sql.execute('delete from bench_insert')
+
+        yield 'bulk_insert_{}'.format(size), size, insert_bulk
+
+    def introspect():
+        for _ in range(INTROSPECTION_CALLS):
+            sql.get_tables()
+            sql.get_columns('bench_wide')
+            sql.get_indexes('bench_wide')
+
+    yield 'introspection_x{}'.format(INTROSPECTION_CALLS), INTROSPECTION_CALLS, introspect
+
+
+def _target_urls(targets, tmp_path):
+    urls = {}
+    for target in targets:
+        if target == 'sqlite-file':
+            urls[target] = 'sqlite:///' + tmp_path
+        elif target == 'sqlite-memory':
+            urls[target] = 'sqlite://'
+        else:
+            url = sqh.SETTINGS.get('{}_url'.format(target))
+            if not url:
+                print('No {}_url in settings.ini, skipping'.format(target))
+                continue
+            urls[target] = url
+    return urls
+
+
+def _compare(results, baseline, threshold):
+    """Print p50 changes against baseline and return list of regressions"""
+    regressions = []
+    print('\n{:<16} {:<28} {:>12} {:>12} {:>9}'.format('target', 'benchmark', 'base p50', 'p50', 'change'))
+    for target, benches in sorted(results.items()):
+        for name, info in benches.items():
+            base = baseline.get('results', {}).get(target, {}).get(name)
+            if not base or not base['p50']:
+                continue
+            change = (info['p50'] - base['p50']) / base['p50'] * 100
+            flag = ''
+            if change > threshold:
+                flag = ' REGRESSION'
+                regressions.append((target, name, change))
+            print('{:<16} {:<28} {:>12.6f} {:>12.6f} {:>8.1f}%{}'.format(
+                target, name, base['p50'], info['p50'], change, flag
+            ))
+    return regressions
+
+
+@click.command()
+@click.option(
+    '--target', 'targets', multiple=True,
+    type=click.Choice(['sqlite-file', 'sqlite-memory', 'postgresql', 'mysql']),
+    help='Database to benchmark against (can be repeated; default sqlite-file and sqlite-memory)'
+)
+@click.option('--sizes', default=DEFAULT_SIZES, help='Comma-separated result sizes (rows), up to 10000000')
+@click.option('--repeat', default=5, help='Number of timed repetitions per benchmark')
+@click.option('--only', default='', help='Only run benchmarks whose name contains this string')
+@click.option('--save', 'save_path', default='', help='Save results as a baseline json file')
+@click.option('--compare', 'compare_path', default='', help='Baseline json file to compare results against')
+@click.option('--threshold', default=10.0, help='Percent p50 increase that counts as a regression')
+def main(targets, sizes, repeat, only, save_path, compare_path, threshold):
+    """Benchmark SQL.execute, insert, bulk_insert, and introspection"""
+    sizes = sorted(set(int(size) for size in sizes.split(',') if size.strip()))
+    targets = targets or ('sqlite-file', 'sqlite-memory')
+    fd, tmp_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    results = {}
+    try:
+        for target, url in _target_urls(targets, tmp_path).items():
+            sql = sqh.SQL(url)
+            print('\n{} ({})'.format(target, sql._engine.url.drivername))
+            _create_tables(sql)
+            _populate(sql, max(sizes))
+            print('{:<28} {:>10} {:>10} {:>10} {:>14} {:>10}'.format(
+                'benchmark', 'p50 ms', 'p95 ms', 'p99 ms', 'rows/sec', 'peak MB'
+            ))
+            results[target] = {}
+            try:
+                for name, rows, func in _benchmarks(sql, sizes):
+                    if only and only not in name:
+                        continue
+                    info = _measure(func, repeat)
+                    info['rows'] = rows
+                    info['rows_per_second'] = rows / info['p50'] if info['p50'] else None
+                    results[target][name] = info
+                    print('{:<28} {:>10.3f} {:>10.3f} {:>10.3f} {:>14.0f} {:>10.1f}'.format(
+                        name, info['p50'] * 1000, info['p95'] * 1000, info['p99'] * 1000,
+                        info['rows_per_second'] or 0, info['peak_bytes'] / 1e6
+                    ))
+            finally:
+                _drop_tables(sql)
+                sql._engine.dispose()
+    finally:
+        os.remove(tmp_path)
+
+    if save_path:
+        with open(save_path, 'w') as fp:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'python': platform.python_version(),
+                    'sqlalchemy': sa_version,
+                    'platform': platform.platform(),
+                    'sizes': sizes,
+                    'repeat': repeat,
+                },
+                'results': results,
+            }, fp, indent=2)
+        print('\nSaved baseline to {}'.format(save_path))
+    if compare_path:
+        with open(compare_path) as fp:
+            baseline = json.load(fp)
+        regressions = _compare(results, baseline, threshold)
+        if regressions:
+            print('\n{} benchmark(s) regressed by more than {}%'.format(len(regressions), threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
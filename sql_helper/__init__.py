@@ -1,18 +1,1158 @@
+import io
+import json
+import logging
+import os
 import re
-import bg_helper as bh
-import input_helper as ih
-import settings_helper as sh
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from importlib import import_module
+from itertools import chain, islice
 from os.path import isfile
-from sqlalchemy import create_engine, text, inspect, __version__ as sa_version
-from sqlalchemy.exc import NoSuchModuleError, OperationalError, ResourceClosedError
+from queue import Full, Queue
+from sqlalchemy import (
+    Column, MetaData, Table, create_engine, event, text, inspect, __version__ as sa_version
+)
+from sqlalchemy.exc import (
+    DisconnectionError, NoSuchModuleError, NoSuchTableError, OperationalError, ProgrammingError,
+    ResourceClosedError
+)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
 from sqlalchemy.sql import sqltypes
 
 
-SETTINGS = sh.get_all_settings(__name__).get(sh.APP_ENV, {})
-CONNECT_TIMEOUT = SETTINGS.get('connect_timeout', 5)
+logger = logging.getLogger(__name__)
 DB_TYPES = ('postgresql', 'mysql')
+POSTGRESQL_TABLES_STATEMENT = (
+    "SELECT schemaname, tablename "
+    "FROM pg_catalog.pg_tables "
+    "WHERE schemaname != 'pg_catalog' AND schemaname != 'information_schema' "
+    "ORDER BY schemaname, tablename"
+)
+POSTGRESQL_INDEXES_STATEMENT = (
+    "SELECT * "
+    "FROM pg_indexes "
+    "WHERE tablename = :table "
+    "ORDER BY schemaname, tablename, indexname"
+)
+POSTGRESQL_TABLE_STATS_STATEMENT = (
+    "SELECT n.nspname AS schemaname, c.relname AS tablename, "
+    "c.reltuples AS estimate, s.n_live_tup AS live_rows, "
+    "s.n_mod_since_analyze AS modified_since_analyze, "
+    "greatest(s.last_analyze, s.last_autoanalyze) AS analyzed, "
+    "pg_total_relation_size(c.oid) AS total_bytes, "
+    "pg_relation_size(c.oid) AS table_bytes, pg_indexes_size(c.oid) AS index_bytes "
+    "FROM pg_class c "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid "
+    "WHERE c.relkind IN ('r', 'p') "
+    "AND n.nspname NOT IN ('pg_catalog', 'information_schema') "
+    "AND n.nspname NOT LIKE 'pg_toast%'"
+)
+MYSQL_TABLE_STATS_STATEMENT = (
+    "SELECT t.table_name AS tablename, t.table_rows AS estimate, "
+    "t.data_length AS table_bytes, t.index_length AS index_bytes, "
+    "t.data_length + t.index_length AS total_bytes{analyzed} "
+    "FROM information_schema.tables t{join} "
+    "WHERE t.table_schema = DATABASE() AND t.table_type = 'BASE TABLE'"
+)
+STALE_STATS_RATIO = 0.1
+SAMPLE_METHODS = ('system', 'bernoulli', 'keyset')
+CANCEL_GRACE_SECONDS = 5
 rx_mysql = re.compile(r'mysql://([\S]+)')
-sa_version_tuple = ih.string_to_version_tuple(sa_version)
+rx_table_name = re.compile(r'^[\w.]+$')
+rx_type_args = re.compile(r'^([^(]+)\(([^)]*)\)(.*)$')
+rx_read_only = re.compile(r'^\s*(select|with|show|values)\s', re.IGNORECASE)
+rx_cte_write = re.compile(r"'(?:[^']|'')*'|\b(insert|update|delete|merge|replace)\b", re.IGNORECASE)
+rx_write_target = re.compile(
+    r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from|'
+    r'truncate(?:\s+table)?|drop\s+table(?:\s+if\s+exists)?|alter\s+table)\s+([`"\w.]+)',
+    re.IGNORECASE
+)
+rx_create = re.compile(r'^\s*create\s', re.IGNORECASE)
+rx_quoted_or_space = re.compile(r"('(?:[^']|'')*')|\s+")
+rx_word = re.compile(r'\w+')
+rx_sql_keyword = re.compile(
+    r'^\s*(\(|--|/\*|(select|insert|update|delete|with|create|alter|drop|truncate|'
+    r'replace|show|set|begin|commit|rollback|savepoint|release|grant|revoke|call|'
+    r'exec|execute|explain|pragma|values|declare|do|copy|analyze|vacuum|merge|'
+    r'use|lock|unlock|describe|desc|rename|comment|load|optimize|refresh|reindex)'
+    r'(?=[\s(;]|$))',
+    re.IGNORECASE
+)
+rx_ddl = re.compile(r'^\s*(create|alter|drop|rename)\s', re.IGNORECASE)
+rx_fingerprint_literal = re.compile(
+    r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b|%\(\w+\)s|%s|(?<!:):\w+|\$\d+",
+    re.IGNORECASE
+)
+rx_fingerprint_list = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+rx_explainable = re.compile(r'^\s*(select|with|insert|update|delete|replace|values)\s', re.IGNORECASE)
+rx_sqlite_plan = re.compile(
+    r'^(SCAN|SEARCH)(?: TABLE)? (\S+)(?: AS \S+)?'
+    r'(?: USING (?:COVERING |AUTOMATIC (?:PARTIAL )?COVERING )?INDEX (\S+)'
+    r'| USING (INTEGER PRIMARY KEY|PRIMARY KEY))?'
+)
+rx_delimiter = re.compile(r'^\s*delimiter\s+(\S+)\s*$', re.IGNORECASE)
+rx_watermark_name = re.compile(r'(updated|modified|changed)', re.IGNORECASE)
+rx_index_columns = re.compile(r'\(([^)]+)\)')
+rx_single_table_select = re.compile(
+    r'^\s*select\s.+?\sfrom\s+([\w.]+)\s*(?:(?:where|order|limit|offset|fetch)\s.*)?;?\s*$',
+    re.IGNORECASE | re.DOTALL
+)
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+COMPRESSION_MODULES = {'gzip': 'gzip', 'bz2': 'bz2', 'xz': 'lzma'}
+ROW_FORMATS = ('dict', 'tuple', 'record', 'columns')
+TIMESTAMP_FORMATS = (
+    '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d',
+)
+POOL_SETTINGS = (
+    'pool_size', 'max_overflow', 'pool_recycle', 'pool_pre_ping',
+    'pool_use_lifo', 'pool_timeout',
+)
+QUEUE_POOL_SETTINGS = ('pool_size', 'max_overflow', 'pool_use_lifo', 'pool_timeout')
+sa_version_tuple = tuple(int(num) for num in re.findall(r'\d+', sa_version)[:3])
+_settings = None
+_state_lock = threading.Lock()
+_engines = {}
+_engines_lock = threading.Lock()
+_pool_stats = weakref.WeakKeyDictionary()
+_MISSING = object()
+
+
+def _get_settings(refresh=False):
+    """Return dict of settings from settings.ini (loaded on first use)
+
+    - refresh: if True, re-read settings.ini
+
+    The SETTINGS and CONNECT_TIMEOUT module attributes are loaded on first
+    access too, so importing sql_helper does not read settings.ini
+    """
+    global _settings
+    if _settings is None or refresh:
+        import settings_helper as sh
+        _settings = sh.get_all_settings(__name__).get(sh.APP_ENV, {})
+    return _settings
+
+
+def _get_connect_timeout():
+    return _get_settings().get('connect_timeout', 5)
+
+
+def _row_to_dict(row):
+    """Return a dict for a row from a sqlalchemy result"""
+    if sa_version_tuple[0] <= 1:
+        return dict(row.items())
+    return dict(row._mapping)
+
+
+def _db_type(drivername):
+    """Return postgresql, mysql, sqlite, or the drivername of an engine url"""
+    if drivername.startswith('postgresql') or drivername == 'redshift+psycopg2':
+        return 'postgresql'
+    elif drivername.startswith('mysql'):
+        return 'mysql'
+    elif drivername.startswith('sqlite'):
+        return 'sqlite'
+    return drivername
+
+
+def _shape_results(statement, first, others):
+    """Return a list of values, list of dicts, or a single item for rows of a result
+
+    - statement: the statement that was executed
+    - first: the first row
+    - others: list of the remaining rows
+
+    See SQL.execute for the rules
+    """
+    results = []
+    num_columns = len(first)
+    if num_columns == 1:
+        results.append(first[0])
+        results.extend([row[0] for row in others])
+    elif num_columns > 1:
+        results.append(_row_to_dict(first))
+        results.extend([_row_to_dict(row) for row in others])
+    if not others and '(' in statement:
+        results = results[0]
+    return results
+
+
+@lru_cache(maxsize=256)
+def _record_class(columns):
+    """Return a namedtuple class for a tuple of column names
+
+    Column names that are not valid identifiers are renamed to _0, _1, etc
+    """
+    return namedtuple('Record', columns, rename=True)
+
+
+def _column_array(values):
+    """Return an array.array for a list of all int or all float values (else the list)"""
+    from array import array
+    kinds = set(map(type, values))
+    if kinds == {int}:
+        try:
+            return array('q', values)
+        except OverflowError:
+            return values
+    elif kinds and kinds <= {int, float}:
+        return array('d', values)
+    return values
+
+
+def _format_rows(columns, rows, row_format):
+    """Return rows of a result in the requested row_format
+
+    - columns: list of column names
+    - rows: list of rows (sequences of values)
+    - row_format: 'dict' (list of dicts), 'tuple' (list of tuples, without
+      the header), 'record' (list of namedtuples), or 'columns' (OrderedDict of
+      column name to list of values, or array.array for int/float columns)
+    """
+    if row_format == 'dict':
+        return [dict(zip(columns, row)) for row in rows]
+    elif row_format == 'tuple':
+        return [tuple(row) for row in rows]
+    elif row_format == 'record':
+        make = _record_class(tuple(columns))._make
+        return [make(row) for row in rows]
+    elif row_format == 'columns':
+        return OrderedDict([
+            (name, _column_array(list(values)))
+            for name, values in zip(columns, zip(*rows) if rows else [()] * len(columns))
+        ])
+    raise ValueError('row_format must be one of {}, not {}'.format(ROW_FORMATS, repr(row_format)))
+
+
+def _arrow_type(pa, sa_type):
+    """Return a pyarrow type for a sqlalchemy column type (or None to let pyarrow infer it)
+
+    - pa: the imported pyarrow module
+    - sa_type: a column type from get_columns
+    """
+    if isinstance(sa_type, sqltypes.Boolean):
+        return pa.bool_()
+    elif isinstance(sa_type, sqltypes.Integer):
+        return pa.int64()
+    elif isinstance(sa_type, sqltypes.Float):
+        return pa.float64()
+    elif isinstance(sa_type, sqltypes.Numeric):
+        if not sa_type.asdecimal:
+            return pa.float64()
+        if sa_type.precision and sa_type.precision <= 38:
+            return pa.decimal128(sa_type.precision, sa_type.scale or 0)
+    elif isinstance(sa_type, sqltypes.DateTime):
+        return pa.timestamp('us', tz='UTC' if sa_type.timezone else None)
+    elif isinstance(sa_type, sqltypes.Date):
+        return pa.date32()
+    elif isinstance(sa_type, sqltypes.Time):
+        return pa.time64('us')
+    elif isinstance(sa_type, sqltypes.String):
+        return pa.string()
+    elif isinstance(sa_type, sqltypes._Binary):
+        return pa.binary()
+
+
+def _arrow_array(pa, values, arrow_type=None):
+    """Return a pyarrow array for a sequence of values
+
+    If values can't be converted to arrow_type directly (like the date strings
+    that sqlite returns), they are converted by pyarrow and cast; if that
+    fails too, the type is inferred
+    """
+    if arrow_type is None:
+        return pa.array(values)
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError):
+        pass
+    inferred = pa.array(values)
+    try:
+        return inferred.cast(arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return inferred
+
+
+def _pandas_dtype(sa_type):
+    """Return a pandas dtype name for a sqlalchemy column type (or None)"""
+    if isinstance(sa_type, sqltypes.Boolean):
+        return 'boolean'
+    elif isinstance(sa_type, sqltypes.Integer):
+        return 'Int64'
+    elif isinstance(sa_type, sqltypes.Float):
+        return 'float64'
+    elif isinstance(sa_type, sqltypes.Numeric) and not sa_type.asdecimal:
+        return 'float64'
+    elif isinstance(sa_type, sqltypes.DateTime) and not sa_type.timezone:
+        return 'datetime64[ns]'
+    elif isinstance(sa_type, sqltypes.Date):
+        return 'datetime64[ns]'
+
+
+def _is_timestamp_column(column):
+    return isinstance(
+        column['type'],
+        (sqltypes.DATE, sqltypes.DATETIME, sqltypes.TIME, sqltypes.TIMESTAMP)
+    )
+
+
+def _is_autoincrement_column(column):
+    return column.get('autoincrement') is True
+
+
+def _is_required_column(column):
+    return column['nullable'] is False and column['default'] is None
+
+
+def _is_non_nullable_column(column):
+    return column['nullable'] is False
+
+
+def _filter_columns(columns, predicate, name_only=False, sort=False):
+    """Return list of column info dicts (or names) that predicate returns True for
+
+    - columns: list of column info dicts (from get_columns)
+    - predicate: func that accepts a column info dict
+    - name_only: if True, only return the names of columns
+    - sort: if True, results will be sorted by name
+    """
+    results = [column for column in columns if predicate(column)]
+    if name_only:
+        results = [column['name'] for column in results]
+        if sort:
+            results = sorted(results)
+    elif sort:
+        results = sorted(results, key=lambda x: x['name'])
+    return results
+
+
+def _chunks(iterable, size):
+    """Yield lists of up to size items from any iterable (including generators)"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def _compression_opener(compression):
+    """Return the open function for compression ('gzip', 'bz2', 'xz'; plain open if None)"""
+    if not compression:
+        return open
+    return import_module(COMPRESSION_MODULES[compression]).open
+
+
+def _infer_format(source):
+    """Return 'csv', 'jsonl', or 'rows' for a file path, file object, or iterable"""
+    if isinstance(source, str):
+        name = source
+    elif hasattr(source, 'read'):
+        name = getattr(source, 'name', '')
+    else:
+        return 'rows'
+    if not isinstance(name, str):
+        name = ''
+    ext = os.path.splitext(name)[1].lower()
+    if ext in ('.csv', '.tsv', '.txt'):
+        return 'csv'
+    elif ext in ('.jsonl', '.ndjson', '.json'):
+        return 'jsonl'
+    raise ValueError('Unable to infer format of {}, pass format='.format(repr(source)))
+
+
+def _csv_value(value, hex_prefix=''):
+    """Return value converted to something COPY/LOAD DATA agree on
+
+    - hex_prefix: string to put before hex encoded bytes ('\\x' for bytea)
+    """
+    if isinstance(value, bool):
+        return int(value)
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return hex_prefix + bytes(value).hex()
+    return value
+
+
+def _csv_line(values, delimiter=',', null='', hex_prefix=''):
+    """Return a csv line for COPY/LOAD DATA with every non-NULL value quoted
+
+    - null: unquoted marker to write for None
+    - hex_prefix: string to put before hex encoded bytes
+
+    Quoting everything but NULL keeps empty strings distinct from NULL
+    """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append(null)
+        else:
+            fields.append('"{}"'.format(str(_csv_value(value, hex_prefix)).replace('"', '""')))
+    return delimiter.join(fields) + '\n'
+
+
+def _portable_type(sa_type, dialect):
+    """Return a version of a reflected sqlalchemy type that dialect can create
+
+    The type's generic equivalent is used when there is one (i.e. INTEGER(11)
+    from mysql becomes Integer); types the dialect can't compile become Text
+    """
+    try:
+        sa_type = sa_type.as_generic()
+    except (AttributeError, NotImplementedError):
+        pass
+    try:
+        sa_type.compile(dialect=dialect)
+    except Exception:
+        return sqltypes.Text()
+    return sa_type
+
+
+def _copy_info(value):
+    """Return a copy of a metadata info value with its dicts and lists copied too
+
+    Column types and other objects are shared (they are not changed in place)
+    """
+    if isinstance(value, dict):
+        return {key: _copy_info(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_info(item) for item in value]
+    return value
+
+
+def _is_read_only(statement):
+    """Return True if statement only reads data
+
+    A WITH statement is read-only if no insert/update/delete/merge/replace
+    appears outside of quoted strings (in the CTEs or the final statement)
+    """
+    match = rx_read_only.match(statement)
+    if match is None:
+        return False
+    if match.group(1).lower() == 'with':
+        return not any(m.group(1) for m in rx_cte_write.finditer(statement))
+    return True
+
+
+def _fingerprint(statement):
+    """Return statement with literals/placeholders replaced by ? and whitespace collapsed
+
+    Statements that only differ by the values used (or the number of items
+    in an IN list) get the same fingerprint
+    """
+    statement = rx_fingerprint_literal.sub('?', statement)
+    statement = rx_quoted_or_space.sub(lambda m: m.group(1) or ' ', statement).strip()
+    return rx_fingerprint_list.sub('(?, ...)', statement)
+
+
+def _plan_node(operation, relation=None, index=None, rows=None, cost=None,
+               full_scan=False, actual_rows=None, actual_seconds=None,
+               detail=None, children=None):
+    """Return a dict for one node of a normalized query plan (see SQL.explain)"""
+    return {
+        'operation': operation,
+        'relation': relation,
+        'index': index,
+        'uses_index': index is not None,
+        'full_scan': full_scan,
+        'rows': rows,
+        'cost': cost,
+        'actual_rows': actual_rows,
+        'actual_seconds': actual_seconds,
+        'detail': detail,
+        'children': children or [],
+    }
+
+
+def _postgresql_plan(plan):
+    """Return normalized plan node for a 'Plan' dict from postgresql EXPLAIN (FORMAT JSON)"""
+    node_type = plan.get('Node Type')
+    actual_rows = plan.get('Actual Rows')
+    if actual_rows is not None:
+        actual_rows = actual_rows * plan.get('Actual Loops', 1)
+    actual_seconds = plan.get('Actual Total Time')
+    if actual_seconds is not None:
+        actual_seconds = actual_seconds / 1000.0
+    return _plan_node(
+        node_type,
+        relation=plan.get('Relation Name'),
+        index=plan.get('Index Name'),
+        rows=plan.get('Plan Rows'),
+        cost=plan.get('Total Cost'),
+        full_scan=node_type == 'Seq Scan',
+        actual_rows=actual_rows,
+        actual_seconds=actual_seconds,
+        detail=(
+            plan.get('Index Cond') or plan.get('Filter') or
+            plan.get('Hash Cond') or plan.get('Join Filter')
+        ),
+        children=[_postgresql_plan(child) for child in plan.get('Plans', [])],
+    )
+
+
+def _mysql_plan_nodes(obj):
+    """Return list of normalized plan nodes for the tables in part of a mysql EXPLAIN FORMAT=JSON dict"""
+    nodes = []
+    if isinstance(obj, list):
+        for item in obj:
+            nodes.extend(_mysql_plan_nodes(item))
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == 'table' and isinstance(value, dict):
+                cost_info = value.get('cost_info', {})
+                cost = cost_info.get('prefix_cost') or cost_info.get('read_cost')
+                access_type = value.get('access_type')
+                rows = value.get('rows_examined_per_scan')
+                nodes.append(_plan_node(
+                    access_type,
+                    relation=value.get('table_name'),
+                    index=value.get('key'),
+                    rows=int(rows) if rows is not None else None,
+                    cost=float(cost) if cost is not None else None,
+                    full_scan=access_type == 'ALL',
+                    detail=value.get('attached_condition'),
+                    children=_mysql_plan_nodes({
+                        k: v for k, v in value.items() if isinstance(v, (dict, list))
+                    }),
+                ))
+            elif isinstance(value, (dict, list)):
+                nodes.extend(_mysql_plan_nodes(value))
+    return nodes
+
+
+def _sqlite_plan(rows):
+    """Return normalized plan node for the (id, parent, notused, detail) rows of sqlite EXPLAIN QUERY PLAN"""
+    root = _plan_node('QUERY PLAN')
+    nodes = {0: root}
+    for node_id, parent, _, detail in rows:
+        match = rx_sqlite_plan.match(detail)
+        if match:
+            operation, relation, index, pk = match.groups()
+            node = _plan_node(
+                operation, relation=relation, index=index or pk,
+                full_scan=operation == 'SCAN' and not (index or pk),
+                detail=detail,
+            )
+        else:
+            node = _plan_node(detail, detail=detail)
+        nodes.get(parent, root)['children'].append(node)
+        nodes[node_id] = node
+    return root
+
+
+def _walk_plan(node):
+    """Yield node and all of its descendants"""
+    yield node
+    for child in node['children']:
+        for descendant in _walk_plan(child):
+            yield descendant
+
+
+@lru_cache(maxsize=16)
+def _statement_token_rx(delimiter, mysql):
+    """Return compiled regex that finds the next quote, comment start, dollar quote, or delimiter"""
+    tokens = [r"'", r'"', r'`', r'--', r'/\*', re.escape(delimiter)]
+    if mysql:
+        tokens.append(r'#')
+    else:
+        tokens.insert(0, r"(?<![\w$])[Ee]'")
+        tokens.append(r'\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$')
+    return re.compile('|'.join(tokens))
+
+
+def _split_statements(lines, delimiter=';', mysql=False):
+    """Yield (statement, line_number) for each statement in an iterable of lines of SQL
+
+    - lines: iterable of lines (like an open file), so a script is never read
+      into memory all at once
+    - delimiter: the initial statement delimiter
+    - mysql: if True, backslash escapes in quoted strings and # comments are
+      recognized; otherwise, postgresql dollar quoting ($$ or $tag$) and
+      backslash escapes in E'...' strings are
+
+    Delimiters inside quoted strings, quoted identifiers, comments, and
+    dollar-quoted bodies do not end a statement. A line with only
+    'DELIMITER xx' (mysql client syntax) between statements changes the
+    delimiter. The line_number is where the statement starts, and statements
+    that are only whitespace or comments are skipped
+    """
+    buf = []
+    start_line = None
+    state = None
+    escapes = mysql
+    token_rx = _statement_token_rx(delimiter, mysql)
+    for line_number, line in enumerate(lines, 1):
+        if state is None and start_line is None:
+            match = rx_delimiter.match(line)
+            if match:
+                delimiter = match.group(1)
+                token_rx = _statement_token_rx(delimiter, mysql)
+                buf = []
+                continue
+        pos = 0
+        length = len(line)
+        while pos < length:
+            if state is None:
+                match = token_rx.search(line, pos)
+                end = match.start() if match else length
+                if start_line is None and line[pos:end].strip():
+                    start_line = line_number
+                if not match:
+                    buf.append(line[pos:])
+                    break
+                token = match.group(0)
+                if token == delimiter:
+                    buf.append(line[pos:end])
+                    if start_line is not None:
+                        yield ''.join(buf).strip(), start_line
+                    buf = []
+                    start_line = None
+                    pos = match.end()
+                    continue
+                buf.append(line[pos:match.end()])
+                pos = match.end()
+                if token in ('--', '#'):
+                    state = '\n'
+                elif token == '/*':
+                    state = '*/'
+                elif token in ("E'", "e'"):
+                    state = "'"
+                    escapes = True
+                    if start_line is None:
+                        start_line = line_number
+                else:
+                    state = token
+                    if start_line is None:
+                        start_line = line_number
+            elif state == '\n':
+                buf.append(line[pos:])
+                state = None
+                break
+            else:
+                end = line.find(state, pos)
+                if escapes and state in ("'", '"'):
+                    backslash = line.find('\\', pos)
+                    if backslash != -1 and (end == -1 or backslash < end):
+                        buf.append(line[pos:backslash + 2])
+                        pos = backslash + 2
+                        continue
+                if end == -1:
+                    buf.append(line[pos:])
+                    break
+                if state in ("'", '"', '`') and line[end + 1:end + 2] == state:
+                    buf.append(line[pos:end + 2])
+                    pos = end + 2
+                    continue
+                buf.append(line[pos:end + len(state)])
+                pos = end + len(state)
+                state = None
+                escapes = mysql
+        if state == '\n':
+            state = None
+    if start_line is not None:
+        statement = ''.join(buf).strip()
+        if statement:
+            yield statement, start_line
+
+
+def _parse_timestamp(value):
+    """Return (datetime, format) for a timestamp string, or (None, None)"""
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt), fmt
+        except ValueError:
+            continue
+    if hasattr(datetime, 'fromisoformat'):
+        try:
+            return datetime.fromisoformat(value.strip()), None
+        except ValueError:
+            pass
+    return None, None
+
+
+def _encode_watermark(value):
+    """Return a json-safe dict for a watermark value"""
+    from decimal import Decimal
+    if isinstance(value, datetime):
+        return {'type': 'datetime', 'value': value.isoformat()}
+    elif isinstance(value, date):
+        return {'type': 'date', 'value': value.isoformat()}
+    elif isinstance(value, Decimal):
+        return {'type': 'decimal', 'value': str(value)}
+    return {'type': 'value', 'value': value}
+
+
+def _decode_watermark(encoded):
+    """Return the watermark value from a dict made by _encode_watermark"""
+    from decimal import Decimal
+    kind, value = encoded['type'], encoded['value']
+    if kind == 'datetime':
+        return _parse_timestamp(value)[0]
+    elif kind == 'date':
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    elif kind == 'decimal':
+        return Decimal(value)
+    return value
+
+
+def _shift_watermark(value, overlap):
+    """Return watermark value moved back by overlap
+
+    - overlap: timedelta or number of seconds for timestamps (and timestamp
+      strings, as returned by sqlite), or a number for numeric columns
+    """
+    from decimal import Decimal
+    if not overlap:
+        return value
+    if isinstance(value, (date, str)) and not isinstance(overlap, timedelta):
+        overlap = timedelta(seconds=overlap)
+    if isinstance(value, str):
+        parsed, fmt = _parse_timestamp(value)
+        if parsed is None:
+            raise ValueError('Cannot apply overlap to watermark {}'.format(repr(value)))
+        shifted = parsed - overlap
+        return shifted.strftime(fmt) if fmt else shifted.isoformat(' ')
+    if isinstance(value, Decimal):
+        return value - Decimal(str(overlap))
+    return value - overlap
+
+
+def _load_state(path):
+    """Return dict of watermark state saved at path (empty dict if no file)"""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+@contextmanager
+def _state_file_lock(path):
+    """Hold an exclusive lock on path + '.lock' so processes sharing a state file take turns"""
+    with open(path + '.lock', 'a+') as fp:
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            fp.seek(0)
+            while True:
+                try:
+                    # LK_LOCK gives up after 10 seconds, so keep trying
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _save_state(path, key, info):
+    """Atomically update the watermark state for key in the json file at path
+
+    The read-modify-write is done while holding a lock file (path + '.lock'),
+    so threads and processes that share the state file don't lose updates
+    """
+    import tempfile
+    with _state_lock, _state_file_lock(path):
+        state = _load_state(path)
+        state[key] = info
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.sqh-state-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(state, fp, indent=2, sort_keys=True)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class _PoolStats(object):
+    def __init__(self):
+        """Counts of pool events and a histogram of checkout wait times for one engine"""
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.wait = _Histogram()
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.wait.record(seconds)
+
+
+def _is_sqlite_memory(url):
+    """Return True if url is an in-memory sqlite database (plain or mode=memory uri)"""
+    if not url.startswith('sqlite'):
+        return False
+    return make_url(url).database in (None, '', ':memory:') or 'mode=memory' in url
+
+
+def _pool_options(url, pool_options=None):
+    """Return dict of create_engine pool kwargs from settings.ini (or pool_options)
+
+    Settings that only apply to QueuePool are dropped for in-memory sqlite
+    urls (SingletonThreadPool), and for file sqlite urls before SQLAlchemy
+    2.0 (NullPool)
+    """
+    if pool_options is None:
+        settings = _get_settings()
+        pool_options = {
+            key: settings[key]
+            for key in POOL_SETTINGS
+            if key in settings and settings[key] != ''
+        }
+    options = dict(pool_options)
+    if _is_sqlite_memory(url) or (url.startswith('sqlite') and sa_version_tuple < (2, 0)):
+        for key in QUEUE_POOL_SETTINGS:
+            options.pop(key, None)
+    return options
+
+
+def _sqlite_row_hash(*values):
+    """Return crc32 of the values of a row (registered on sqlite connections as sqh_row_hash)"""
+    import zlib
+    return zlib.crc32('#'.join('\\N' if v is None else str(v) for v in values).encode('utf-8'))
+
+
+class _SqliteBitXor(object):
+    """Aggregate that xors integers (registered on sqlite connections as sqh_bit_xor)"""
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= value
+
+    def finalize(self):
+        return self.value
+
+
+def _new_engine(url, connect_args, pool_options):
+    """Return a new engine with listeners for pool stats and fork safety"""
+    engine = create_engine(url, connect_args=connect_args, **pool_options)
+    stats = _pool_stats[engine] = _PoolStats()
+    is_sqlite = engine.dialect.name == 'sqlite'
+
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+        stats.connects += 1
+        if is_sqlite:
+            dbapi_connection.create_function('sqh_row_hash', -1, _sqlite_row_hash)
+            dbapi_connection.create_aggregate('sqh_bit_xor', 1, _SqliteBitXor)
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.get('pid') != pid:
+            # connection was made in a parent process; don't share its socket
+            if sa_version_tuple < (1, 4):
+                connection_record.connection = connection_proxy.connection = None
+            else:
+                connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise DisconnectionError(
+                'Connection record belongs to pid {}, attempting to check out in pid {}'.format(
+                    connection_record.info.get('pid'), pid
+                )
+            )
+        stats.checkouts += 1
+
+    def on_checkin(dbapi_connection, connection_record):
+        stats.checkins += 1
+
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        stats.invalidations += 1
+
+    event.listen(engine, 'connect', on_connect)
+    event.listen(engine, 'checkout', on_checkout)
+    event.listen(engine, 'checkin', on_checkin)
+    event.listen(engine, 'invalidate', on_invalidate)
+    return engine
+
+
+def _get_engine(url, connect_args={}, pool_options={}, share=True):
+    """Return the engine for url/connect_args/pool_options from the registry (or a new one)
+
+    - share: if False, always return a new engine that is not in the registry
+    """
+    if not share:
+        return _new_engine(url, connect_args, pool_options)
+    key = (url, repr(sorted(connect_args.items())), repr(sorted(pool_options.items())))
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = _new_engine(url, connect_args, pool_options)
+    return engine
+
+
+def dispose_engines():
+    """Close all pooled connections of shared engines and empty the engine registry"""
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        engine.dispose()
+
+
+def _after_fork_in_child():
+    """Drop pooled connections inherited from the parent process (without closing them)"""
+    global _engines_lock
+    _engines_lock = threading.Lock()
+    if sa_version_tuple >= (1, 4, 33):
+        for engine in list(_pool_stats.keys()):
+            engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class ScriptError(Exception):
+    def __init__(self, message, path=None, line_number=None, statement=None, stats=None):
+        """Raised by SQL.run_script when a statement fails and stop_on_error is True
+
+        - path: path of the script
+        - line_number: line of the script the failing statement starts on
+        - statement: the failing statement
+        - stats: dict of stats for the statements that did run (see run_script)
+        """
+        super(ScriptError, self).__init__(message)
+        self.path = path
+        self.line_number = line_number
+        self.statement = statement
+        self.stats = stats
+
+
+def _execute_driver_sql(conn, statement):
+    """Execute statement exactly as written (no :param parsing or %-formatting by the driver)"""
+    if sa_version_tuple < (1, 4):
+        return conn.execution_options(no_parameters=True).execute(statement)
+    return conn.exec_driver_sql(statement, execution_options={'no_parameters': True})
+
+
+class _LRUCache(object):
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None):
+        """A thread-safe mapping with LRU eviction, optional TTL, and hit/miss counters
+
+        - maxsize: max number of entries to keep (least recently used are
+          evicted first)
+        - ttl: default number of seconds an entry is valid for (None for no
+          expiration)
+        - maxbytes: max total of the sizes passed to set (None for no limit)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        self._bytes -= self._data.pop(key)[2]
+
+    def get(self, key, default=None):
+        """Return value for key (and mark as recently used) or default if missing/expired"""
+        with self._lock:
+            try:
+                expires, value, _, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, size=0, tags=()):
+        """Store value for key, evicting least recently used entries if over maxsize
+
+        - ttl: number of seconds this entry is valid for (default is self.ttl)
+        - size: size of value to count against maxbytes
+        - tags: collection of strings that invalidate_tags can match on
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires, value, size, frozenset(tags))
+            self._bytes += size
+            while self._data and (
+                len(self._data) > self.maxsize or
+                (self.maxbytes is not None and self._bytes > self.maxbytes)
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key][1]
+            self._remove(key)
+            return value
+
+    def invalidate_tags(self, tags):
+        """Remove every entry that has any of the tags and return number removed"""
+        tags = set(tags)
+        with self._lock:
+            keys = [key for key, entry in self._data.items() if entry[3] & tags]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return a dict with hits, misses, evictions, size, and hit_rate"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'bytes': self._bytes,
+            'maxbytes': self.maxbytes,
+            'ttl': self.ttl,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class _SqliteCache(_LRUCache):
+    def __init__(self, path, maxsize=128, ttl=None, maxbytes=None):
+        """An _LRUCache stored in a local sqlite file, so entries survive restarts
+
+        - path: path to the sqlite file (created if it does not exist)
+
+        Values must be bytes
+        """
+        super(_SqliteCache, self).__init__(maxsize=maxsize, ttl=ttl, maxbytes=maxbytes)
+        import sqlite3
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL, '
+            'size INTEGER, tags TEXT)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_accessed ON cache (accessed)')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT count(*) FROM cache').fetchone()[0]
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                if row is not None:
+                    self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.misses += 1
+                return default
+            self._conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value, ttl=None, size=0, tags=()):
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                'REPLACE INTO cache (key, value, expires, accessed, size, tags) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, value, expires, now, size or len(value), ' {} '.format(' '.join(tags)))
+            )
+            count, total = self._conn.execute(
+                'SELECT count(*), coalesce(sum(size), 0) FROM cache'
+            ).fetchone()
+            while count and (
+                count > self.maxsize or
+                (self.maxbytes is not None and total > self.maxbytes)
+            ):
+                oldest_key, oldest_size = self._conn.execute(
+                    'SELECT key, size FROM cache ORDER BY accessed LIMIT 1'
+                ).fetchone()
+                self._conn.execute('DELETE FROM cache WHERE key = ?', (oldest_key,))
+                self.evictions += 1
+                count -= 1
+                total -= oldest_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        return row[0] if row is not None else default
+
+    def invalidate_tags(self, tags):
+        removed = 0
+        with self._lock:
+            for tag in set(tags):
+                removed += self._conn.execute(
+                    "DELETE FROM cache WHERE instr(tags, ' ' || ? || ' ') > 0", (tag,)
+                ).rowcount
+        return removed
+
+    def keys(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT key FROM cache ORDER BY accessed')]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache')
+
+    def stats(self):
+        results = super(_SqliteCache, self).stats()
+        with self._lock:
+            results['size'], results['bytes'] = self._conn.execute(
+                'SELECT count(*), coalesce(sum(size), 0) FROM cache'
+            ).fetchone()
+        results['path'] = self.path
+        return results
 
 
 def _settings_for_docker_ok(exception=False):
@@ -23,7 +1163,9 @@ def _settings_for_docker_ok(exception=False):
 
     If any are missing, prompt to sync settings with vimdiff
     """
-    global SETTINGS
+    import input_helper as ih
+    import settings_helper as sh
+    settings = _get_settings()
     settings_keys_for_docker = [
         'postgresql_container_name', 'postgresql_image_version', 'postgresql_username',
         'postgresql_password', 'postgresql_port', 'postgresql_db', 'postgresql_rm',
@@ -31,15 +1173,15 @@ def _settings_for_docker_ok(exception=False):
         'mysql_container_name', 'mysql_image_version', 'mysql_username', 'mysql_password',
         'mysql_root_password', 'mysql_port', 'mysql_db', 'mysql_rm', 'mysql_data_dir', 'mysql_url'
     ]
-    missing_settings = set(settings_keys_for_docker) - set(SETTINGS.keys())
+    missing_settings = set(settings_keys_for_docker) - set(settings.keys())
     if missing_settings != set():
         message = 'Update your settings.ini to have: {}'.format(sorted(list(missing_settings)))
         print(message)
         resp = ih.user_input('Sync settings.ini with vimdiff? (y/n)')
         if resp.lower().startswith('y'):
             sh.sync_settings_file(__name__)
-            SETTINGS = sh.get_all_settings(__name__).get(sh.APP_ENV, {})
-            missing_settings = set(settings_keys_for_docker) - set(SETTINGS.keys())
+            settings = _get_settings(refresh=True)
+            missing_settings = set(settings_keys_for_docker) - set(settings.keys())
             if missing_settings == set():
                 return True
             elif exception:
@@ -71,16 +1213,19 @@ def start_docker(db_type, exception=False, show=False, force=False, wait=True, s
     if not ok:
         return False
 
+    import bg_helper as bh
+    settings = _get_settings()
+
     if db_type == 'postgresql':
         return bh.tools.docker_postgres_start(
-            SETTINGS['postgresql_container_name'],
-            version=SETTINGS['postgresql_image_version'],
-            port=SETTINGS['postgresql_port'],
-            username=SETTINGS['postgresql_username'],
-            password=SETTINGS['postgresql_password'],
-            db=SETTINGS['postgresql_db'],
-            rm=SETTINGS['postgresql_rm'],
-            data_dir=SETTINGS['postgresql_data_dir'],
+            settings['postgresql_container_name'],
+            version=settings['postgresql_image_version'],
+            port=settings['postgresql_port'],
+            username=settings['postgresql_username'],
+            password=settings['postgresql_password'],
+            db=settings['postgresql_db'],
+            rm=settings['postgresql_rm'],
+            data_dir=settings['postgresql_data_dir'],
             exception=exception,
             show=show,
             force=force,
@@ -89,15 +1234,15 @@ def start_docker(db_type, exception=False, show=False, force=False, wait=True, s
         )
     elif db_type == 'mysql':
         return bh.tools.docker_mysql_start(
-            SETTINGS['mysql_container_name'],
-            version=SETTINGS['mysql_image_version'],
-            port=SETTINGS['mysql_port'],
-            root_password=SETTINGS['mysql_root_password'],
-            username=SETTINGS['mysql_username'],
-            password=SETTINGS['mysql_password'],
-            db=SETTINGS['mysql_db'],
-            rm=SETTINGS['mysql_rm'],
-            data_dir=SETTINGS['mysql_data_dir'],
+            settings['mysql_container_name'],
+            version=settings['mysql_image_version'],
+            port=settings['mysql_port'],
+            root_password=settings['mysql_root_password'],
+            username=settings['mysql_username'],
+            password=settings['mysql_password'],
+            db=settings['mysql_db'],
+            rm=settings['mysql_rm'],
+            data_dir=settings['mysql_data_dir'],
             exception=exception,
             show=show,
             force=force,
@@ -118,26 +1263,29 @@ def stop_docker(db_type, exception=False, show=False):
             repr(DB_TYPES), db_type
         )
     )
+    settings = _get_settings()
     container_key = '{}_container_name'.format(db_type)
-    if container_key not in SETTINGS:
+    if container_key not in settings:
         message = 'Update your settings.ini to have: {}'.format(container_key)
         if exception is True:
             raise Exception(message)
         elif show is True:
             print(message)
         return False
-    return bh.tools.docker_stop(SETTINGS[container_key], exception=exception, show=show)
+    import bg_helper as bh
+    return bh.tools.docker_stop(settings[container_key], exception=exception, show=show)
 
 
 def urls_from_settings():
     """Return a list of urls (connection strings) from settings.ini"""
+    settings = _get_settings()
     return [
         url
         for url in [
-            SETTINGS.get('sql_url'),
-            SETTINGS.get('postgresql_url'),
-            SETTINGS.get('mysql_url'),
-            SETTINGS.get('sqlite_url'),
+            settings.get('sql_url'),
+            settings.get('postgresql_url'),
+            settings.get('mysql_url'),
+            settings.get('sqlite_url'),
         ]
         if url
     ]
@@ -149,6 +1297,7 @@ def select_url_from_settings():
     if not urls:
         print('No connection strings are defined in ~/.config/sql-helper/settings.ini')
         return
+    import input_helper as ih
     selected = ih.make_selections(
         urls,
         prompt='Select connection string to use',
@@ -159,9 +1308,201 @@ def select_url_from_settings():
         return selected
 
 
+class _Histogram(object):
+    def __init__(self, sub_buckets=32):
+        """Log-linear (HDR-style) histogram of non-negative values with bounded memory
+
+        - sub_buckets: number of linear buckets per power of 2 (relative error
+          of percentiles is at most 1 / sub_buckets)
+        """
+        self.sub_buckets = sub_buckets
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        import math
+        if value <= 0:
+            key = None
+            value = 0.0
+        else:
+            mantissa, exponent = math.frexp(value)
+            key = (exponent, int((mantissa - 0.5) * 2 * self.sub_buckets))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _upper_bound(self, key):
+        import math
+        if key is None:
+            return 0.0
+        exponent, sub = key
+        return math.ldexp(0.5 + (sub + 1) / (2.0 * self.sub_buckets), exponent)
+
+    def percentile(self, percent):
+        """Return the value that percent of recorded values are at or below (None if empty)"""
+        import math
+        if not self.count:
+            return None
+        target = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for key in sorted(self.counts, key=lambda k: (-1, 0) if k is None else k):
+            seen += self.counts[key]
+            if seen >= target:
+                return min(self._upper_bound(key), self.max)
+        return self.max
+
+
+class SchemaSnapshot(object):
+    def __init__(self, db_type, default_schema=None):
+        """In-memory description of every table in a db (see SQL.describe_all)
+
+        - db_type: postgresql, mysql, sqlite, etc
+        - default_schema: schema to assume for table names without a schema
+          (postgresql only)
+
+        The tables attribute is a dict keyed by table name (schema.tablename on
+        postgresql) with a dict of columns, indexes, and primary_key for each
+        """
+        self.db_type = db_type
+        self.default_schema = default_schema
+        self.created = time.time()
+        self.tables = OrderedDict()
+
+    def __repr__(self):
+        return '<SchemaSnapshot: {} {} tables>'.format(self.db_type, len(self.tables))
+
+    def _table_key(self, table, schema=None):
+        if self.db_type == 'postgresql':
+            if '.' in table and schema is None:
+                return table
+            return '{}.{}'.format(schema or self.default_schema, table)
+        if '.' in table and schema is None:
+            return table.split('.', 1)[1]
+        return table
+
+    def add_table(self, table):
+        """Return the info dict for table (creating it if needed)"""
+        return self.tables.setdefault(table, {'columns': [], 'indexes': [], 'primary_key': []})
+
+    def has_table(self, table, schema=None):
+        return self._table_key(table, schema) in self.tables
+
+    def get_tables(self):
+        """Return a list of table names (or schema.tablename strings)"""
+        return list(self.tables.keys())
+
+    def get_columns(self, table, schema=None):
+        """Return list of column info dicts for table (None if table is unknown)"""
+        info = self.tables.get(self._table_key(table, schema))
+        if info is not None:
+            return _copy_info(info['columns'])
+
+    def get_indexes(self, table, schema=None):
+        """Return list of index info dicts for table (None if table is unknown)"""
+        info = self.tables.get(self._table_key(table, schema))
+        if info is not None:
+            return _copy_info(info['indexes'])
+
+    def get_primary_key(self, table, schema=None):
+        """Return list of primary key column names for table (None if table is unknown)"""
+        info = self.tables.get(self._table_key(table, schema))
+        if info is not None:
+            return list(info['primary_key'])
+
+
+class TableIterator(object):
+    def __init__(self, sql, table, key, batch_size=1000, where='', params={},
+                 columns=None, after=None):
+        """An iterable that yields batches of rows from table using keyset pagination
+
+        Use SQL.iter_table to create one. After each batch is yielded, token is
+        a string that can be passed as start_after to SQL.iter_table to resume
+        after the last row of that batch
+        """
+        self.table = table
+        self.key = list(key)
+        self.batch_size = batch_size
+        self.params = dict(params)
+        self.after = list(after) if after is not None else None
+        self.rows = 0
+        self.batches = 0
+        self._sql = sql
+        if columns:
+            columns = self.key + [c for c in columns if c not in self.key]
+            select = ', '.join(columns)
+        elif sql._type == 'sqlite' and 'rowid' in self.key:
+            # SELECT * doesn't include the rowid of a table without a primary key
+            select = ', '.join(self.key) + ', *'
+        else:
+            select = '*'
+        self._start = 'SELECT {} FROM {}'.format(select, table)
+        self._where = '({})'.format(where) if where else ''
+        self._end = ' ORDER BY {} LIMIT {}'.format(', '.join(self.key), batch_size)
+        self._seek = self._seek_clause(sql._type)
+
+    def __repr__(self):
+        return '<TableIterator {} key={} rows={}>'.format(self.table, self.key, self.rows)
+
+    def _seek_clause(self, db_type):
+        """Return the where clause for rows after the :_after_N params"""
+        names = [':_after_{}'.format(i) for i in range(len(self.key))]
+        if len(self.key) == 1:
+            return '{} > {}'.format(self.key[0], names[0])
+        if db_type == 'postgresql':
+            return '({}) > ({})'.format(', '.join(self.key), ', '.join(names))
+        clauses = []
+        for i, column in enumerate(self.key):
+            equals = [
+                '{} = {}'.format(self.key[j], names[j])
+                for j in range(i)
+            ]
+            clauses.append('({})'.format(' AND '.join(equals + ['{} > {}'.format(column, names[i])])))
+        return '({})'.format(' OR '.join(clauses))
+
+    @property
+    def token(self):
+        """Resumable cursor token (None if no rows have been read yet)"""
+        if self.after is None:
+            return None
+        return json.dumps({'table': self.table, 'key': self.key, 'after': self.after}, default=str)
+
+    def __iter__(self):
+        while True:
+            params = dict(self.params)
+            where = self._where
+            if self.after is not None:
+                for i, value in enumerate(self.after):
+                    params['_after_{}'.format(i)] = value
+                where = '{} AND {}'.format(where, self._seek) if where else self._seek
+            statement = self._start + (' WHERE ' + where if where else '') + self._end
+            rows = self._sql._execute(statement, params, row_format='dict')
+            if not rows:
+                return
+            self.after = [rows[-1][column] for column in self.key]
+            self.rows += len(rows)
+            self.batches += 1
+            yield rows
+            if len(rows) < self.batch_size:
+                return
+
+
 class SQL(object):
-    def __init__(self, url, connect_timeout=CONNECT_TIMEOUT, attempt_docker=False,
-                 wait=False, **connect_args):
+    def __init__(self, url, connect_timeout=None, attempt_docker=False,
+                 wait=False, metadata_cache=False, metadata_cache_ttl=300,
+                 metadata_cache_size=256, result_cache=False, result_cache_ttl=60,
+                 result_cache_size=1000, result_cache_maxbytes=None,
+                 result_cache_path=None, statement_cache_size=512, instrument=False,
+                 slow_query_seconds=None, stats_exporter=None,
+                 stats_max_statements=1000, explain_slow_seconds=None,
+                 slow_plans_size=100, share_engine=True, pool_options=None,
+                 **connect_args):
         """An instance that can execute SQL statements on a SQL db (postgresql/mysql/sqlite/etc)
 
         - url: connection url to a SQL db
@@ -172,84 +1513,708 @@ class SQL(object):
                 - You must install the `sqlalchemy-redshift` package wherever you
                   installed `sql-helper` to connect to a redshift instance
         - connect_timeout: number of seconds to wait for connection before giving up
+          (default is connect_timeout in settings.ini, or 5)
         - attempt_docker: if True, and unable to connect initially, call start_docker
           if url matches postgresql_url or mysql_url in settings.ini
         - wait: if True and attempt_docker is True,
+        - metadata_cache: if True, cache results of get_tables, get_indexes,
+          and get_columns (and the get_*_columns methods that use it); cache
+          is cleared whenever a create/alter/drop/rename statement is executed
+          or refresh_metadata_cache is called
+        - metadata_cache_ttl: number of seconds metadata_cache entries are
+          valid for (None for no expiration)
+        - metadata_cache_size: max number of metadata_cache entries to keep
+          (least recently used are evicted first)
+        - result_cache: if True, cache results of read-only statements passed
+          to execute (keyed on normalized statement text and params); entries
+          that mention a table are invalidated when a statement that writes to
+          that table is executed
+        - result_cache_ttl: default number of seconds result_cache entries are
+          valid for (None for no expiration)
+        - result_cache_size: max number of result_cache entries to keep (least
+          recently used are evicted first)
+        - result_cache_maxbytes: max total size (in pickled bytes) of
+          result_cache entries
+        - result_cache_path: path to a local sqlite file to store the
+          result_cache in (so it survives restarts) instead of memory
+        - statement_cache_size: max number of compiled text() constructs and
+          generated insert statements to keep (least recently used are evicted
+          first)
+        - instrument: if True, record latency, rows, and pool wait time for
+          every statement sent to the db (see stats)
+        - slow_query_seconds: if specified, log a warning with the statement
+          and params whenever a statement takes at least this many seconds
+          (implies instrument=True)
+        - stats_exporter: if specified, a func that is called with a dict of
+          info after every statement (implies instrument=True); keys are
+          fingerprint, statement, params, seconds, rows, pool_wait, error,
+          and slow
+        - stats_max_statements: max number of distinct statement
+          fingerprints to keep stats for (others are combined under '<other>')
+        - explain_slow_seconds: if specified, capture the plan (see explain)
+          of any statement passed to execute that takes at least this many
+          seconds (see slow_plans)
+        - slow_plans_size: max number of captured slow plans to keep
+        - share_engine: if True, SQL instances with the same url, connect args,
+          and pool options share one engine (and connection pool) per
+          process; instances with instrumentation and in-memory sqlite
+          instances always get their own engine
+        - pool_options: dict of create_engine pool kwargs (pool_size,
+          max_overflow, pool_recycle, pool_pre_ping, pool_use_lifo,
+          pool_timeout); if None, the values set in settings.ini are used
 
         Other kwargs passed in will be passed to sqlalchemy.create_engine as
         connect_args
+
+        No connection is made until the first statement (or warm is called),
+        unless attempt_docker is True. Passing connect_timeout and pool_options
+        avoids loading settings.ini
+
+        Pooled connections are never reused across a fork: connections made
+        in a parent process are discarded in the child (see pool_stats)
         """
         if not url:
             raise ValueError('The url cannot be None or empty string')
+        if connect_timeout is None:
+            connect_timeout = _get_connect_timeout()
         if url.startswith('sqlite'):
             connect_args['timeout'] = connect_timeout
         elif url.startswith('postgresql') or url.startswith('mysql'):
             connect_args['connect_timeout'] = connect_timeout
 
         url = self._fix_mysql_url(url)
+        self._connect_args = connect_args
+        self._local = threading.local()
+        self._metadata_cache = None
+        self._schema = None
+        if metadata_cache:
+            self._metadata_cache = _LRUCache(metadata_cache_size, metadata_cache_ttl)
+        self._statement_cache = _LRUCache(statement_cache_size)
+        self._result_cache = None
+        if result_cache_path:
+            self._result_cache = _SqliteCache(
+                result_cache_path, result_cache_size, result_cache_ttl,
+                maxbytes=result_cache_maxbytes
+            )
+        elif result_cache:
+            self._result_cache = _LRUCache(
+                result_cache_size, result_cache_ttl, maxbytes=result_cache_maxbytes
+            )
+        self._inspector_instance = None
+        instrumented = (
+            instrument or slow_query_seconds is not None or stats_exporter is not None
+        )
+        self._shared_engine = share_engine and not instrumented and not _is_sqlite_memory(url)
+        pool_options = _pool_options(url, pool_options)
         try:
-            self._engine = create_engine(url, connect_args=connect_args)
+            self._engine = _get_engine(url, connect_args, pool_options, share=self._shared_engine)
         except NoSuchModuleError as e:
             raise
-        try:
-            self._inspector = inspect(self._engine)
-        except OperationalError as e:
-            if 'Connection refused' in repr(e) and attempt_docker is True:
-                if url in [SETTINGS.get('postgresql_url'), self._fix_mysql_url(SETTINGS.get('mysql_url', ''))]:
+        if attempt_docker is True:
+            try:
+                self.warm()
+            except OperationalError as e:
+                settings = _get_settings()
+                if 'Connection refused' not in repr(e):
+                    raise
+                if url in [settings.get('postgresql_url'), self._fix_mysql_url(settings.get('mysql_url', ''))]:
                     if url.startswith('postgresql'):
                         db_type = 'postgresql'
                     elif url.startswith('mysql'):
                         db_type = 'mysql'
                     start_docker(db_type, show=True, wait=wait)
-                    self._engine = create_engine(url, connect_args=connect_args)
-                    self._inspector = inspect(self._engine)
+                    self._engine.dispose()
+                    self.warm()
                 else:
                     raise
-            else:
-                raise
 
-        if (
-            self._engine.url.drivername.startswith('postgresql') or
-            self._engine.url.drivername == 'redshift+psycopg2'
-        ):
-            self._type = 'postgresql'
-        elif self._engine.url.drivername.startswith('mysql'):
-            self._type = 'mysql'
-        elif self._engine.url.drivername.startswith('sqlite'):
-            self._type = 'sqlite'
-        else:
-            self._type = self._engine.url.drivername
+        self._type = _db_type(self._engine.url.drivername)
+        self._slow_query_seconds = slow_query_seconds
+        self._stats_exporter = stats_exporter
+        self._stats_max_statements = stats_max_statements
+        self._stats_lock = threading.Lock()
+        self._stats = None
+        self._explain_slow_seconds = explain_slow_seconds
+        self._slow_plans = deque(maxlen=slow_plans_size)
+        if instrumented:
+            self._stats = OrderedDict()
+            event.listen(self._engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(self._engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(self._engine, 'handle_error', self._handle_error)
 
-    def _fix_mysql_url(self, url):
-        """Make sure any mysql:// becomes mysql+pymysql://"""
+    @property
+    def _inspector(self):
+        """sqlalchemy Inspector for the engine (created, connecting to the db, on first use)"""
+        if self._inspector_instance is None:
+            self._inspector_instance = inspect(self._engine)
+        return self._inspector_instance
+
+    def warm(self, connections=1):
+        """Connect to the db and create the inspector now instead of on first use
+
+        - connections: number of connections to open and return to the pool
+
+        Returns the SQL instance, so `sql = SQL(url).warm()` can be used
+        """
+        self._inspector
+        conns = [self._engine.connect() for _ in range(max(connections, 1))]
+        for conn in conns:
+            conn.close()
+        return self
+
+    def _record_pool_wait(self, start):
+        """Record seconds since start as the wait for a connection checkout"""
+        seconds = time.perf_counter() - start
+        self._local.pool_wait = seconds
+        stats = _pool_stats.get(self._engine)
+        if stats is not None:
+            stats.record_wait(seconds)
+
+    def pool_stats(self):
+        """Return a dict of info about the connection pool of the engine
+
+        Keys are pool (class name), shared (if the engine is shared with other
+        SQL instances), size, checked_in, checked_out, overflow (None if the
+        pool type does not track it), connects, checkouts, checkins,
+        invalidations, and wait_p50, wait_p95, wait_p99, wait_max (seconds
+        waited to check out a connection, measured for statements run by SQL
+        instances)
+        """
+        pool = self._engine.pool
+        stats = _pool_stats.get(self._engine) or _PoolStats()
+
+        def call(name):
+            func = getattr(pool, name, None)
+            if func is None:
+                return None
+            try:
+                return func()
+            except (AttributeError, NotImplementedError, TypeError):
+                return None
+
+        with stats.lock:
+            return {
+                'pool': pool.__class__.__name__,
+                'shared': self._shared_engine,
+                'size': call('size'),
+                'checked_in': call('checkedin'),
+                'checked_out': call('checkedout'),
+                'overflow': call('overflow'),
+                'connects': stats.connects,
+                'checkouts': stats.checkouts,
+                'checkins': stats.checkins,
+                'invalidations': stats.invalidations,
+                'wait_p50': stats.wait.percentile(50),
+                'wait_p95': stats.wait.percentile(95),
+                'wait_p99': stats.wait.percentile(99),
+                'wait_max': stats.wait.max,
+            }
+
+    def dispose(self):
+        """Close all pooled connections of the engine (new ones are made as needed)
+
+        If the engine is shared (same url, connect_args, and pool options,
+        share_engine=True), this closes the pool of every other SQL instance
+        using it too; their next statements check out new connections
+        """
+        self._engine.dispose()
+
+    def _fix_mysql_url(self, url):
+        """Make sure any mysql:// becomes mysql+pymysql://"""
         match = rx_mysql.match(url)
         if match:
             url = 'mysql+pymysql://' + match.group(1)
         return url
 
-    def _execute_raw(self, statement, params={}):
+    @contextmanager
+    def connection(self):
+        """Pin one connection for every statement run (in this thread) inside the with block
+
+        Each statement is still committed on its own (unless inside a
+        transaction block), but the pool checkout happens only once
+
+            with sql.connection():
+                for statement in statements:
+                    sql.execute(statement)
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        start = time.perf_counter()
+        conn = self._engine.connect()
+        self._record_pool_wait(start)
+        self._local.conn = conn
+        self._local.in_transaction = False
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            conn.close()
+
+    @contextmanager
+    def transaction(self, savepoint=False):
+        """Run every statement (in this thread) inside the with block on one connection in one transaction
+
+        - savepoint: if True and already inside a transaction block, use a
+          SAVEPOINT so only the statements in this block are rolled back if
+          there is an exception (otherwise, this block just joins the outer
+          transaction)
+
+        The transaction is committed once at the end of the block (or rolled
+        back if there is an exception). Statements from execute, iter_execute,
+        insert, bulk_insert, load (except mysql LOAD DATA, which needs its own
+        connection), export, and call_procedure all use the pinned connection.
+        The result_cache is not used inside a transaction block, and cached
+        results of tables written in the block are removed after the commit
+
+            with sql.transaction():
+                sql.insert('table1', data1)
+                sql.execute('update table2 set x = :x', {'x': 1})
+
+        Note: SAVEPOINT on sqlite requires the pysqlite transaction workaround
+        from the sqlalchemy docs
+        """
+        with self.connection() as conn:
+            if self._local.in_transaction:
+                if savepoint:
+                    trans = conn.begin_nested()
+                    try:
+                        yield conn
+                    except BaseException:
+                        trans.rollback()
+                        raise
+                    trans.commit()
+                else:
+                    yield conn
+                return
+            trans = conn.begin()
+            self._local.in_transaction = True
+            self._local.pending_tags = set()
+            try:
+                yield conn
+            except BaseException:
+                trans.rollback()
+                raise
+            else:
+                trans.commit()
+                self._invalidate_pending_results(self._local.pending_tags)
+            finally:
+                self._local.in_transaction = False
+                self._local.pending_tags = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('sql_helper_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['sql_helper_start'].pop()
+        if cursor.description is None:
+            self._record_query(statement, parameters, seconds, rows=cursor.rowcount)
+        else:
+            # rowcount is -1 for a select on most drivers, so rows are counted
+            # as they are fetched (see _count_fetched)
+            key = self._record_query(statement, parameters, seconds)
+            if context is not None:
+                context._sql_helper_stats_key = key
+
+    def _handle_error(self, context):
+        conn = context.connection
+        if conn is None or not conn.info.get('sql_helper_start'):
+            return
+        seconds = time.perf_counter() - conn.info['sql_helper_start'].pop()
+        self._record_query(context.statement or '', context.parameters, seconds, error=True)
+
+    def _count_fetched(self, result, num_rows):
+        """Add num_rows fetched from a result to the rows stat of its statement"""
+        if self._stats is None or not num_rows:
+            return
+        key = getattr(getattr(result, 'context', None), '_sql_helper_stats_key', None)
+        if key is None:
+            return
+        with self._stats_lock:
+            info = self._stats.get(key)
+            if info is not None:
+                info['rows'] += num_rows
+
+    def _record_query(self, statement, params, seconds, rows=None, error=False):
+        """Add the latency/rows/pool wait of a statement to stats, log it if slow, and export it
+
+        - rows: number of rows affected, as reported by the driver (ignored if
+          negative); rows of a select are added by _count_fetched as they are
+          fetched through execute, iter_execute, etc
+
+        The pool wait time of the most recent connection checkout in this
+        thread is attributed to the first statement run on it. Return the key
+        the statement's stats are kept under
+        """
+        pool_wait = getattr(self._local, 'pool_wait', None)
+        self._local.pool_wait = None
+        fingerprint = _fingerprint(statement)
+        if rows is not None and rows < 0:
+            rows = None
+        with self._stats_lock:
+            key = fingerprint
+            if key not in self._stats and len(self._stats) >= self._stats_max_statements:
+                key = '<other>'
+            info = self._stats.get(key)
+            if info is None:
+                info = self._stats[key] = {
+                    'calls': 0, 'errors': 0, 'rows': 0,
+                    'latency': _Histogram(), 'pool_wait': _Histogram(),
+                }
+            info['calls'] += 1
+            if error:
+                info['errors'] += 1
+            if rows:
+                info['rows'] += rows
+            info['latency'].record(seconds)
+            if pool_wait is not None:
+                info['pool_wait'].record(pool_wait)
+
+        slow = self._slow_query_seconds is not None and seconds >= self._slow_query_seconds
+        if slow:
+            logger.warning(
+                'Slow query (%.3f seconds): %s -- params: %s',
+                seconds, statement, repr(params)[:1000]
+            )
+        if self._stats_exporter is not None:
+            try:
+                self._stats_exporter({
+                    'fingerprint': fingerprint, 'statement': statement,
+                    'params': params, 'seconds': seconds, 'rows': rows,
+                    'pool_wait': pool_wait, 'error': error, 'slow': slow,
+                })
+            except Exception:
+                logger.exception('stats_exporter raised an exception')
+        return key
+
+    def stats(self, reset=False):
+        """Return an OrderedDict of latency stats per statement fingerprint (most total time first)
+
+        - reset: if True, clear the stats after returning them
+
+        Each value is a dict with calls, errors, rows, total_seconds,
+        mean_seconds, max_seconds, p50, p95, p99 (seconds), and pool_wait_p50,
+        pool_wait_p95, pool_wait_p99 (seconds waited to check out a connection)
+
+        Percentiles come from log-linear histograms, so they are accurate to
+        within about 3%. An empty dict is returned if the SQL instance was not
+        created with instrument=True (or slow_query_seconds/stats_exporter)
+        """
+        results = OrderedDict()
+        if self._stats is None:
+            return results
+        with self._stats_lock:
+            items = list(self._stats.items())
+            if reset:
+                self._stats.clear()
+        summaries = []
+        for fingerprint, info in items:
+            latency = info['latency']
+            pool_wait = info['pool_wait']
+            summaries.append((fingerprint, {
+                'calls': info['calls'],
+                'errors': info['errors'],
+                'rows': info['rows'],
+                'total_seconds': latency.total,
+                'mean_seconds': latency.total / latency.count if latency.count else None,
+                'max_seconds': latency.max,
+                'p50': latency.percentile(50),
+                'p95': latency.percentile(95),
+                'p99': latency.percentile(99),
+                'pool_wait_p50': pool_wait.percentile(50),
+                'pool_wait_p95': pool_wait.percentile(95),
+                'pool_wait_p99': pool_wait.percentile(99),
+            }))
+        for fingerprint, info in sorted(summaries, key=lambda s: -s[1]['total_seconds']):
+            results[fingerprint] = info
+        return results
+
+    def _explain_rows(self, statement, params={}):
+        """Execute an EXPLAIN statement (or statement being analyzed) and return all rows
+
+        Outside of a transaction block, it runs in its own transaction that is
+        rolled back (so EXPLAIN ANALYZE of a write statement has no effect)
+        """
+        if self._in_transaction():
+            res = self._local.conn.execute(text(statement), params)
+            return res.fetchall() if res.returns_rows else []
+        with self._engine.connect() as conn:
+            trans = conn.begin()
+            try:
+                res = conn.execute(text(statement), params)
+                return res.fetchall() if res.returns_rows else []
+            finally:
+                trans.rollback()
+
+    def explain(self, statement, params={}, analyze=False):
+        """Return a dict with the normalized query plan for statement
+
+        - statement: a select/insert/update/delete statement
+        - params: dict containing any :param names in statement
+        - analyze: if True, actually run the statement to get actual row counts
+          and times (EXPLAIN ANALYZE on postgresql and mysql 8.0.18+; timed
+          execution on sqlite); write statements are rolled back unless inside
+          a transaction block
+
+        Uses EXPLAIN (FORMAT JSON) on postgresql, EXPLAIN FORMAT=JSON on mysql,
+        and EXPLAIN QUERY PLAN on sqlite. The returned dict has keys:
+
+        - db_type: postgresql, mysql, or sqlite
+        - statement: the statement explained
+        - plan: tree of plan nodes, each a dict with operation, relation,
+          index, uses_index, full_scan, rows (estimated), cost (estimated),
+          actual_rows, actual_seconds, detail, and children (values that the
+          db does not report are None)
+        - full_scans: names of relations read with a full table scan
+        - indexes: names of indexes used
+        - raw: the plan as returned by the db
+        """
+        statement = statement.strip().rstrip(';')
+        if self._type == 'postgresql':
+            options = 'FORMAT JSON, ANALYZE' if analyze else 'FORMAT JSON'
+            raw = self._explain_rows('EXPLAIN ({}) {}'.format(options, statement), params)[0][0]
+            if isinstance(raw, str):
+                raw = json.loads(raw)
+            top = raw[0]
+            plan = _postgresql_plan(top['Plan'])
+            if 'Execution Time' in top:
+                plan['actual_seconds'] = top['Execution Time'] / 1000.0
+        elif self._type == 'mysql':
+            raw = json.loads(self._explain_rows('EXPLAIN FORMAT=JSON {}'.format(statement), params)[0][0])
+            query_block = raw.get('query_block', raw)
+            cost = query_block.get('cost_info', {}).get('query_cost')
+            plan = _plan_node(
+                'query_block',
+                cost=float(cost) if cost is not None else None,
+                children=_mysql_plan_nodes(query_block),
+            )
+            if analyze:
+                start = time.perf_counter()
+                analyzed = self._explain_rows('EXPLAIN ANALYZE {}'.format(statement), params)
+                plan['actual_seconds'] = time.perf_counter() - start
+                plan['detail'] = analyzed[0][0]
+        elif self._type == 'sqlite':
+            raw = [tuple(row) for row in self._explain_rows('EXPLAIN QUERY PLAN {}'.format(statement), params)]
+            plan = _sqlite_plan(raw)
+            if analyze:
+                start = time.perf_counter()
+                rows = self._explain_rows(statement, params)
+                plan['actual_seconds'] = time.perf_counter() - start
+                plan['actual_rows'] = len(rows)
+        else:
+            raise NotImplementedError('explain is not supported for {}'.format(self._type))
+
+        nodes = list(_walk_plan(plan))
+        return {
+            'db_type': self._type,
+            'statement': statement,
+            'plan': plan,
+            'full_scans': [node['relation'] for node in nodes if node['full_scan'] and node['relation']],
+            'indexes': [node['index'] for node in nodes if node['index']],
+            'raw': raw,
+        }
+
+    def _capture_plan(self, statement, params, seconds):
+        """Add the plan for a slow statement to slow_plans (and log it)"""
+        if not rx_explainable.match(statement) or not isinstance(params, dict):
+            return
+        try:
+            plan = self.explain(statement, params)
+        except Exception as e:
+            logger.warning('Unable to explain slow statement: %s', repr(e))
+            return
+        self._slow_plans.append({
+            'time': time.time(), 'seconds': seconds, 'statement': statement,
+            'params': params, 'explain': plan,
+        })
+        logger.warning(
+            'Slow statement (%.3f seconds, full scans: %s): %s',
+            seconds, ', '.join(plan['full_scans']) or 'none', statement
+        )
+
+    def slow_plans(self, clear=False):
+        """Return list of dicts for plans captured for slow statements (newest last)
+
+        - clear: if True, remove the captured plans after returning them
+
+        Each dict has time, seconds, statement, params, and explain (the dict
+        returned by explain). Plans are only captured if the SQL instance was
+        created with explain_slow_seconds
+        """
+        results = list(self._slow_plans)
+        if clear:
+            self._slow_plans.clear()
+        return results
+
+    def _in_transaction(self):
+        return getattr(self._local, 'conn', None) is not None and self._local.in_transaction
+
+    @contextmanager
+    def _begin(self):
+        """Yield a connection with a transaction begun (or the pinned connection)
+
+        The transaction is committed at the end of the with block, unless the
+        connection is pinned by a transaction block or already has a
+        transaction open (like the one of a result still being streamed by
+        iter_execute), which is then joined
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            start = time.perf_counter()
+            with self._engine.begin() as conn:
+                self._record_pool_wait(start)
+                yield conn
+        elif self._local.in_transaction or conn.in_transaction():
+            yield conn
+        else:
+            with conn.begin():
+                yield conn
+
+    @contextmanager
+    def _raw_connection(self):
+        """Yield a DBAPI connection (from the pinned connection, if any)
+
+        It is committed at the end of the with block (or rolled back if there is
+        an exception), unless the connection is pinned by a transaction block
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            raw_conn = conn.connection
+            if self._local.in_transaction:
+                yield raw_conn
+                return
+        else:
+            start = time.perf_counter()
+            raw_conn = self._engine.raw_connection()
+            self._record_pool_wait(start)
+        try:
+            yield raw_conn
+            raw_conn.commit()
+        except BaseException:
+            raw_conn.rollback()
+            raise
+        finally:
+            if conn is None:
+                raw_conn.close()
+
+    def _text(self, statement):
+        """Return a sqlalchemy text construct for statement (cached by statement string)"""
+        clause = self._statement_cache.get(statement)
+        if clause is None:
+            clause = text(statement)
+            self._statement_cache.set(statement, clause)
+        return clause
+
+    def _is_script(self, statement):
+        """Return True if statement is the path to a sql script
+
+        Statements that start with a SQL keyword (or a comment or parenthesis)
+        are never checked against the filesystem
+        """
+        return (
+            '\n' not in statement and
+            rx_sql_keyword.match(statement) is None and
+            isfile(statement)
+        )
+
+    def _execute_raw(self, statement, params={}, script=None):
         """Pass statement to SQL engine and return object before fetchall/fetchone
 
         - statement: a string or path to a sql script
         - params: dict or list of dicts containing any :param names in string statement
+        - script: if True, statement is the path to a sql script; if False,
+          statement is never treated as a path; if None, check if it is a path
+          (only when the statement does not start with a SQL keyword)
         """
-        if isfile(statement):
+        if script is None:
+            script = self._is_script(statement)
+        if script:
             with open(statement, 'r') as fp:
                 script_contents = fp.read()
-            with self._engine.begin() as conn:
+            with self._begin() as conn:
                 res = conn.execute(text(script_contents))
+            self.refresh_metadata_cache()
+            self._invalidate_results()
             return res
 
-        with self._engine.begin() as conn:
-            res = conn.execute(text(statement), params)
+        with self._begin() as conn:
+            res = conn.execute(self._text(statement), params)
+        if rx_ddl.match(statement):
+            self.refresh_metadata_cache()
+        self._invalidate_results(statement)
         return res
 
-    def execute(self, statement, params={}):
+    def _invalidate_results(self, statement=None, table=None):
+        """Remove cached results affected by a statement (or a write to table)
+
+        Cached results are kept for read-only statements and create statements;
+        if the table written to cannot be determined (or neither statement nor
+        table is given), the whole cache is cleared. Inside a transaction
+        block, results are removed after the commit (see transaction), so
+        other threads can't cache rows from before it in between
+        """
+        if self._result_cache is None:
+            return
+        tag = None
+        if table is None and statement is not None:
+            if _is_read_only(statement) or rx_create.match(statement):
+                return
+            match = rx_write_target.match(statement)
+            if match:
+                table = match.group(1)
+        if table is not None:
+            tag = table.replace('`', '').replace('"', '').split('.')[-1].lower()
+        if self._in_transaction():
+            self._local.pending_tags.add(tag)
+        elif tag is None:
+            self._result_cache.clear()
+        else:
+            self._result_cache.invalidate_tags([tag])
+
+    def _invalidate_pending_results(self, tags):
+        """Remove cached results for tags collected in a transaction block (None clears all)"""
+        if self._result_cache is None or not tags:
+            return
+        if None in tags:
+            self._result_cache.clear()
+        else:
+            self._result_cache.invalidate_tags(tags)
+
+    def clear_result_cache(self):
+        """Remove all cached results"""
+        if self._result_cache is not None:
+            self._result_cache.clear()
+
+    def _result_cache_key(self, statement, params):
+        """Return key for db url, statement (whitespace normalized outside of quotes), and params
+
+        The url is part of the key since a result_cache_path can be shared by
+        SQL instances for different dbs
+        """
+        normalized = rx_quoted_or_space.sub(lambda m: m.group(1) or ' ', statement).strip()
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        return str(self._engine.url) + ' -- ' + normalized + ' -- ' + repr(params)
+
+    def execute(self, statement, params={}, cache=None, cache_ttl=None, row_format=None):
         """Pass statement to SQL engine and return a list of dicts, list, dict, or value
 
         - statement: a string or path to a sql script
         - params: dict or list of dicts containing any :param names in string
           statement
+        - cache: if False, don't use the result_cache for this call (only
+          applies if result_cache was enabled when SQL instance was created)
+        - cache_ttl: number of seconds to keep these results in the
+          result_cache (default is result_cache_ttl)
+        - row_format: if None, shape the results as described below; otherwise
+          one of 'dict', 'tuple', 'record', or 'columns'
+            - 'dict': list of dicts (even for 1 column or 1 row)
+            - 'tuple': list of tuples, where the first tuple is the column names
+            - 'record': list of namedtuples (fields that are not valid
+              identifiers are renamed to _0, _1, etc)
+            - 'columns': OrderedDict of column name to list of values (or
+              array.array for columns that are all int or all float)
 
         If the result returns rows of info and the first result only has 1
         column, a simple list is returned; if there are multiple columns, a
@@ -257,10 +2222,304 @@ class SQL(object):
         in the statement, the item (dict or value) at index 0 is returned
 
         If the result does not return rows, or result set is empty, an empty
-        list is returned
+        list is returned (for row_format 'tuple' or 'columns', an empty result
+        set still includes the column names)
+        """
+        import pickle
+        if row_format is not None and row_format not in ROW_FORMATS:
+            raise ValueError('row_format must be one of {}, not {}'.format(ROW_FORMATS, repr(row_format)))
+        # namedtuple classes are made on the fly and can't be pickled, so
+        # 'record' results are fetched (and cached) as tuples, then converted
+        fetch_format = 'tuple' if row_format == 'record' else row_format
+        use_cache = (
+            self._result_cache is not None and cache is not False and
+            _is_read_only(statement) and
+            not self._in_transaction()
+        )
+        results = _MISSING
+        if use_cache:
+            key = self._result_cache_key(statement, params)
+            if fetch_format is not None:
+                key += ' -- ' + fetch_format
+            cached = self._result_cache.get(key, _MISSING)
+            if cached is not _MISSING:
+                results = pickle.loads(cached)
+        if results is _MISSING:
+            start = time.perf_counter()
+            results = self._execute(statement, params, row_format=fetch_format)
+            seconds = time.perf_counter() - start
+            if self._explain_slow_seconds is not None and seconds >= self._explain_slow_seconds:
+                self._capture_plan(statement, params, seconds)
+            if use_cache:
+                value = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+                self._result_cache.set(
+                    key, value, ttl=cache_ttl, size=len(value),
+                    tags=rx_word.findall(statement.lower())
+                )
+        if row_format == 'record' and results:
+            results = _format_rows(results[0], results[1:], 'record')
+        return results
+
+    def _interrupt(self, conn):
+        """Ask the db to stop the statement running on conn in another thread"""
+        raw_conn = conn.connection
+        try:
+            if self._type == 'sqlite':
+                raw_conn.interrupt()
+            elif self._engine.dialect.driver == 'psycopg2':
+                raw_conn.cancel()
+            elif self._engine.dialect.driver == 'pymysql':
+                with self._engine.connect() as other_conn:
+                    other_conn.execute(text('KILL QUERY {}'.format(int(raw_conn.thread_id()))))
+        except Exception:
+            logger.warning('Unable to interrupt statement', exc_info=True)
+
+    def _parallel_workers(self, max_workers, num_statements):
+        """Return number of threads to use for execute_many_parallel"""
+        url = self._engine.url
+        if self._type == 'sqlite' and url.database in (None, '', ':memory:'):
+            # each thread gets its own in-memory database
+            return 1
+        if max_workers is None:
+            max_workers = 5
+            try:
+                max_workers = self._engine.pool.size() + max(self._engine.pool._max_overflow, 0)
+            except (AttributeError, TypeError):
+                pass
+        return max(1, min(max_workers, num_statements))
+
+    def execute_many_parallel(self, statements, max_workers=None, ordered=True,
+                              timeout=None, show=False, **kwargs):
+        """Run independent statements concurrently on pooled connections and return dict of results
+
+        - statements: list of strings and/or (statement, params) tuples
+        - max_workers: max number of statements to run at the same time
+          (default is pool size + max overflow, or 5)
+        - ordered: if True, results are in the same order as statements; if
+          False, results are in the order they completed
+        - timeout: number of seconds (since the call started) to wait for each
+          statement before reporting it as timed out
+        - show: if True, print each statement's seconds (and any error) as it
+          completes, then the total
+
+        Additional kwargs (cache, cache_ttl, row_format) are passed to execute
+
+        The returned dict has results (list of dicts with index, statement,
+        params, result, error, and seconds), errors (number of statements that
+        failed or timed out), seconds (wall time of the call),
+        statement_seconds (sum of each completed statement's seconds), and speedup
+        (statement_seconds / seconds); seconds is None for timed out statements
+
+        An error or timeout in one statement does not cancel the others. When
+        the timeout is reached, statements that haven't started are cancelled
+        and running ones are interrupted (sqlite interrupt, postgresql cancel,
+        mysql KILL QUERY); their connections are invalidated instead of being
+        returned to the pool. Each statement runs in its own transaction on
+        its own connection, so this does not use the connection of a
+        transaction block; with an in-memory sqlite db, statements are run one
+        at a time
         """
-        cursor = self._execute_raw(statement, params)
+        items = []
+        for index, statement in enumerate(statements):
+            params = {}
+            if isinstance(statement, (tuple, list)):
+                statement, params = statement
+            items.append({
+                'index': index, 'statement': statement, 'params': params,
+                'result': None, 'error': None, 'seconds': None,
+            })
+        stats = {
+            'results': [], 'errors': 0, 'seconds': 0.0, 'statement_seconds': 0.0,
+            'speedup': None,
+        }
+        if not items:
+            return stats
+
+        running = {}
+        timed_out = set()
+
+        def run(item):
+            item = dict(item)
+            start = time.perf_counter()
+            with self.connection() as conn:
+                running[item['index']] = conn
+                try:
+                    item['result'] = self.execute(item['statement'], item['params'], **kwargs)
+                except Exception as e:
+                    item['error'] = str(e)
+                finally:
+                    del running[item['index']]
+                    if item['index'] in timed_out:
+                        # the connection may be mid-statement or interrupted
+                        conn.invalidate()
+            item['seconds'] = time.perf_counter() - start
+            return item
+
+        def finish(item):
+            stats['results'].append(item)
+            if item['error'] is not None:
+                stats['errors'] += 1
+            if item['seconds'] is not None:
+                stats['statement_seconds'] += item['seconds']
+            if show:
+                print('{:>8.3f}s  {}{}'.format(
+                    item['seconds'] or 0, ' '.join(item['statement'].split())[:80],
+                    '  ERROR: {}'.format(item['error']) if item['error'] else ''
+                ))
+
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(
+            max_workers=self._parallel_workers(max_workers, len(items)),
+            thread_name_prefix='sql-helper-parallel'
+        )
+        try:
+            pending = {executor.submit(run, item): item for item in items}
+            while pending:
+                remaining = None
+                if timeout is not None:
+                    remaining = max(timeout - (time.perf_counter() - start), 0)
+                done, _ = wait_futures(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                if not done:
+                    started = []
+                    for future, item in pending.items():
+                        finish(dict(item, error='Timed out after {} seconds'.format(timeout)))
+                        if not future.cancel():
+                            timed_out.add(item['index'])
+                            started.append(future)
+                    for index in timed_out:
+                        conn = running.get(index)
+                        if conn is not None:
+                            self._interrupt(conn)
+                    if started:
+                        wait_futures(started, timeout=CANCEL_GRACE_SECONDS)
+                    break
+                for future in done:
+                    finish(future.result())
+                    del pending[future]
+        finally:
+            executor.shutdown(wait=all(future.done() for future in pending))
+
+        stats['seconds'] = time.perf_counter() - start
+        if stats['seconds'] > 0:
+            stats['speedup'] = stats['statement_seconds'] / stats['seconds']
+        if ordered:
+            stats['results'].sort(key=lambda item: item['index'])
+        if show:
+            print('{} statements in {:.3f}s ({:.3f}s total statement time, {:.1f}x), {} error(s)'.format(
+                len(items), stats['seconds'], stats['statement_seconds'],
+                stats['speedup'] or 0, stats['errors']
+            ))
+        return stats
+
+    def execute_script(self, path):
+        """Read the sql script at path, pass it to SQL engine, and return results like execute
+
+        Use this (or run_script) for scripts, since execute only checks the
+        filesystem when the statement does not start with a SQL keyword
+        """
+        return self._execute(path, script=True)
+
+    def run_script(self, path, batch_size=100, stop_on_error=True, show=False,
+                   encoding='utf-8'):
+        """Stream the sql script at path, run each statement, and return dict of stats
+
+        - path: path to a .sql file (may be compressed with a .gz/.bz2/.xz extension)
+        - batch_size: number of statements to run (and commit) per transaction
+        - stop_on_error: if True, raise ScriptError (with the line number of the
+          failing statement) at the first error; if False, the failing batch
+          is re-run one statement per transaction so only the failing
+          statements are skipped, and errors are listed in the stats
+        - show: if True, print the running statement count and statements per
+          second after each batch
+        - encoding: encoding of the script
+
+        The script is read one line at a time and split into statements on ';'
+        (outside of quotes, comments, and postgresql dollar-quoted bodies), so
+        scripts of any size can be run; mysql 'DELIMITER xx' lines are
+        supported. Statements are sent as written (no :param parsing). Batches
+        that already ran stay committed when there is an error
+
+        The returned dict has path, statements, batches, errors (list of dicts
+        with line_number, statement, and error), seconds, and
+        statements_per_second
+        """
+        _, ext = os.path.splitext(path.lower())
+        opener = _compression_opener(COMPRESSION_EXTENSIONS.get(ext))
+        stats = {
+            'path': path, 'statements': 0, 'batches': 0, 'errors': [],
+            'seconds': 0.0, 'statements_per_second': 0.0,
+        }
+        start = time.time()
+
+        def run_batch(batch):
+            try:
+                with self._begin() as conn:
+                    for statement, line_number in batch:
+                        try:
+                            _execute_driver_sql(conn, statement)
+                        except Exception as e:
+                            e.sql_helper_line_number = line_number
+                            e.sql_helper_statement = statement
+                            raise
+                stats['statements'] += len(batch)
+            except Exception as e:
+                line_number = getattr(e, 'sql_helper_line_number', None)
+                statement = getattr(e, 'sql_helper_statement', None)
+                if stop_on_error or self._in_transaction():
+                    stats['seconds'] = time.time() - start
+                    raise ScriptError(
+                        '{} line {}: {}'.format(path, line_number, e),
+                        path=path, line_number=line_number,
+                        statement=statement, stats=stats
+                    ) from e
+                if len(batch) > 1:
+                    for item in batch:
+                        run_batch([item])
+                    return
+                stats['errors'].append({
+                    'line_number': line_number, 'statement': statement,
+                    'error': str(e),
+                })
+            stats['batches'] += 1
+            stats['seconds'] = time.time() - start
+            if stats['seconds'] > 0:
+                stats['statements_per_second'] = stats['statements'] / stats['seconds']
+
+        try:
+            with opener(path, 'rt', encoding=encoding) as fp:
+                statements = _split_statements(fp, mysql=self._type == 'mysql')
+                while True:
+                    batch = list(islice(statements, batch_size))
+                    if not batch:
+                        break
+                    run_batch(batch)
+                    if show:
+                        print('{}: ran {} statements ({:.0f} statements/sec), line {}'.format(
+                            path, stats['statements'], stats['statements_per_second'],
+                            batch[-1][1]
+                        ))
+        finally:
+            self.refresh_metadata_cache()
+            self.clear_result_cache()
+
+        stats['seconds'] = time.time() - start
+        if stats['seconds'] > 0:
+            stats['statements_per_second'] = stats['statements'] / stats['seconds']
+        return stats
+
+    def _execute(self, statement, params={}, script=None, row_format=None):
+        cursor = self._execute_raw(statement, params, script=script)
         results = []
+        if row_format is not None:
+            if not cursor.returns_rows:
+                return results
+            columns = list(cursor.keys())
+            rows = cursor.fetchall()
+            self._count_fetched(cursor, len(rows))
+            if row_format == 'tuple':
+                return [tuple(columns)] + _format_rows(columns, rows, 'tuple')
+            return _format_rows(columns, rows, row_format)
+
         try:
             first = cursor.fetchone()
         except ResourceClosedError as err:
@@ -272,33 +2531,285 @@ class SQL(object):
             return results
 
         others = cursor.fetchall()
-        num_columns = len(first)
-        if num_columns == 1:
-            results.append(first[0])
-            results.extend([row[0] for row in others])
-        elif num_columns > 1:
-            if sa_version_tuple[0] <= 1:
-                results.append(dict(first.items()))
-                results.extend([dict(row.items()) for row in others])
+        self._count_fetched(cursor, 1 + len(others))
+        return _shape_results(statement, first, others)
+
+    def _stream(self, statement, params={}, batch_size=1000, empty=False):
+        """Yield (columns, rows) for each batch of rows fetched from a server-side cursor
+
+        - statement: a string (or a sqlalchemy select)
+        - params: dict containing any :param names in string statement
+        - batch_size: max number of rows to fetch from the server at a time
+        - empty: if True, yield (columns, []) when the result set is empty
+
+        Nothing is yielded if the statement does not return rows
+        """
+        if isinstance(statement, str):
+            clause = self._text(statement)
+        else:
+            clause = statement
+        with self._begin() as conn:
+            res = conn.execute(
+                clause.execution_options(
+                    stream_results=True, max_row_buffer=batch_size
+                ),
+                params
+            )
+            if not res.returns_rows:
+                if rx_ddl.match(statement):
+                    self.refresh_metadata_cache()
+                self._invalidate_results(statement)
+                return
+            columns = list(res.keys())
+            num_batches = 0
+            while True:
+                rows = res.fetchmany(batch_size)
+                if not rows:
+                    break
+                self._count_fetched(res, len(rows))
+                num_batches += 1
+                yield columns, rows
+            if empty and num_batches == 0:
+                yield columns, []
+
+    def iter_execute(self, statement, params={}, batch_size=1000, batches=False,
+                     row_format=None):
+        """Pass statement to SQL engine and yield results one row at a time
+
+        - statement: a string
+        - params: dict containing any :param names in string statement
+        - batch_size: number of rows to fetch from the server at a time
+        - batches: if True, yield a list of rows for each batch fetched instead
+          of yielding individual rows
+        - row_format: if None, each row is shaped as described below; otherwise
+          one of 'dict', 'tuple', 'record', or 'columns' (see execute)
+            - 'tuple': the first item yielded is a tuple of column names
+            - 'columns': one OrderedDict of column name to values is yielded
+              per batch (batches is implied)
+
+        Rows are streamed with a server-side cursor (named cursor on postgresql,
+        SSCursor on mysql, incremental stepping on sqlite), so memory use stays
+        flat no matter how big the result set is
+
+        If the result only has 1 column, each row is a simple value; if there
+        are multiple columns, each row is a dict
+        """
+        if row_format is not None and row_format not in ROW_FORMATS:
+            raise ValueError('row_format must be one of {}, not {}'.format(ROW_FORMATS, repr(row_format)))
+        header_sent = False
+        for columns, rows in self._stream(statement, params, batch_size):
+            if row_format is None:
+                if len(columns) == 1:
+                    shaped = [row[0] for row in rows]
+                else:
+                    shaped = [dict(zip(columns, row)) for row in rows]
             else:
-                results.append(dict(first._mapping))
-                results.extend([dict(row._mapping) for row in others])
-        if not others and '(' in statement:
-            results = results[0]
-        return results
+                shaped = _format_rows(columns, rows, row_format)
+                if row_format == 'columns':
+                    yield shaped
+                    continue
+                if row_format == 'tuple' and not header_sent:
+                    header_sent = True
+                    yield tuple(columns)
+            if batches:
+                yield shaped
+            else:
+                for row in shaped:
+                    yield row
+
+    def iter_table(self, table, key=None, batch_size=1000, where='', params={},
+                   start_after=None, columns=None):
+        """Return a TableIterator that yields batches (lists of dicts) of rows from table
+
+        - table: name of table
+        - key: column name or list of column names that uniquely identify a row
+          (default is the primary key, or the autoincrement column(s); rowid
+          on sqlite tables that have neither)
+        - batch_size: number of rows per batch
+        - where: extra condition rows must match (i.e. "status = :status")
+        - params: dict containing any :param names in where
+        - start_after: token from a previous TableIterator, or the key value
+          (or list of values for a multi-column key) to resume after
+        - columns: list of column names to select (key columns are always
+          included); default is all columns
+
+        Each batch is fetched with keyset (seek) pagination, "WHERE key > last
+        ORDER BY key LIMIT batch_size", so every batch is an index range scan
+        no matter how far into the table it is (unlike OFFSET). After each
+        batch, the iterator's token attribute can be saved and passed back as
+        start_after to resume. Rows with a NULL key are skipped
+        """
+        if key is None:
+            key = self.get_primary_key(table) or self.get_autoincrement_columns(table, name_only=True)
+            if not key and self._type == 'sqlite':
+                key = ['rowid']
+            if not key:
+                raise ValueError(
+                    'Table {} has no primary key or autoincrement column, so key must be specified'.format(table)
+                )
+        elif isinstance(key, str):
+            key = [key]
+        key = list(key)
+        after = start_after
+        if isinstance(start_after, str) and start_after.startswith('{'):
+            token = json.loads(start_after)
+            if token['key'] != key:
+                raise ValueError('start_after token is for key {}, not {}'.format(token['key'], key))
+            after = token['after']
+        elif start_after is not None and not isinstance(start_after, (list, tuple)):
+            after = [start_after]
+        if after is not None and len(after) != len(key):
+            raise ValueError('start_after needs {} value(s) for key {}'.format(len(key), key))
+        return TableIterator(
+            self, table, key, batch_size=batch_size, where=where, params=params,
+            columns=columns, after=after
+        )
+
+    def _indexed_columns(self, table):
+        """Return set of column names that are the first column of an index on table"""
+        indexed = set(self.get_primary_key(table)[:1])
+        for index in self.get_indexes(table):
+            if self._type == 'postgresql':
+                match = rx_index_columns.search(index['indexdef'])
+                if match:
+                    indexed.add(match.group(1).split(',')[0].strip().strip('"'))
+            elif self._type == 'mysql':
+                if index['Seq_in_index'] == 1:
+                    indexed.add(index['Column_name'])
+            elif index.get('column_names'):
+                indexed.add(index['column_names'][0])
+        return indexed
+
+    def get_watermark_column(self, table):
+        """Return the name of the best column to use as a watermark for table
+
+        Candidates are timestamp and autoincrement columns. Indexed columns
+        are preferred, then timestamps named like updated/modified/changed,
+        then autoincrement columns, then other timestamps
+
+        Raise ValueError if table has no candidate columns
+        """
+        indexed = self._indexed_columns(table)
+        autoincrement = self.get_autoincrement_columns(table, name_only=True)
+        timestamps = self.get_timestamp_columns(table, name_only=True)
+        candidates = []
+        for position, name in enumerate(self.get_columns(table, name_only=True)):
+            if name in autoincrement:
+                rank = 1
+            elif name in timestamps:
+                rank = 0 if rx_watermark_name.search(name) else 2
+            else:
+                continue
+            candidates.append((name not in indexed, rank, position, name))
+        if not candidates:
+            raise ValueError(
+                'Table {} has no timestamp or autoincrement columns, so column must be specified'.format(table)
+            )
+        return min(candidates)[-1]
+
+    def extract_incremental(self, table, state_path, column=None, overlap=None,
+                            batch_size=10000, where='', params={}, columns=None,
+                            state_key=None):
+        """Yield batches (lists of dicts) of rows of table added or changed since the last extract
+
+        - table: name of table
+        - state_path: path to a json file where watermarks are saved (can be
+          shared by processes; updates are made while holding state_path.lock)
+        - column: name of the watermark column (default is get_watermark_column)
+        - overlap: re-read rows this far behind the saved watermark to catch
+          late-arriving rows (timedelta or number of seconds for timestamp
+          columns, a number for numeric columns)
+        - batch_size: number of rows per batch
+        - where: extra condition rows must match (i.e. "status = :status")
+        - params: dict containing any :param names in where
+        - columns: list of column names to select (the watermark column is
+          always included); default is all columns
+        - state_key: name the watermark is saved under (default is table)
+
+        Rows with column > saved watermark (minus overlap) and <= the max value
+        of column when the extract started are streamed in column order with
+        a server-side cursor, so the read is an index range scan when column
+        is indexed. The watermark is saved atomically (temp file + os.replace)
+        after each batch is consumed, and only advances past a value once
+        every row with that value has been yielded, so an interrupted extract
+        resumes without skipping rows (rows may be repeated; use overlap or
+        dedupe downstream)
+        """
+        if column is None:
+            column = self.get_watermark_column(table)
+        key = state_key or table
+        saved = _load_state(state_path).get(key)
+        watermark = None
+        if saved is not None:
+            if saved['column'] != column:
+                raise ValueError('Watermark for {} in {} is for column {}, not {}'.format(
+                    key, state_path, saved['column'], column
+                ))
+            watermark = _decode_watermark(saved['watermark'])
+        if columns:
+            select = ', '.join([column] + [c for c in columns if c != column])
+        else:
+            select = '*'
+        extra = ' AND ({})'.format(where) if where else ''
+        high = self._execute(
+            'SELECT max({}) FROM {} WHERE {} IS NOT NULL{}'.format(column, table, column, extra),
+            params
+        )
+        if isinstance(high, list):
+            high = high[0] if high else None
+        if high is None:
+            return
+        params = dict(params, _high=high)
+        statement = 'SELECT {} FROM {} WHERE {} <= :_high'.format(select, table, column)
+        if watermark is not None:
+            params['_low'] = _shift_watermark(watermark, overlap)
+            statement += ' AND {} > :_low'.format(column)
+        statement += '{} ORDER BY {}'.format(extra, column)
+
+        rows_read = saved['rows'] if saved else 0
+
+        def save(value):
+            if watermark is not None and value <= watermark:
+                return
+            _save_state(state_path, key, {
+                'table': table, 'column': column, 'watermark': _encode_watermark(value),
+                'rows': rows_read, 'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+            })
+
+        for names, rows in self._stream(statement, params, batch_size):
+            index = names.index(column)
+            yield [dict(zip(names, row)) for row in rows]
+            rows_read += len(rows)
+            # rows with the last value may continue in the next batch
+            last = rows[-1][index]
+            complete = [row[index] for row in rows if row[index] != last]
+            if complete:
+                save(complete[-1])
+        save(high)
 
     def call_procedure(self, procedure, list_of_params=[]):
         """Call the stored procedure with specified params"""
-        raw_conn = self._engine.raw_connection()
-        results = None
-        try:
+        self.clear_result_cache()
+        with self._raw_connection() as raw_conn:
             cursor = raw_conn.cursor()
-            cursor.callproc(procedure, list_of_params)
-            results = list(cursor.fetchall())
-            cursor.close()
-            raw_conn.commit()
-        finally:
-            raw_conn.close()
+            start = time.perf_counter()
+            try:
+                cursor.callproc(procedure, list_of_params)
+                results = list(cursor.fetchall())
+            except Exception:
+                if self._stats is not None:
+                    self._record_query(
+                        'CALL {}'.format(procedure), list_of_params,
+                        time.perf_counter() - start, error=True
+                    )
+                raise
+            finally:
+                cursor.close()
+        if self._stats is not None:
+            self._record_query(
+                'CALL {}'.format(procedure), list_of_params,
+                time.perf_counter() - start, rows=len(results)
+            )
         return results
 
     def _get_postgresql_procedure_names(self, schema='', sort=False):
@@ -382,12 +2893,7 @@ class SQL(object):
         return results
 
     def _get_postgresql_tables(self):
-        results = self.execute(
-            "SELECT schemaname, tablename "
-            "FROM pg_catalog.pg_tables "
-            "WHERE schemaname != 'pg_catalog' AND schemaname != 'information_schema' "
-            "ORDER BY schemaname, tablename"
-        )
+        results = self.execute(POSTGRESQL_TABLES_STATEMENT)
         return [
             r['schemaname'] + '.' + r['tablename']
             for r in results
@@ -396,8 +2902,44 @@ class SQL(object):
     def _get_mysql_tables(self):
         return self.execute("show tables")
 
+    def refresh_metadata_cache(self):
+        """Clear cached table/column/index info (and the inspector's own cache)
+
+        Any SchemaSnapshot saved by describe_all is discarded too
+        """
+        if self._metadata_cache is not None:
+            self._metadata_cache.clear()
+        if self._inspector_instance is not None:
+            self._inspector_instance.info_cache.clear()
+        self._schema = None
+
+    def _cached_metadata(self, key, func):
+        """Return func() or the value cached for key if metadata_cache is enabled"""
+        if self._metadata_cache is None:
+            return func()
+        value = self._metadata_cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = func()
+            self._metadata_cache.set(key, value)
+        return value
+
+    def get_cache_stats(self):
+        """Return a dict of hit/miss/eviction stats for each enabled cache"""
+        stats = {}
+        if self._metadata_cache is not None:
+            stats['metadata'] = self._metadata_cache.stats()
+        if self._result_cache is not None:
+            stats['results'] = self._result_cache.stats()
+        stats['statements'] = self._statement_cache.stats()
+        return stats
+
     def get_tables(self):
         """Return a list of table names (or schema.tablename strings)"""
+        if self._schema is not None:
+            return self._schema.get_tables()
+        return list(self._cached_metadata(('tables',), self._get_tables))
+
+    def _get_tables(self):
         if self._type == 'postgresql':
             return self._get_postgresql_tables()
         elif self._type == 'mysql':
@@ -407,16 +2949,199 @@ class SQL(object):
                 return self._engine.table_names()
             return self._inspector.get_table_names()
 
+    def _table_stats_postgresql(self):
+        stats = {}
+        for row in self._execute(POSTGRESQL_TABLE_STATS_STATEMENT, row_format='dict'):
+            estimate = row['estimate']
+            if estimate is None or estimate < 0:
+                # never analyzed (reltuples is -1 since postgresql 14)
+                estimate = row['live_rows']
+            modified = row['modified_since_analyze']
+            stats[row['schemaname'] + '.' + row['tablename']] = {
+                'rows': int(estimate) if estimate is not None else None,
+                'analyzed': row['analyzed'],
+                'modified_since_analyze': modified,
+                'stale': row['analyzed'] is None or (
+                    modified is not None and modified > STALE_STATS_RATIO * max(estimate or 0, 1)
+                ),
+                'total_bytes': row['total_bytes'],
+                'table_bytes': row['table_bytes'],
+                'index_bytes': row['index_bytes'],
+            }
+        return stats
+
+    def _table_stats_mysql(self):
+        try:
+            # last_update of the persistent InnoDB stats (needs SELECT on mysql.*)
+            rows = self._execute(MYSQL_TABLE_STATS_STATEMENT.format(
+                analyzed=', i.last_update AS analyzed',
+                join=(
+                    ' LEFT JOIN mysql.innodb_table_stats i ON '
+                    'i.database_name = t.table_schema AND i.table_name = t.table_name'
+                )
+            ), row_format='dict')
+        except (OperationalError, ProgrammingError):
+            rows = self._execute(MYSQL_TABLE_STATS_STATEMENT.format(
+                analyzed=', NULL AS analyzed', join=''
+            ), row_format='dict')
+        stats = {}
+        for row in rows:
+            stats[row['tablename']] = {
+                'rows': int(row['estimate']) if row['estimate'] is not None else None,
+                'analyzed': row['analyzed'],
+                'modified_since_analyze': None,
+                'stale': row['analyzed'] is None,
+                'total_bytes': row['total_bytes'],
+                'table_bytes': row['table_bytes'],
+                'index_bytes': row['index_bytes'],
+            }
+        return stats
+
+    def _estimate_rows_sqlite(self, table):
+        """Return max(rowid) of table (or count(*) for WITHOUT ROWID tables)"""
+        try:
+            return self._execute('SELECT max(rowid) FROM "{}"'.format(table)) or 0
+        except OperationalError:
+            return self._execute('SELECT count(*) FROM "{}"'.format(table))
+
+    def _table_stats_sqlite(self):
+        estimates = {}
+        try:
+            # row counts saved by ANALYZE (first number of stat)
+            for row in self._execute('SELECT tbl, stat FROM sqlite_stat1', row_format='dict'):
+                estimates.setdefault(row['tbl'], int(row['stat'].split()[0]))
+        except OperationalError:
+            pass
+        sizes = {}
+        try:
+            statement = (
+                "SELECT m.tbl_name AS name, sum(d.pgsize) AS total_bytes, "
+                "sum(CASE WHEN m.type = 'index' THEN d.pgsize ELSE 0 END) AS index_bytes, "
+                "sum(CASE WHEN m.type = 'table' AND d.pagetype = 'leaf' THEN d.ncell ELSE 0 END) AS leaf_cells "
+                "FROM dbstat d JOIN sqlite_master m ON m.name = d.name GROUP BY m.tbl_name"
+            )
+            for row in self._execute(statement, row_format='dict'):
+                sizes[row['name']] = row
+        except OperationalError:
+            # sqlite was compiled without the dbstat virtual table
+            pass
+        stats = {}
+        for table in self.get_tables():
+            size = sizes.get(table, {})
+            total = size.get('total_bytes')
+            rows = estimates.get(table)
+            if rows is None:
+                # not analyzed; cells in the leaf pages of the table b-tree
+                rows = size.get('leaf_cells')
+            if rows is None:
+                rows = self._estimate_rows_sqlite(table)
+            stats[table] = {
+                'rows': rows,
+                'analyzed': None,
+                'modified_since_analyze': None,
+                'stale': table not in estimates,
+                'total_bytes': total,
+                'table_bytes': total - size['index_bytes'] if total is not None else None,
+                'index_bytes': size.get('index_bytes'),
+            }
+        return stats
+
+    def _table_stats(self, tables=None):
+        """Return dict of table name to dict of catalog stats (row estimate and sizes)
+
+        On postgresql, table names in tables without a schema are looked up in
+        the current schema
+        """
+        if self._type == 'postgresql':
+            stats = self._table_stats_postgresql()
+        elif self._type == 'mysql':
+            stats = self._table_stats_mysql()
+        elif self._type == 'sqlite':
+            stats = self._table_stats_sqlite()
+        else:
+            raise NotImplementedError('Table stats are not supported for {}'.format(self._type))
+        if tables is not None:
+            schema = ''
+            if self._type == 'postgresql':
+                schema = self._execute('SELECT current_schema()') + '.'
+            stats = {
+                table: stats.get(table) or stats.get(schema + table) or {
+                    'rows': None, 'analyzed': None, 'modified_since_analyze': None,
+                    'stale': True, 'total_bytes': None, 'table_bytes': None,
+                    'index_bytes': None,
+                }
+                for table in tables
+            }
+        return stats
+
+    def estimate_counts(self, tables=None, exact=False, max_workers=None):
+        """Return dict of table name to dict with an estimated row count from catalog statistics
+
+        - tables: list of table names (default is all tables)
+        - exact: if True, run count(*) for each table in parallel (see
+          execute_many_parallel) instead of reading statistics
+        - max_workers: max number of counts to run at the same time if exact
+
+        Each dict has rows, estimated (False if exact), analyzed (when
+        statistics were last gathered, if known), modified_since_analyze
+        (postgresql only), and stale (True if there are no statistics or
+        more than 10% of rows changed since they were gathered)
+
+        Estimates come from one catalog query: pg_class.reltuples on
+        postgresql, information_schema.tables on mysql, and sqlite_stat1
+        (written by ANALYZE) on sqlite; sqlite tables that were not analyzed
+        are estimated from dbstat page data (or max(rowid))
+        """
+        if exact:
+            if tables is None:
+                tables = self.get_tables()
+            results = self.execute_many_parallel(
+                ['SELECT count(*) FROM {}'.format(table) for table in tables],
+                max_workers=max_workers, cache=False
+            )['results']
+            counts = {}
+            for table, item in zip(tables, results):
+                if item['error'] is not None:
+                    raise RuntimeError('Unable to count {}: {}'.format(table, item['error']))
+                counts[table] = {
+                    'rows': item['result'], 'estimated': False, 'analyzed': None,
+                    'modified_since_analyze': None, 'stale': False,
+                }
+            return counts
+        return {
+            table: {
+                'rows': info['rows'], 'estimated': True, 'analyzed': info['analyzed'],
+                'modified_since_analyze': info['modified_since_analyze'],
+                'stale': info['stale'],
+            }
+            for table, info in self._table_stats(tables).items()
+        }
+
+    def table_sizes(self, tables=None):
+        """Return dict of table name to dict of sizes (in bytes) from catalog statistics
+
+        - tables: list of table names (default is all tables)
+
+        Each dict has total_bytes, table_bytes, index_bytes, rows (estimate),
+        and stale (see estimate_counts). Sizes come from
+        pg_total_relation_size/pg_relation_size/pg_indexes_size on postgresql,
+        data_length/index_length of information_schema.tables on mysql, and
+        the dbstat virtual table on sqlite (sizes are None if sqlite was
+        compiled without it)
+        """
+        return {
+            table: {
+                'total_bytes': info['total_bytes'], 'table_bytes': info['table_bytes'],
+                'index_bytes': info['index_bytes'], 'rows': info['rows'],
+                'stale': info['stale'],
+            }
+            for table, info in self._table_stats(tables).items()
+        }
+
     def _get_postgresql_indexes(self, table, schema=None):
         if '.' in table and schema is None:
             schema, table = table.split('.', 1)
-        query = (
-            "SELECT * "
-            "FROM pg_indexes "
-            "WHERE tablename = :table "
-            "ORDER BY schemaname, tablename, indexname"
-        )
-        results = self.execute(query, {'table': table})
+        results = self.execute(POSTGRESQL_INDEXES_STATEMENT, {'table': table})
         return results
 
     def _get_mysql_indexes(self, table):
@@ -425,10 +3150,33 @@ class SQL(object):
 
     def get_indexes(self, table, schema=None):
         """Return a list of dicts containing info about indexes for table"""
+        if self._schema is not None and self._schema.has_table(table, schema):
+            return self._schema.get_indexes(table, schema)
+        return _copy_info(self._cached_metadata(
+            ('indexes', table, schema),
+            lambda: self._get_indexes(table, schema)
+        ))
+
+    def _get_indexes(self, table, schema=None):
         if self._type == 'postgresql':
             return self._get_postgresql_indexes(table, schema)
         elif self._type == 'mysql':
             return self._get_mysql_indexes(table)
+        else:
+            if '.' in table and schema is None:
+                schema, table = table.split('.', 1)
+            return self._inspector.get_indexes(table, schema=schema)
+
+    def get_primary_key(self, table, schema=None):
+        """Return a list of the primary key column names for table"""
+        if self._schema is not None and self._schema.has_table(table, schema):
+            return self._schema.get_primary_key(table, schema)
+        if '.' in table and schema is None:
+            schema, table = table.split('.', 1)
+        return list(self._cached_metadata(
+            ('primary_key', table, schema),
+            lambda: self._inspector.get_pk_constraint(table, schema=schema).get('constrained_columns') or []
+        ))
 
     def get_columns(self, table, schema=None, name_only=False, sort=False, **kwargs):
         """Return a list of dicts containing info about columns for table
@@ -438,10 +3186,20 @@ class SQL(object):
         - sort: if True, results will be sorted by name
 
         Additional kwargs are passed to self._inspector.get_columns
+
+        If describe_all was called (and no kwargs are passed), the column info
+        comes from the saved SchemaSnapshot instead of the db
         """
-        if '.' in table and schema is None:
-            schema, table = table.split('.', 1)
-        results = self._inspector.get_columns(table, schema=schema, **kwargs)
+        results = None
+        if self._schema is not None and not kwargs:
+            results = self._schema.get_columns(table, schema)
+        if results is None:
+            if '.' in table and schema is None:
+                schema, table = table.split('.', 1)
+            results = _copy_info(self._cached_metadata(
+                ('columns', table, schema, tuple(sorted(kwargs.items()))),
+                lambda: self._inspector.get_columns(table, schema=schema, **kwargs)
+            ))
         if name_only:
             results = [col['name'] for col in results]
             if sort:
@@ -450,6 +3208,208 @@ class SQL(object):
             results = sorted(results, key=lambda x: x['name'])
         return results
 
+    def _type_from_name(self, type_name, args=()):
+        """Return a sqlalchemy type instance for a type name from a catalog query
+
+        - type_name: name of the type, optionally with args in parentheses
+          (i.e. 'varchar(20)', 'timestamp without time zone', 'int unsigned')
+        - args: length/precision/scale args (if not included in type_name)
+
+        Unknown types are returned as NullType
+        """
+        dialect = self._engine.dialect
+        if self._type == 'sqlite':
+            return dialect._resolve_type_affinity(type_name.upper())
+        name = type_name.lower()
+        match = rx_type_args.match(name)
+        if match:
+            name = (match.group(1) + match.group(3)).strip()
+            args = match.group(2).split(',')
+        args = tuple(int(a) for a in args if a is not None and str(a).strip().isdigit())
+        name = name.replace(' unsigned', '').replace(' zerofill', '').strip()
+        kwargs = {}
+        if name.endswith(' with time zone'):
+            kwargs['timezone'] = True
+        type_class = dialect.ischema_names.get(name)
+        if type_class is None:
+            return sqltypes.NULLTYPE
+        if not issubclass(type_class, (sqltypes.String, sqltypes.Numeric)):
+            args = ()
+        try:
+            return type_class(*args, **kwargs)
+        except Exception:
+            return sqltypes.NULLTYPE
+
+    def _describe_all_postgresql(self, snapshot):
+        columns = self.iter_execute(
+            "SELECT c.table_schema, c.table_name, c.column_name, c.data_type, "
+            "c.character_maximum_length, c.numeric_precision, c.numeric_scale, "
+            "c.is_nullable, c.column_default, c.is_identity "
+            "FROM information_schema.columns c "
+            "JOIN information_schema.tables t "
+            "ON t.table_schema = c.table_schema AND t.table_name = c.table_name "
+            "WHERE t.table_type = 'BASE TABLE' "
+            "AND c.table_schema NOT IN ('pg_catalog', 'information_schema') "
+            "ORDER BY c.table_schema, c.table_name, c.ordinal_position"
+        )
+        for col in columns:
+            info = snapshot.add_table(col['table_schema'] + '.' + col['table_name'])
+            if col['data_type'] == 'numeric':
+                args = (col['numeric_precision'], col['numeric_scale'])
+            else:
+                args = (col['character_maximum_length'],)
+            default = col['column_default']
+            info['columns'].append({
+                'name': col['column_name'],
+                'type': self._type_from_name(col['data_type'], args),
+                'nullable': col['is_nullable'] == 'YES',
+                'default': default,
+                'autoincrement': (
+                    col['is_identity'] == 'YES' or
+                    (default is not None and default.startswith('nextval('))
+                ),
+            })
+        indexes = self.iter_execute(
+            "SELECT * "
+            "FROM pg_indexes "
+            "WHERE schemaname NOT IN ('pg_catalog', 'information_schema') "
+            "ORDER BY schemaname, tablename, indexname"
+        )
+        for index in indexes:
+            table = index['schemaname'] + '.' + index['tablename']
+            if table in snapshot.tables:
+                snapshot.tables[table]['indexes'].append(index)
+        primary_keys = self.iter_execute(
+            "SELECT tc.table_schema, tc.table_name, kcu.column_name "
+            "FROM information_schema.table_constraints tc "
+            "JOIN information_schema.key_column_usage kcu "
+            "ON kcu.constraint_name = tc.constraint_name "
+            "AND kcu.table_schema = tc.table_schema AND kcu.table_name = tc.table_name "
+            "WHERE tc.constraint_type = 'PRIMARY KEY' "
+            "ORDER BY tc.table_schema, tc.table_name, kcu.ordinal_position"
+        )
+        for pk in primary_keys:
+            table = pk['table_schema'] + '.' + pk['table_name']
+            if table in snapshot.tables:
+                snapshot.tables[table]['primary_key'].append(pk['column_name'])
+
+    def _describe_all_mysql(self, snapshot):
+        columns = self.iter_execute(
+            "SELECT c.table_name AS table_name, c.column_name AS column_name, "
+            "c.column_type AS column_type, c.is_nullable AS is_nullable, "
+            "c.column_default AS column_default, c.extra AS extra "
+            "FROM information_schema.columns c "
+            "JOIN information_schema.tables t "
+            "ON t.table_schema = c.table_schema AND t.table_name = c.table_name "
+            "WHERE c.table_schema = DATABASE() AND t.table_type = 'BASE TABLE' "
+            "ORDER BY c.table_name, c.ordinal_position"
+        )
+        for col in columns:
+            info = snapshot.add_table(col['table_name'])
+            info['columns'].append({
+                'name': col['column_name'],
+                'type': self._type_from_name(col['column_type']),
+                'nullable': col['is_nullable'] == 'YES',
+                'default': col['column_default'],
+                'autoincrement': 'auto_increment' in (col['extra'] or '').lower(),
+            })
+        indexes = self.iter_execute(
+            "SELECT table_name AS `Table`, non_unique AS Non_unique, "
+            "index_name AS Key_name, seq_in_index AS Seq_in_index, "
+            "column_name AS Column_name, collation AS `Collation`, "
+            "cardinality AS Cardinality, sub_part AS Sub_part, packed AS Packed, "
+            "nullable AS `Null`, index_type AS Index_type, comment AS `Comment`, "
+            "index_comment AS Index_comment "
+            "FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() "
+            "ORDER BY table_name, index_name, seq_in_index"
+        )
+        for index in indexes:
+            info = snapshot.tables.get(index['Table'])
+            if info is not None:
+                info['indexes'].append(index)
+                if index['Key_name'] == 'PRIMARY':
+                    info['primary_key'].append(index['Column_name'])
+
+    def _describe_all_sqlite(self, snapshot):
+        columns = self.iter_execute(
+            "SELECT m.name AS table_name, p.name, p.type, p.\"notnull\", p.dflt_value, p.pk "
+            "FROM sqlite_master m JOIN pragma_table_info(m.name) p "
+            "WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' "
+            "ORDER BY m.name, p.cid"
+        )
+        primary_keys = {}
+        for col in columns:
+            info = snapshot.add_table(col['table_name'])
+            info['columns'].append({
+                'name': col['name'],
+                'type': self._type_from_name(col['type']),
+                'nullable': not col['notnull'],
+                'default': col['dflt_value'],
+                'primary_key': col['pk'],
+            })
+            if col['pk']:
+                primary_keys.setdefault(col['table_name'], []).append((col['pk'], col['name']))
+        for table, pk in primary_keys.items():
+            snapshot.tables[table]['primary_key'] = [name for _, name in sorted(pk)]
+        indexes = self.iter_execute(
+            "SELECT m.name AS table_name, il.name AS index_name, il.\"unique\", "
+            "il.origin, ii.name AS column_name "
+            "FROM sqlite_master m JOIN pragma_index_list(m.name) il "
+            "JOIN pragma_index_info(il.name) ii "
+            "WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' "
+            "ORDER BY m.name, il.name, ii.seqno"
+        )
+        by_name = OrderedDict()
+        for index in indexes:
+            if index['origin'] == 'pk':
+                continue
+            key = (index['table_name'], index['index_name'])
+            if key not in by_name:
+                by_name[key] = {
+                    'name': index['index_name'],
+                    'column_names': [],
+                    'unique': index['unique'],
+                }
+            by_name[key]['column_names'].append(index['column_name'])
+        for (table, _), index in by_name.items():
+            if table in snapshot.tables:
+                snapshot.tables[table]['indexes'].append(index)
+
+    def describe_all(self, save=True):
+        """Return a SchemaSnapshot with columns, indexes, and primary keys of every table
+
+        - save: if True, keep the snapshot on this instance so get_tables,
+          get_indexes, get_columns, and the get_*_columns methods answer from it
+          without going back to the db (until refresh_metadata_cache is called
+          or a create/alter/drop/rename statement is executed)
+
+        Only a handful of catalog queries are run (information_schema/pg_catalog
+        on postgresql and mysql, pragma table-valued functions on sqlite)
+        instead of one reflection round trip per table
+        """
+        default_schema = None
+        if self._type == 'postgresql':
+            default_schema = self._inspector.default_schema_name
+        snapshot = SchemaSnapshot(self._type, default_schema=default_schema)
+        if self._type == 'postgresql':
+            self._describe_all_postgresql(snapshot)
+        elif self._type == 'mysql':
+            self._describe_all_mysql(snapshot)
+        elif self._type == 'sqlite':
+            self._describe_all_sqlite(snapshot)
+        else:
+            for table in self._get_tables():
+                info = snapshot.add_table(table)
+                info['columns'] = self._inspector.get_columns(table)
+                info['indexes'] = self._inspector.get_indexes(table)
+                info['primary_key'] = self._inspector.get_pk_constraint(table).get(
+                    'constrained_columns', []
+                )
+        if save:
+            self._schema = snapshot
+        return snapshot
+
     def get_timestamp_columns(self, table, schema=None, name_only=False,
                               sort=False, **kwargs):
         """Return a list of columns that are DATE, DATETIME, TIME, or TIMESTAMP
@@ -460,25 +3420,10 @@ class SQL(object):
 
         Additional kwargs are passed to self.get_columns
         """
-        columns = self.get_columns(table, schema=schema, **kwargs)
-        results = []
-        getter = lambda x: x
-        sortkey = lambda x: x['name']
-        if name_only:
-            getter = lambda x: x['name']
-            sortkey = lambda x: x
-        for column in columns:
-            if (
-                isinstance(column['type'], sqltypes.DATE) or
-                isinstance(column['type'], sqltypes.DATETIME) or
-                isinstance(column['type'], sqltypes.TIME) or
-                isinstance(column['type'], sqltypes.TIMESTAMP)
-            ):
-                results.append(getter(column))
-
-        if sort:
-            results = sorted(results, key=sortkey)
-        return results
+        return _filter_columns(
+            self.get_columns(table, schema=schema, **kwargs),
+            _is_timestamp_column, name_only=name_only, sort=sort
+        )
 
     def get_autoincrement_columns(self, table, schema=None, name_only=False,
                                   sort=False, **kwargs):
@@ -490,20 +3435,10 @@ class SQL(object):
 
         Additional kwargs are passed to self.get_columns
         """
-        columns = self.get_columns(table, schema=schema, **kwargs)
-        results = []
-        getter = lambda x: x
-        sortkey = lambda x: x['name']
-        if name_only:
-            getter = lambda x: x['name']
-            sortkey = lambda x: x
-        for column in columns:
-            if column.get('autoincrement') is True:
-                results.append(getter(column))
-
-        if sort:
-            results = sorted(results, key=sortkey)
-        return results
+        return _filter_columns(
+            self.get_columns(table, schema=schema, **kwargs),
+            _is_autoincrement_column, name_only=name_only, sort=sort
+        )
 
     def get_required_columns(self, table, schema=None, name_only=False,
                              sort=False, **kwargs):
@@ -515,20 +3450,10 @@ class SQL(object):
 
         Additional kwargs are passed to self.get_columns
         """
-        columns = self.get_columns(table, schema=schema, **kwargs)
-        results = []
-        getter = lambda x: x
-        sortkey = lambda x: x['name']
-        if name_only:
-            getter = lambda x: x['name']
-            sortkey = lambda x: x
-        for column in columns:
-            if column['nullable'] is False and column['default'] is None:
-                results.append(getter(column))
-
-        if sort:
-            results = sorted(results, key=sortkey)
-        return results
+        return _filter_columns(
+            self.get_columns(table, schema=schema, **kwargs),
+            _is_required_column, name_only=name_only, sort=sort
+        )
 
     def get_non_nullable_columns(self, table, schema=None, name_only=False,
                                  sort=False, **kwargs):
@@ -540,34 +3465,1122 @@ class SQL(object):
 
         Additional kwargs are passed to self.get_columns
         """
-        columns = self.get_columns(table, schema=schema, **kwargs)
-        results = []
-        getter = lambda x: x
-        sortkey = lambda x: x['name']
-        if name_only:
-            getter = lambda x: x['name']
-            sortkey = lambda x: x
-        for column in columns:
-            if column['nullable'] is False:
-                results.append(getter(column))
-
-        if sort:
-            results = sorted(results, key=sortkey)
-        return results
+        return _filter_columns(
+            self.get_columns(table, schema=schema, **kwargs),
+            _is_non_nullable_column, name_only=name_only, sort=sort
+        )
 
     def insert(self, table, data):
         """Insert data to table and return generated statement
 
         - data: dict or list of dicts
+
+        All rows are sent in a single transaction. For large amounts of data
+        (or generators of dicts), use bulk_insert instead
         """
         try:
             keys = data.keys()
         except AttributeError:
             keys = data[0].keys()
 
-        statement_start = 'insert into {} ('.format(table)
-        statement_cols = ', '.join(keys) + ') values ('
-        statement_vals = ', '.join([':{}'.format(k) for k in keys]) + ')'
-        statement = statement_start + statement_cols + statement_vals
-        self._execute_raw(statement, data)
+        cache_key = ('insert', table, tuple(keys))
+        statement = self._statement_cache.get(cache_key)
+        if statement is None:
+            statement_start = 'insert into {} ('.format(table)
+            statement_cols = ', '.join(keys) + ') values ('
+            statement_vals = ', '.join([':{}'.format(k) for k in keys]) + ')'
+            statement = statement_start + statement_cols + statement_vals
+            self._statement_cache.set(cache_key, statement)
+        self._execute_raw(statement, data, script=False)
         return statement
+
+    def bulk_insert(self, table, data, chunk_size=5000, show=False):
+        """Insert data to table in chunks (commit per chunk) and return dict of stats
+
+        - data: dict, list of dicts, or any iterable/generator of dicts
+        - chunk_size: number of rows to send (and commit) at a time
+        - show: if True, print the running row count and rows per second after
+          each chunk
+
+        Column names are taken from the keys of the first row (rows missing a
+        key get NULL for it). The fastest path for the driver is used:
+        psycopg2.extras.execute_values (multi-row VALUES) on postgresql, a
+        batched executemany on pymysql (rewritten into multi-row VALUES), and
+        executemany inside one transaction per chunk on sqlite and others
+        """
+        if isinstance(data, dict):
+            data = [data]
+        stats = {
+            'table': table, 'statement': '', 'rows': 0, 'chunks': 0,
+            'seconds': 0.0, 'rows_per_second': 0.0,
+        }
+        chunks = _chunks(data, chunk_size)
+        try:
+            first_chunk = next(chunks)
+        except StopIteration:
+            return stats
+
+        keys = list(first_chunk[0].keys())
+        statement_start = 'insert into {} ({}) values '.format(table, ', '.join(keys))
+        driver = self._engine.dialect.driver
+        if driver == 'psycopg2':
+            from psycopg2.extras import execute_values
+            statement = statement_start + '%s'
+
+            def write(conn, rows):
+                cursor = conn.cursor()
+                execute_values(
+                    cursor, statement,
+                    [tuple(row.get(k) for k in keys) for row in rows],
+                    page_size=len(rows)
+                )
+                cursor.close()
+        elif driver == 'pymysql':
+            statement = statement_start + '(' + ', '.join(['%s'] * len(keys)) + ')'
+
+            def write(conn, rows):
+                cursor = conn.cursor()
+                cursor.executemany(
+                    statement,
+                    [tuple(row.get(k) for k in keys) for row in rows]
+                )
+                cursor.close()
+        else:
+            statement = statement_start + '(' + ', '.join([':{}'.format(k) for k in keys]) + ')'
+            write = None
+
+        stats['statement'] = statement
+        start = time.time()
+        try:
+            for rows in chain([first_chunk], chunks):
+                if write is None:
+                    with self._begin() as conn:
+                        conn.execute(
+                            text(statement),
+                            [{k: row.get(k) for k in keys} for row in rows]
+                        )
+                else:
+                    with self._raw_connection() as raw_conn:
+                        write(raw_conn, rows)
+                stats['rows'] += len(rows)
+                stats['chunks'] += 1
+                stats['seconds'] = time.time() - start
+                if stats['seconds'] > 0:
+                    stats['rows_per_second'] = stats['rows'] / stats['seconds']
+                if show:
+                    print('{}: inserted {} rows ({:.0f} rows/sec)'.format(
+                        table, stats['rows'], stats['rows_per_second']
+                    ))
+        finally:
+            self._invalidate_results(table=table)
+        return stats
+
+    def _load_postgresql(self, table, columns, rows, fp=None, delimiter=',',
+                         chunk_size=10000, show=False):
+        """Stream rows (or an open csv file) through COPY ... FROM STDIN and return row count"""
+        statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, DELIMITER '{}')".format(
+            table, ', '.join(columns), delimiter
+        )
+        num_rows = 0
+        with self._raw_connection() as raw_conn:
+            cursor = raw_conn.cursor()
+            if fp is not None:
+                cursor.copy_expert(statement, fp)
+                num_rows = cursor.rowcount
+            else:
+                for chunk in _chunks(rows, chunk_size):
+                    buf = io.StringIO()
+                    for row in chunk:
+                        buf.write(_csv_line(
+                            [row.get(c) for c in columns], delimiter, hex_prefix='\\x'
+                        ))
+                    buf.seek(0)
+                    cursor.copy_expert(statement, buf)
+                    num_rows += len(chunk)
+                    if show:
+                        print('{}: copied {} rows'.format(table, num_rows))
+            cursor.close()
+        return num_rows
+
+    def _load_mysql(self, table, columns, rows, path=None, delimiter=',',
+                    header=True, chunk_size=10000, show=False):
+        """Send a csv file (or chunks of rows) through LOAD DATA LOCAL INFILE and return row count"""
+        import tempfile
+        import pymysql
+        statement = (
+            "LOAD DATA LOCAL INFILE %s INTO TABLE {} CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY %s OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+            "LINES TERMINATED BY '\\n' {}({}) SET {}"
+        )
+        variables = ', '.join(['@c{}'.format(i) for i in range(len(columns))])
+        if path is not None:
+            # LOAD DATA gives @c the same '' for a quoted "" and an empty field
+            assignments = ', '.join([
+                "{} = NULLIF(@c{}, '')".format(column, i)
+                for i, column in enumerate(columns)
+            ])
+        else:
+            binary = set([
+                column['name'] for column in self.get_columns(table)
+                if isinstance(column['type'], sqltypes._Binary)
+            ])
+            assignments = ', '.join([
+                ('{0} = UNHEX(@c{1})' if column in binary else '{0} = @c{1}').format(column, i)
+                for i, column in enumerate(columns)
+            ])
+        cargs, cparams = self._engine.dialect.create_connect_args(self._engine.url)
+        cparams.update(self._connect_args)
+        cparams['local_infile'] = True
+        raw_conn = pymysql.connect(*cargs, **cparams)
+        num_rows = 0
+        try:
+            cursor = raw_conn.cursor()
+            if path is not None:
+                cursor.execute(
+                    statement.format(table, 'IGNORE 1 LINES ' if header else '', variables, assignments),
+                    (path, delimiter)
+                )
+                num_rows = cursor.rowcount
+            else:
+                for chunk in _chunks(rows, chunk_size):
+                    with tempfile.NamedTemporaryFile(
+                        'w', suffix='.csv', delete=False, newline='', encoding='utf-8'
+                    ) as tmp:
+                        for row in chunk:
+                            tmp.write(_csv_line(
+                                [row.get(c) for c in columns], delimiter, null='NULL'
+                            ))
+                    try:
+                        cursor.execute(
+                            statement.format(table, '', variables, assignments),
+                            (tmp.name, delimiter)
+                        )
+                    finally:
+                        os.remove(tmp.name)
+                    num_rows += len(chunk)
+                    if show:
+                        print('{}: loaded {} rows'.format(table, num_rows))
+            cursor.close()
+            raw_conn.commit()
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+        return num_rows
+
+    def load(self, table, source, format=None, columns=None, chunk_size=10000,
+             delimiter=',', header=True, show=False):
+        """Bulk load data into table with the native path for the db and return dict of stats
+
+        - table: name of table to load into
+        - source: path to a file, an open file object, or an iterable of dicts
+        - format: 'csv', 'jsonl', or 'rows' (inferred from the file extension
+          or the type of source if not specified)
+        - columns: list of column names in the order they appear in the source
+          (default for csv is the header, or the table columns from get_columns
+          if there is no header; default for jsonl/rows is keys of first dict)
+        - chunk_size: number of rows to buffer per COPY, LOAD DATA, or
+          executemany call
+        - delimiter: field delimiter for csv
+        - header: if True, the first line of a csv source is a header row
+        - show: if True, print progress after each chunk
+
+        On postgresql (psycopg2), data is streamed through COPY ... FROM STDIN;
+        on mysql (pymysql), through LOAD DATA LOCAL INFILE (the server must
+        allow local_infile); for other dbs, through chunked executemany with
+        bulk_insert. Empty csv fields are loaded as NULL; on postgresql that is
+        only unquoted ones (COPY loads a quoted "" as an empty string), while
+        LOAD DATA and the csv reader can't tell them apart, so a quoted "" is
+        NULL too. Empty strings in jsonl and rows sources stay empty strings
+
+        A ValueError is raised if any of the columns are not in the table
+        """
+        import csv
+        if format is None:
+            format = _infer_format(source)
+        if format not in ('csv', 'jsonl', 'rows'):
+            raise ValueError('format must be one of csv, jsonl, rows... not {}'.format(format))
+
+        table_columns = self.get_columns(table, name_only=True)
+        stats = {
+            'table': table, 'format': format, 'method': '', 'rows': 0,
+            'seconds': 0.0, 'rows_per_second': 0.0,
+        }
+        start = time.time()
+        fp = None
+        opened = False
+        if format != 'rows':
+            if isinstance(source, str):
+                fp = open(source, 'r', newline='' if format == 'csv' else None, encoding='utf-8')
+                opened = True
+            else:
+                fp = source
+
+        try:
+            rows = None
+            if format == 'csv':
+                if header:
+                    file_columns = next(csv.reader([fp.readline()], delimiter=delimiter), [])
+                    columns = columns or file_columns
+                elif not columns:
+                    columns = table_columns
+                rows = (
+                    {k: (v if v != '' else None) for k, v in row.items()}
+                    for row in csv.DictReader(fp, fieldnames=columns, delimiter=delimiter)
+                )
+            else:
+                if format == 'jsonl':
+                    rows = (json.loads(line) for line in fp if line.strip())
+                else:
+                    rows = iter(source)
+                first = next(rows, None)
+                if first is None:
+                    return stats
+                columns = columns or list(first.keys())
+                rows = chain([first], rows)
+
+            unknown = [c for c in columns if c not in table_columns]
+            if unknown:
+                raise ValueError('Columns not in {}: {}'.format(table, unknown))
+
+            driver = self._engine.dialect.driver
+            if driver == 'psycopg2':
+                stats['method'] = 'copy'
+                stats['rows'] = self._load_postgresql(
+                    table, columns, rows, fp=fp if format == 'csv' else None,
+                    delimiter=delimiter, chunk_size=chunk_size, show=show
+                )
+            elif driver == 'pymysql':
+                stats['method'] = 'load data'
+                path = None
+                if format == 'csv' and opened:
+                    path = source
+                stats['rows'] = self._load_mysql(
+                    table, columns, rows, path=path, delimiter=delimiter,
+                    header=header, chunk_size=chunk_size, show=show
+                )
+            else:
+                stats['method'] = 'executemany'
+                stats['rows'] = self.bulk_insert(
+                    table,
+                    ({c: row.get(c) for c in columns} for row in rows),
+                    chunk_size=chunk_size,
+                    show=show
+                )['rows']
+        finally:
+            self._invalidate_results(table=table)
+            if opened:
+                fp.close()
+
+        stats['seconds'] = time.time() - start
+        if stats['seconds'] > 0:
+            stats['rows_per_second'] = stats['rows'] / stats['seconds']
+        if show:
+            print('{}: loaded {} rows in {:.2f} seconds ({:.0f} rows/sec)'.format(
+                table, stats['rows'], stats['seconds'], stats['rows_per_second']
+            ))
+        return stats
+
+    def _table_object(self, table, columns, primary_key=(), dialect=None):
+        """Return a sqlalchemy Table for table with columns (dicts from get_columns)
+
+        - primary_key: list of primary key column names
+        - dialect: if given, types are converted to ones dialect can create
+        """
+        schema = None
+        if '.' in table:
+            schema, table = table.split('.', 1)
+        return Table(
+            table, MetaData(),
+            *[
+                Column(
+                    column['name'],
+                    _portable_type(column['type'], dialect) if dialect else column['type'],
+                    nullable=column.get('nullable', True),
+                    primary_key=column['name'] in primary_key,
+                    autoincrement=False
+                )
+                for column in columns
+            ],
+            schema=schema
+        )
+
+    def copy_table_to(self, dest_sql, table, dest_table=None, create=True,
+                      batch_size=10000, queue_size=4, where='', params={}, show=False):
+        """Stream rows of table to a table on another db (dest_sql) and return dict of stats
+
+        - dest_sql: SQL instance for the destination db
+        - table: name of source table
+        - dest_table: name of destination table (default is table, without
+          its schema)
+        - create: if True, create dest_table (if it doesn't exist) from the
+          reflected source columns and primary key; types are converted to
+          their generic equivalent (or TEXT if dest db can't create them)
+        - batch_size: number of rows to fetch and write at a time
+        - queue_size: max number of batches buffered between reader and writer
+        - where: extra condition source rows must match (i.e. "status = :status")
+        - params: dict containing any :param names in where
+        - show: if True, print progress after each batch
+
+        Rows are read with a server-side cursor on a background thread and
+        passed through a bounded queue to the writer (calling thread), so
+        reading and writing overlap and memory stays at about queue_size
+        batches. If the source engine keeps one connection per thread or
+        process (i.e. in-memory sqlite), batches are read on the calling
+        thread between writes instead. The writer uses COPY on postgresql (psycopg2), multi-row
+        inserts on mysql (see bulk_insert), and an executemany per batch with
+        typed binds on other dbs
+
+        The returned dict has table, dest_table, created, method, rows,
+        batches, seconds, rows_per_second, read_wait (seconds the reader
+        waited on a full queue, i.e. writing is the bottleneck), and
+        write_wait (seconds the writer waited on an empty queue, i.e. reading
+        is the bottleneck)
+        """
+        if dest_table is None:
+            dest_table = table.split('.')[-1]
+        columns = self.get_columns(table)
+        primary_key = self.get_primary_key(table)
+        source = self._table_object(table, columns)
+        target = dest_sql._table_object(
+            dest_table, columns, primary_key, dialect=dest_sql._engine.dialect
+        )
+        stats = {
+            'table': table, 'dest_table': dest_table, 'created': False, 'method': '',
+            'rows': 0, 'batches': 0, 'seconds': 0.0, 'rows_per_second': 0.0,
+            'read_wait': 0.0, 'write_wait': 0.0,
+        }
+        if create:
+            with dest_sql._engine.connect() as conn:
+                exists = dest_sql._engine.dialect.has_table(conn, target.name, schema=target.schema)
+            if not exists:
+                target.create(dest_sql._engine)
+                dest_sql.refresh_metadata_cache()
+                stats['created'] = True
+
+        statement = source.select()
+        if where:
+            statement = statement.where(text(where))
+        batches = Queue(maxsize=queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            wait_start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    break
+                except Full:
+                    continue
+            stats['read_wait'] += time.perf_counter() - wait_start
+
+        def read():
+            try:
+                for rows in rows_from_source():
+                    put(rows)
+                    if stop.is_set():
+                        return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        def rows_from_source():
+            for names, rows in self._stream(statement, params, batch_size):
+                yield [dict(zip(names, row)) for row in rows]
+
+        def rows_from_queue():
+            if not threaded:
+                for rows in rows_from_source():
+                    yield rows
+                return
+            while True:
+                wait_start = time.perf_counter()
+                item = batches.get()
+                stats['write_wait'] += time.perf_counter() - wait_start
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        def progress(rows):
+            stats['rows'] += len(rows)
+            stats['batches'] += 1
+            stats['seconds'] = time.time() - start
+            if stats['seconds'] > 0:
+                stats['rows_per_second'] = stats['rows'] / stats['seconds']
+            if show:
+                print('{} -> {}: copied {} rows ({:.0f} rows/sec)'.format(
+                    table, dest_table, stats['rows'], stats['rows_per_second']
+                ))
+
+        driver = dest_sql._engine.dialect.driver
+        start = time.time()
+        # a reader thread would get its own (empty) in-memory sqlite database
+        threaded = not isinstance(self._engine.pool, (SingletonThreadPool, StaticPool))
+        reader = threading.Thread(target=read, name='sql-helper-copy-reader', daemon=True)
+        if threaded:
+            reader.start()
+        try:
+            names = [column['name'] for column in columns]
+            if driver == 'psycopg2':
+                stats['method'] = 'copy'
+
+                def counted_rows():
+                    for rows in rows_from_queue():
+                        for row in rows:
+                            yield row
+                        progress(rows)
+
+                dest_sql._load_postgresql(dest_table, names, counted_rows(), chunk_size=batch_size)
+            elif driver == 'pymysql':
+                stats['method'] = 'bulk_insert'
+                for rows in rows_from_queue():
+                    dest_sql.bulk_insert(dest_table, rows, chunk_size=batch_size)
+                    progress(rows)
+            else:
+                stats['method'] = 'executemany'
+                insert = target.insert()
+                for rows in rows_from_queue():
+                    with dest_sql._begin() as conn:
+                        conn.execute(insert, rows)
+                    progress(rows)
+        finally:
+            stop.set()
+            if threaded:
+                reader.join()
+            dest_sql._invalidate_results(table=dest_table)
+
+        stats['seconds'] = time.time() - start
+        if stats['seconds'] > 0:
+            stats['rows_per_second'] = stats['rows'] / stats['seconds']
+        return stats
+
+    def _checksum_key(self, table, key=None):
+        """Return (key, is_integer) for table checksums"""
+        if key is None:
+            key = self.get_primary_key(table) or self.get_autoincrement_columns(table, name_only=True)
+            if len(key) != 1:
+                raise ValueError(
+                    'Table {} does not have a single column primary key, so key must be specified'.format(table)
+                )
+            key = key[0]
+        types = {column['name']: column['type'] for column in self.get_columns(table)}
+        if key not in types:
+            raise ValueError('Column {} is not in {}'.format(key, table))
+        return key, isinstance(types[key], sqltypes.Integer)
+
+    def _checksum_boundaries(self, table, key, chunk_size):
+        """Return list of every chunk_size-th key value of table
+
+        The values are picked in the db with row_number(), so only the
+        boundaries are sent back. Dbs without window functions (sqlite < 3.25,
+        mysql < 8) step through the key with one LIMIT 1 OFFSET query per
+        boundary instead
+        """
+        size = int(chunk_size)
+        try:
+            rows = self._execute(
+                'SELECT {0} FROM (SELECT {0}, row_number() OVER (ORDER BY {0}) AS rn '
+                'FROM {1} WHERE {0} IS NOT NULL) numbered '
+                'WHERE rn > 1 AND (rn - 1) % {2} = 0 ORDER BY {0}'.format(key, table, size),
+                row_format='tuple'
+            )
+            return [row[0] for row in rows[1:]]
+        except (OperationalError, ProgrammingError):
+            pass
+        boundaries = []
+        statement = 'SELECT {0} FROM {1} WHERE {0} IS NOT NULL{2} ORDER BY {0} LIMIT 1 OFFSET {3}'
+        while True:
+            if boundaries:
+                rows = self._execute(
+                    statement.format(key, table, ' AND {} >= :_after'.format(key), size),
+                    {'_after': boundaries[-1]}, row_format='tuple'
+                )
+            else:
+                rows = self._execute(statement.format(key, table, '', size), row_format='tuple')
+            if len(rows) < 2:
+                return boundaries
+            boundaries.append(rows[1][0])
+
+    def _row_hash_expression(self, table, key):
+        """Return sql for the hash aggregate of the rows in a group"""
+        if self._type == 'postgresql':
+            return "md5(string_agg(md5(t::text), '' ORDER BY t.{}))".format(key)
+        columns = self.get_columns(table, name_only=True)
+        if self._type == 'mysql':
+            return "BIT_XOR(CRC32(CONCAT_WS('#', {}, CONCAT({}))))".format(
+                ', '.join(columns), ', '.join('ISNULL({})'.format(c) for c in columns)
+            )
+        return 'sqh_bit_xor(sqh_row_hash({}))'.format(', '.join(columns))
+
+    def table_checksums(self, table, key=None, chunk_size=1000, boundaries=None):
+        """Return list of dicts with the row count and checksum of each key range of table
+
+        - table: name of table
+        - key: name of the column that uniquely identifies a row (default is the
+          single column primary key or autoincrement column)
+        - chunk_size: number of key values per chunk (integer keys) or number of
+          rows per chunk (other keys)
+        - boundaries: list of key values where chunks start (default for
+          non-integer keys is every chunk_size-th key value)
+
+        Everything is computed in the db with one GROUP BY query: md5 of the
+        string_agg of row md5s on postgresql, BIT_XOR(CRC32(...)) of the row
+        values on mysql, and a xor of crc32s with registered functions on
+        sqlite. Integer keys are chunked by value (key range
+        [chunk * chunk_size, (chunk + 1) * chunk_size)), so the same chunks
+        line up on another db even if rows are missing or extra
+
+        Each dict has chunk, min_key, max_key, rows, and checksum. Checksums
+        are only comparable between dbs of the same type
+        """
+        key, is_integer = self._checksum_key(table, key)
+        params = {}
+        if is_integer and boundaries is None:
+            size = int(chunk_size)
+            div = 'DIV' if self._type == 'mysql' else '/'
+            chunk = '(t.{0} - ((t.{0} % {1}) + {1}) % {1}) {2} {1}'.format(key, size, div)
+        else:
+            if boundaries is None:
+                boundaries = self._checksum_boundaries(table, key, chunk_size)
+            if not boundaries:
+                chunk = '0'
+            else:
+                cases = []
+                for i, value in enumerate(boundaries):
+                    params['_b{}'.format(i)] = value
+                    cases.append('WHEN t.{} < :_b{} THEN {}'.format(key, i, i))
+                chunk = 'CASE {} ELSE {} END'.format(' '.join(cases), len(boundaries))
+        statement = (
+            'SELECT {chunk} AS chunk, count(*) AS num_rows, min(t.{key}) AS min_key, '
+            'max(t.{key}) AS max_key, {hash} AS checksum FROM {table} t '
+            'WHERE t.{key} IS NOT NULL GROUP BY 1 ORDER BY 1'
+        ).format(chunk=chunk, key=key, hash=self._row_hash_expression(table, key), table=table)
+        return [
+            {
+                'chunk': int(row['chunk']), 'min_key': row['min_key'], 'max_key': row['max_key'],
+                'rows': row['num_rows'], 'checksum': str(row['checksum']),
+            }
+            for row in self._execute(statement, params, row_format='dict')
+        ]
+
+    def _chunk_rows(self, table, key, chunk, chunk_size=None, boundaries=None):
+        """Return dict of key value to row (dict) for the rows of table in a checksum chunk"""
+        source = self._table_object(table, self.get_columns(table))
+        statement = source.select()
+        column = source.c[key]
+        if boundaries is None:
+            statement = statement.where(column >= chunk * chunk_size).where(column < (chunk + 1) * chunk_size)
+        else:
+            if chunk > 0:
+                statement = statement.where(column >= boundaries[chunk - 1])
+            if chunk < len(boundaries):
+                statement = statement.where(column < boundaries[chunk])
+        rows = {}
+        for names, batch in self._stream(statement, batch_size=10000):
+            for row in batch:
+                row = dict(zip(names, row))
+                rows[row[key]] = row
+        return rows
+
+    def diff_tables(self, other_sql, table, other_table=None, key=None, chunk_size=1000):
+        """Compare table to a table on another db (or the same db) and return dict of differences
+
+        - other_sql: SQL instance for the other db
+        - table: name of table
+        - other_table: name of table on other db (default is table)
+        - key: name of the column that uniquely identifies a row (default is the
+          single column primary key or autoincrement column)
+        - chunk_size: see table_checksums
+
+        Chunk checksums are computed in each db (see table_checksums) and only
+        the rows of chunks whose count or checksum differ are fetched and
+        compared. If the dbs are different types, checksums aren't comparable,
+        so every chunk is fetched
+
+        The returned dict has chunks (number compared), differing_chunks,
+        rows_fetched, missing (rows only in table), extra (rows only in
+        other_table), and changed (list of (row, other_row) tuples)
+        """
+        other_table = other_table or table
+        key, is_integer = self._checksum_key(table, key)
+        boundaries = None
+        if not is_integer:
+            boundaries = self._checksum_boundaries(table, key, chunk_size)
+        mine = {c['chunk']: c for c in self.table_checksums(table, key, chunk_size, boundaries)}
+        theirs = {
+            c['chunk']: c
+            for c in other_sql.table_checksums(other_table, key, chunk_size, boundaries)
+        }
+        comparable = self._type == other_sql._type
+        result = {
+            'chunks': len(set(mine) | set(theirs)), 'differing_chunks': [],
+            'rows_fetched': 0, 'missing': [], 'extra': [], 'changed': [],
+        }
+        for chunk in sorted(set(mine) | set(theirs)):
+            a, b = mine.get(chunk), theirs.get(chunk)
+            if comparable and a and b and (a['rows'], a['checksum']) == (b['rows'], b['checksum']):
+                continue
+            rows = self._chunk_rows(table, key, chunk, chunk_size, boundaries)
+            other_rows = other_sql._chunk_rows(other_table, key, chunk, chunk_size, boundaries)
+            result['rows_fetched'] += len(rows) + len(other_rows)
+            differs = False
+            for value, row in rows.items():
+                other_row = other_rows.get(value)
+                if other_row is None:
+                    result['missing'].append(row)
+                    differs = True
+                elif row != other_row:
+                    result['changed'].append((row, other_row))
+                    differs = True
+            for value, other_row in other_rows.items():
+                if value not in rows:
+                    result['extra'].append(other_row)
+                    differs = True
+            if differs:
+                result['differing_chunks'].append(chunk)
+        return result
+
+    def _sample_tablesample(self, table, select, n, fraction, method, rng, seed):
+        """Return rows sampled with TABLESAMPLE (postgresql)"""
+        if fraction is not None:
+            percent = fraction * 100
+        else:
+            estimate = self.estimate_counts([table])[table]['rows']
+            # oversample, since SYSTEM samples whole pages and both methods vary
+            percent = 100.0 * n * 1.5 / estimate if estimate else 100
+        statement = 'SELECT {} FROM {} TABLESAMPLE {} (:_percent)'.format(select, table, method.upper())
+        params = {'_percent': min(max(percent, 0), 100)}
+        if seed is not None:
+            statement += ' REPEATABLE (:_seed)'
+            params['_seed'] = seed
+        rows = self._execute(statement, params, row_format='dict')
+        if n is not None and len(rows) > n:
+            rows = rng.sample(rows, n)
+        return rows
+
+    def _sample_keyset(self, table, select, key, n, fraction, rng, probes_per_statement=100):
+        """Return rows sampled by probing random values of an integer key"""
+        bounds = self._execute(
+            'SELECT min({0}) AS low, max({0}) AS high FROM {1}'.format(key, table),
+            row_format='dict'
+        )[0]
+        low, high = bounds['low'], bounds['high']
+        if low is None:
+            return []
+        if n is None:
+            estimate = self.estimate_counts([table])[table]['rows']
+            n = int(round(fraction * (estimate or (high - low + 1))))
+        rows = {}
+        attempts = 0
+        while len(rows) < n and attempts < n * 10:
+            count = min(probes_per_statement, n - len(rows))
+            attempts += count
+            params = {}
+            parts = []
+            for i in range(count):
+                params['_p{}'.format(i)] = rng.randint(low, high)
+                parts.append(
+                    'SELECT * FROM (SELECT {0} FROM {1} WHERE {2} >= :_p{3} ORDER BY {2} LIMIT 1) s{3}'.format(
+                        select, table, key, i
+                    )
+                )
+            for row in self._execute(' UNION ALL '.join(parts), params, row_format='dict'):
+                rows.setdefault(row[key], row)
+            if attempts >= n * 2 and len(rows) < n / 2:
+                # sparse key or small table: probes keep landing on the same rows
+                break
+        if len(rows) < n and attempts >= n * 2:
+            all_rows = self._execute(
+                'SELECT {} FROM {} ORDER BY {}'.format(select, table, key), row_format='dict'
+            )
+            if len(all_rows) <= n:
+                return all_rows
+            picked = rng.sample(all_rows, n)
+            return sorted(picked, key=lambda row: row[key])
+        return [rows[value] for value in sorted(rows)]
+
+    def sample(self, table, n=None, fraction=None, method=None, seed=None, columns=None, key=None):
+        """Return a random sample of rows (list of dicts) from table without sorting the whole table
+
+        - table: name of table
+        - n: number of rows to return (at most)
+        - fraction: fraction of rows to return (i.e. 0.01 for 1%), if n is None
+        - method: 'system' or 'bernoulli' (postgresql TABLESAMPLE), or
+          'keyset'; default is 'system' on postgresql and 'keyset' on others
+        - seed: int seed to get the same sample again (for unchanged data)
+        - columns: list of column names to select; default is all columns
+        - key: integer column used by the keyset method (default is the
+          single column primary key or autoincrement column)
+
+        TABLESAMPLE SYSTEM picks random pages and BERNOULLI random rows (the
+        whole table is read, but not sorted). If n is given, the sample
+        percent comes from estimate_counts (oversampled, then trimmed to n)
+
+        The keyset method probes random key values between min(key) and
+        max(key) with "WHERE key >= :probe ORDER BY key LIMIT 1" (batches of
+        probes per statement), so a sample of n rows costs about n index
+        lookups. Rows after large gaps in the key are more likely to be
+        picked. If probes keep hitting the same rows (small table or sparse
+        key), the key column order is read and n rows are picked from it
+        """
+        import random
+        if (n is None) == (fraction is None):
+            raise ValueError('Specify exactly one of n or fraction')
+        if method is None:
+            method = 'system' if self._type == 'postgresql' else 'keyset'
+        if method not in SAMPLE_METHODS:
+            raise ValueError('method must be one of {}, not {}'.format(SAMPLE_METHODS, repr(method)))
+        if method != 'keyset' and self._type != 'postgresql':
+            raise ValueError('TABLESAMPLE {} is only supported on postgresql'.format(method.upper()))
+        rng = random.Random(seed)
+        if method != 'keyset':
+            select = ', '.join(columns) if columns else '*'
+            return self._sample_tablesample(table, select, n, fraction, method, rng, seed)
+        key, is_integer = self._checksum_key(table, key)
+        if not is_integer:
+            raise ValueError('The keyset method needs an integer key, and {} is not'.format(key))
+        if columns:
+            select = ', '.join([key] + [c for c in columns if c != key])
+        else:
+            select = '*'
+        if n is not None and n <= 0:
+            return []
+        return self._sample_keyset(table, select, key, n, fraction, rng)
+
+    def export(self, statement_or_table, path, format=None, params={},
+               chunk_size=10000, compression=None, show=False):
+        """Stream results of a statement (or a whole table) to a file and return dict of stats
+
+        - statement_or_table: a select statement or the name of a table
+        - path: path of the file to write
+        - format: 'csv', 'jsonl', or 'parquet' (inferred from the extension of
+          path if not specified)
+        - params: dict containing any :param names in statement
+        - chunk_size: number of rows to fetch from the server and write at a time
+        - compression: 'gzip', 'bz2', or 'xz' for csv/jsonl (inferred from a
+          .gz/.bz2/.xz extension on path); for parquet, the codec to pass to
+          pyarrow (default is snappy)
+        - show: if True, print the running row count and rows per second after
+          each chunk
+
+        Rows are streamed with a server-side cursor and written incrementally,
+        so memory use does not grow with the size of the result set. Parquet
+        files are written as Arrow record batches (requires pyarrow), with
+        column types from get_columns when statement_or_table is a table name
+        or a select from a single table (other columns have their types
+        inferred from the first chunk). On postgresql (psycopg2), csv exports
+        without params use COPY ... TO STDOUT
+
+        The file is always created; if there are no rows, a csv file still gets
+        its header and a parquet file its schema
+        """
+        import csv
+        if rx_table_name.match(statement_or_table):
+            statement = 'select * from {}'.format(statement_or_table)
+        else:
+            statement = statement_or_table.strip().rstrip(';')
+        base, ext = os.path.splitext(path.lower())
+        if ext in COMPRESSION_EXTENSIONS:
+            compression = compression or COMPRESSION_EXTENSIONS[ext]
+            ext = os.path.splitext(base)[1]
+        if format is None:
+            format = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.parquet': 'parquet'}.get(ext)
+        if format not in ('csv', 'jsonl', 'parquet'):
+            raise ValueError('format must be one of csv, jsonl, parquet... not {}'.format(format))
+        if format != 'parquet' and compression and compression not in COMPRESSION_MODULES:
+            raise ValueError('compression must be one of {}... not {}'.format(
+                sorted(COMPRESSION_MODULES), compression
+            ))
+
+        stats = {
+            'path': path, 'format': format, 'method': 'cursor', 'rows': 0,
+            'seconds': 0.0, 'rows_per_second': 0.0, 'bytes': 0,
+        }
+        start = time.time()
+
+        def progress(num_rows):
+            stats['rows'] = num_rows
+            stats['seconds'] = time.time() - start
+            if stats['seconds'] > 0:
+                stats['rows_per_second'] = stats['rows'] / stats['seconds']
+            if show:
+                print('{}: wrote {} rows ({:.0f} rows/sec)'.format(
+                    path, stats['rows'], stats['rows_per_second']
+                ))
+
+        if format == 'parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError('pyarrow must be installed to export parquet files')
+            types = {
+                name: _arrow_type(pa, sa_type)
+                for name, sa_type in self._column_types(statement_or_table).items()
+            }
+            types = {name: arrow_type for name, arrow_type in types.items() if arrow_type is not None}
+            writer = None
+            num_rows = 0
+            try:
+                for batch in self._arrow_batches(statement, params, chunk_size, types):
+                    if writer is None:
+                        writer = pq.ParquetWriter(
+                            path, batch.schema, compression=compression or 'snappy'
+                        )
+                    writer.write_batch(batch)
+                    num_rows += batch.num_rows
+                    progress(num_rows)
+            finally:
+                if writer is not None:
+                    writer.close()
+        else:
+            opener = _compression_opener(compression)
+            with opener(path, 'wt', newline='' if format == 'csv' else None, encoding='utf-8') as fp:
+                if (
+                    format == 'csv' and not params and
+                    self._engine.dialect.driver == 'psycopg2'
+                ):
+                    stats['method'] = 'copy'
+                    with self._raw_connection() as raw_conn:
+                        cursor = raw_conn.cursor()
+                        cursor.copy_expert(
+                            'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)'.format(statement),
+                            fp
+                        )
+                        num_rows = cursor.rowcount
+                        cursor.close()
+                    progress(num_rows)
+                else:
+                    writer = csv.writer(fp) if format == 'csv' else None
+                    num_rows = 0
+                    for columns, rows in self._stream(statement, params, chunk_size, empty=True):
+                        if format == 'csv':
+                            if num_rows == 0:
+                                writer.writerow(columns)
+                            writer.writerows(rows)
+                        else:
+                            fp.writelines([
+                                json.dumps(dict(zip(columns, row)), default=str) + '\n'
+                                for row in rows
+                            ])
+                        num_rows += len(rows)
+                        progress(num_rows)
+
+        stats['seconds'] = time.time() - start
+        stats['bytes'] = os.path.getsize(path) if os.path.isfile(path) else 0
+        return stats
+
+    def _column_types(self, statement_or_table):
+        """Return dict of column name to sqlalchemy type for a table or single table select
+
+        An empty dict is returned if the table can't be determined or found
+        """
+        if rx_table_name.match(statement_or_table):
+            table = statement_or_table
+        else:
+            match = rx_single_table_select.match(statement_or_table)
+            if not match:
+                return {}
+            table = match.group(1)
+        try:
+            columns = self.get_columns(table)
+        except NoSuchTableError:
+            return {}
+        return {column['name']: column['type'] for column in columns or []}
+
+    def _arrow_batches(self, statement, params={}, chunksize=10000, types={}):
+        """Yield pyarrow RecordBatches built column by column from cursor batches
+
+        - types: dict of column name to pyarrow type (missing names are inferred)
+
+        The schema is set by the first batch, so every batch has the same schema.
+        One empty batch is yielded if the result set is empty
+        """
+        import pyarrow as pa
+        schema = None
+        for columns, rows in self._stream(statement, params, chunksize, empty=True):
+            values = list(zip(*rows)) if rows else [()] * len(columns)
+            if schema is None:
+                arrays = [
+                    _arrow_array(pa, list(column_values), types.get(name))
+                    if column_values else
+                    pa.array([], type=types.get(name) or pa.null())
+                    for name, column_values in zip(columns, values)
+                ]
+                batch = pa.RecordBatch.from_arrays(arrays, names=columns)
+                schema = batch.schema
+            else:
+                batch = pa.RecordBatch.from_arrays(
+                    [
+                        _arrow_array(pa, list(column_values), field.type)
+                        for column_values, field in zip(values, schema)
+                    ],
+                    schema=schema
+                )
+            yield batch
+
+    def _arrow_copy(self, statement, types={}):
+        """Return a pyarrow Table for statement using postgresql COPY (psycopg2)
+
+        COPY writes csv to a spooled temp file and pyarrow's multithreaded csv
+        reader parses it, using types for the listed columns
+        """
+        import tempfile
+        import pyarrow.csv as pa_csv
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, mode='w+b') as fp:
+            with self._raw_connection() as raw_conn:
+                cursor = raw_conn.cursor()
+                cursor.copy_expert(
+                    'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)'.format(statement),
+                    fp
+                )
+                cursor.close()
+            fp.seek(0)
+            return pa_csv.read_csv(
+                fp,
+                convert_options=pa_csv.ConvertOptions(
+                    column_types=types,
+                    true_values=['t', 'true', 'TRUE', '1'],
+                    false_values=['f', 'false', 'FALSE', '0'],
+                    strings_can_be_null=True,
+                    quoted_strings_can_be_null=False,
+                )
+            )
+
+    def to_arrow(self, statement_or_table, params={}, chunksize=None):
+        """Return a pyarrow Table for results of a statement (or a whole table)
+
+        - statement_or_table: a select statement or the name of a table
+        - params: dict containing any :param names in statement
+        - chunksize: if specified, return an iterator of pyarrow Tables with up
+          to chunksize rows each (for results that don't fit in memory)
+
+        Columns are built directly from cursor batches (rows are never turned
+        into dicts). Column types come from get_columns when statement_or_table
+        is a table name or a select from a single table; other columns have
+        their types inferred. On postgresql (psycopg2), whole results of
+        statements without params are read with COPY and pyarrow's csv reader
+
+        Requires pyarrow
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError('pyarrow must be installed to use to_arrow')
+        if rx_table_name.match(statement_or_table):
+            statement = 'select * from {}'.format(statement_or_table)
+        else:
+            statement = statement_or_table.strip().rstrip(';')
+        types = {
+            name: _arrow_type(pa, sa_type)
+            for name, sa_type in self._column_types(statement_or_table).items()
+        }
+        types = {name: arrow_type for name, arrow_type in types.items() if arrow_type is not None}
+
+        if chunksize:
+            return (
+                pa.Table.from_batches([batch])
+                for batch in self._arrow_batches(statement, params, chunksize, types)
+            )
+        if not params and self._engine.dialect.driver == 'psycopg2':
+            try:
+                return self._arrow_copy(statement, types)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                pass
+        return pa.Table.from_batches(list(self._arrow_batches(statement, params, 10000, types)))
+
+    def to_dataframe(self, statement_or_table, params={}, chunksize=None):
+        """Return a pandas DataFrame for results of a statement (or a whole table)
+
+        - statement_or_table: a select statement or the name of a table
+        - params: dict containing any :param names in statement
+        - chunksize: if specified, return an iterator of DataFrames with up to
+          chunksize rows each (for results that don't fit in memory)
+
+        If pyarrow is installed, DataFrames are converted from to_arrow results
+        (see to_arrow for how column types are determined). Otherwise, columns
+        are built directly from cursor batches and cast to pandas dtypes based
+        on get_columns (nullable Int64/boolean for integer/boolean columns)
+
+        Requires pandas
+        """
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError('pandas must be installed to use to_dataframe')
+        try:
+            import pyarrow
+        except ImportError:
+            pyarrow = None
+
+        if pyarrow is not None:
+            results = self.to_arrow(statement_or_table, params, chunksize=chunksize)
+            if chunksize:
+                return (table.to_pandas() for table in results)
+            return results.to_pandas()
+
+        if rx_table_name.match(statement_or_table):
+            statement = 'select * from {}'.format(statement_or_table)
+        else:
+            statement = statement_or_table.strip().rstrip(';')
+        dtypes = {
+            name: _pandas_dtype(sa_type)
+            for name, sa_type in self._column_types(statement_or_table).items()
+        }
+
+        def make_frame(columns, rows):
+            values = list(zip(*rows)) if rows else [()] * len(columns)
+            df = pd.DataFrame(OrderedDict([
+                (name, list(column_values))
+                for name, column_values in zip(columns, values)
+            ]), columns=columns)
+            for name in columns:
+                if dtypes.get(name):
+                    try:
+                        df[name] = df[name].astype(dtypes[name])
+                    except (TypeError, ValueError):
+                        pass
+            return df
+
+        frames = (
+            make_frame(columns, rows)
+            for columns, rows in self._stream(
+                statement, params, chunksize or 10000, empty=True
+            )
+        )
+        if chunksize:
+            return frames
+        frames = list(frames)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+
+
+def _import_async_sql():
+    try:
+        from sql_helper.async_sql import AsyncSQL
+    except ImportError:
+        AsyncSQL = None
+    return AsyncSQL
+
+
+if sys.version_info < (3, 7):
+    SETTINGS = _get_settings()
+    CONNECT_TIMEOUT = _get_connect_timeout()
+    AsyncSQL = _import_async_sql()
+
+
+def __getattr__(name):
+    """Load SETTINGS, CONNECT_TIMEOUT, and AsyncSQL on first access (python 3.7+)"""
+    if name == 'SETTINGS':
+        return _get_settings()
+    elif name == 'CONNECT_TIMEOUT':
+        return _get_connect_timeout()
+    elif name == 'AsyncSQL':
+        globals()['AsyncSQL'] = _import_async_sql()
+        return globals()['AsyncSQL']
+    raise AttributeError('module {} has no attribute {}'.format(repr(__name__), repr(name)))
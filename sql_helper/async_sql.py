@@ -0,0 +1,416 @@
+import time
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sql_helper import (
+    POSTGRESQL_TABLES_STATEMENT, POSTGRESQL_INDEXES_STATEMENT, ROW_FORMATS,
+    _chunks, _db_type, _filter_columns, _format_rows, _get_connect_timeout,
+    _shape_results, _is_timestamp_column, _is_autoincrement_column, _is_required_column,
+    _is_non_nullable_column
+)
+
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+}
+ASYNC_DRIVER_NAMES = ('asyncpg', 'psycopg', 'aiomysql', 'asyncmy', 'aiosqlite')
+
+
+def _async_url(url):
+    """Return url with the asyncio driver for postgresql/mysql/sqlite
+
+    Urls that already specify an asyncio driver are returned unchanged
+    """
+    scheme, sep, rest = url.partition('://')
+    if scheme.split('+')[-1] in ASYNC_DRIVER_NAMES:
+        return url
+    db_type = _db_type(scheme)
+    if db_type in ASYNC_DRIVERS:
+        return ASYNC_DRIVERS[db_type] + sep + rest
+    return url
+
+
+async def _achunks(iterable, size):
+    """Yield lists of up to size items from an iterable or async iterable"""
+    if not hasattr(iterable, '__aiter__'):
+        for chunk in _chunks(iterable, size):
+            yield chunk
+        return
+    chunk = []
+    async for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class AsyncSQL(object):
+    def __init__(self, url, connect_timeout=None, **connect_args):
+        """An instance that can execute SQL statements on a SQL db without blocking the event loop
+
+        - url: connection url to a SQL db (postgresql://, mysql://, and
+          sqlite:/// urls are changed to use asyncpg, aiomysql, and aiosqlite)
+        - connect_timeout: number of seconds to wait for connection before giving up
+          (default is connect_timeout in settings.ini, or 5)
+
+        Other kwargs passed in will be passed to
+        sqlalchemy.ext.asyncio.create_async_engine as connect_args
+
+        Methods are awaitable versions of the SQL methods with the same names
+        and the same result shaping rules; iter_execute is an async generator
+        """
+        if not url:
+            raise ValueError('The url cannot be None or empty string')
+        url = _async_url(url)
+        if connect_timeout is None:
+            connect_timeout = _get_connect_timeout()
+        if url.startswith('sqlite') or url.startswith('postgresql'):
+            connect_args['timeout'] = connect_timeout
+        elif url.startswith('mysql'):
+            connect_args['connect_timeout'] = connect_timeout
+        self._engine = create_async_engine(url, connect_args=connect_args)
+        self._type = _db_type(self._engine.url.drivername)
+
+    async def dispose(self):
+        """Close all pooled connections"""
+        await self._engine.dispose()
+
+    async def execute(self, statement, params={}, row_format=None):
+        """Pass statement to SQL engine and return a list of dicts, list, dict, or value
+
+        - statement: a string
+        - params: dict or list of dicts containing any :param names in string
+          statement
+        - row_format: if None, shape the results like SQL.execute; otherwise
+          one of 'dict', 'tuple', 'record', or 'columns' (see SQL.execute)
+
+        See SQL.execute for how results are shaped
+        """
+        if row_format is not None and row_format not in ROW_FORMATS:
+            raise ValueError('row_format must be one of {}, not {}'.format(ROW_FORMATS, repr(row_format)))
+        async with self._engine.begin() as conn:
+            res = await conn.execute(text(statement), params)
+            if not res.returns_rows:
+                return []
+            columns = list(res.keys())
+            rows = res.fetchall()
+        if row_format == 'tuple':
+            return [tuple(columns)] + _format_rows(columns, rows, 'tuple')
+        elif row_format is not None:
+            return _format_rows(columns, rows, row_format)
+        if not rows:
+            return []
+        return _shape_results(statement, rows[0], rows[1:])
+
+    async def iter_execute(self, statement, params={}, batch_size=1000, batches=False,
+                           row_format=None):
+        """Pass statement to SQL engine and yield results one row at a time
+
+        - statement: a string (that returns rows)
+        - params: dict containing any :param names in string statement
+        - batch_size: number of rows to fetch from the server at a time
+        - batches: if True, yield a list of rows for each batch fetched instead
+          of yielding individual rows
+        - row_format: if None, each row is shaped like SQL.iter_execute;
+          otherwise one of 'dict', 'tuple', 'record', or 'columns' (see
+          SQL.iter_execute)
+
+        Rows are streamed with a server-side cursor. If the result only has 1
+        column, each row is a simple value; if there are multiple columns, each
+        row is a dict
+        """
+        if row_format is not None and row_format not in ROW_FORMATS:
+            raise ValueError('row_format must be one of {}, not {}'.format(ROW_FORMATS, repr(row_format)))
+        async with self._engine.begin() as conn:
+            res = await conn.stream(text(statement), params)
+            columns = list(res.keys())
+            header_sent = False
+            while True:
+                rows = await res.fetchmany(batch_size)
+                if not rows:
+                    break
+                if row_format is not None:
+                    shaped = _format_rows(columns, rows, row_format)
+                    if row_format == 'columns':
+                        yield shaped
+                        continue
+                    if row_format == 'tuple' and not header_sent:
+                        header_sent = True
+                        yield tuple(columns)
+                elif len(columns) == 1:
+                    shaped = [row[0] for row in rows]
+                else:
+                    shaped = [dict(zip(columns, row)) for row in rows]
+                if batches:
+                    yield shaped
+                else:
+                    for row in shaped:
+                        yield row
+
+    async def insert(self, table, data):
+        """Insert data to table and return generated statement
+
+        - data: dict or list of dicts
+        """
+        try:
+            keys = data.keys()
+        except AttributeError:
+            keys = data[0].keys()
+
+        statement_start = 'insert into {} ('.format(table)
+        statement_cols = ', '.join(keys) + ') values ('
+        statement_vals = ', '.join([':{}'.format(k) for k in keys]) + ')'
+        statement = statement_start + statement_cols + statement_vals
+        async with self._engine.begin() as conn:
+            await conn.execute(text(statement), data)
+        return statement
+
+    async def bulk_insert(self, table, data, chunk_size=5000, show=False):
+        """Insert data to table in chunks (commit per chunk) and return dict of stats
+
+        - data: dict, list of dicts, or any iterable/async iterable of dicts
+        - chunk_size: number of rows to send (and commit) at a time
+        - show: if True, print the running row count and rows per second after
+          each chunk
+
+        Column names are taken from the keys of the first row (rows missing a
+        key get NULL for it)
+        """
+        if isinstance(data, dict):
+            data = [data]
+        stats = {
+            'table': table, 'statement': '', 'rows': 0, 'chunks': 0,
+            'seconds': 0.0, 'rows_per_second': 0.0,
+        }
+        chunks = _achunks(data, chunk_size)
+        try:
+            first_chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            return stats
+
+        keys = list(first_chunk[0].keys())
+        statement = 'insert into {} ({}) values ({})'.format(
+            table, ', '.join(keys), ', '.join([':{}'.format(k) for k in keys])
+        )
+        stats['statement'] = statement
+        start = time.time()
+        rows = first_chunk
+        while rows:
+            async with self._engine.begin() as conn:
+                await conn.execute(
+                    text(statement),
+                    [{k: row.get(k) for k in keys} for row in rows]
+                )
+            stats['rows'] += len(rows)
+            stats['chunks'] += 1
+            stats['seconds'] = time.time() - start
+            if stats['seconds'] > 0:
+                stats['rows_per_second'] = stats['rows'] / stats['seconds']
+            if show:
+                print('{}: inserted {} rows ({:.0f} rows/sec)'.format(
+                    table, stats['rows'], stats['rows_per_second']
+                ))
+            try:
+                rows = await chunks.__anext__()
+            except StopAsyncIteration:
+                rows = None
+        return stats
+
+    async def _inspect(self, method, *args, **kwargs):
+        """Return result of calling method on an inspector for a pooled connection"""
+        async with self._engine.connect() as conn:
+            return await conn.run_sync(
+                lambda sync_conn: getattr(inspect(sync_conn), method)(*args, **kwargs)
+            )
+
+    async def call_procedure(self, procedure, list_of_params=[]):
+        """Call the stored procedure with specified params and return a list of tuples
+
+        On postgresql, the procedure is called like psycopg2's callproc does
+        (SELECT * FROM procedure(...)); on mysql, with CALL
+        """
+        params = {'p{}'.format(i): value for i, value in enumerate(list_of_params)}
+        placeholders = ', '.join([':p{}'.format(i) for i in range(len(list_of_params))])
+        if self._type == 'postgresql':
+            statement = 'SELECT * FROM {}({})'.format(procedure, placeholders)
+        elif self._type == 'mysql':
+            statement = 'CALL {}({})'.format(procedure, placeholders)
+        else:
+            raise NotImplementedError('Stored procedures are not supported for {}'.format(self._type))
+        async with self._engine.begin() as conn:
+            res = await conn.execute(text(statement), params)
+            if not res.returns_rows:
+                return []
+            return [tuple(row) for row in res.fetchall()]
+
+    async def _get_postgresql_procedure_names(self, schema='', sort=False):
+        if schema:
+            statement = (
+                "SELECT proname "
+                "FROM pg_catalog.pg_namespace n "
+                "JOIN pg_catalog.pg_proc p on pronamespace = n.oid "
+                "WHERE nspname = :schema"
+            )
+            if sort:
+                statement += " ORDER BY proname"
+        else:
+            statement = (
+                "SELECT proname, nspname "
+                "FROM pg_catalog.pg_namespace n "
+                "JOIN pg_catalog.pg_proc p on pronamespace = n.oid "
+                "WHERE nspname NOT IN ('pg_catalog', 'information_schema')"
+            )
+            if sort:
+                statement += " ORDER BY nspname, proname"
+        return await self.execute(statement, {'schema': schema} if schema else {})
+
+    async def _get_mysql_procedure_names(self, sort=False):
+        results = await self.execute(
+            "SELECT routine_name "
+            "FROM information_schema.routines "
+            "WHERE routine_type = 'PROCEDURE'"
+        )
+        if sort:
+            results = sorted(results)
+        return results
+
+    async def get_procedure_names(self, schema='', sort=False):
+        """Return a list of procedure names
+
+        - schema: name of schema (postgresql only)
+        - sort: if True, results will be sorted by name (or by schema then name
+          if postgresql and no schema specified)
+        """
+        if self._type == 'postgresql':
+            return await self._get_postgresql_procedure_names(schema=schema, sort=sort)
+        elif self._type == 'mysql':
+            return await self._get_mysql_procedure_names(sort=sort)
+        else:
+            return []
+
+    async def get_procedure_code(self, procedure):
+        """Return a string with definition of stored procedure"""
+        if self._type == 'postgresql':
+            return ''.join(await self.execute(
+                "SELECT prosrc FROM pg_proc WHERE proname = :procedure",
+                {'procedure': procedure}
+            ))
+        elif self._type == 'mysql':
+            return b''.join(await self.execute(
+                "SELECT body FROM mysql.proc WHERE name = :procedure",
+                {'procedure': procedure}
+            )).decode('utf-8')
+        else:
+            return ''
+
+    async def get_schemas(self, sort=False):
+        """Return a list of schemas (postgresql only)
+
+        - sort: if True, results will be sorted by name
+        """
+        results = []
+        if self._type == 'postgresql':
+            results = await self.execute(
+                "SELECT schema_name FROM information_schema.schemata"
+            )
+        if sort:
+            results = sorted(results)
+        return results
+
+    async def get_tables(self):
+        """Return a list of table names (or schema.tablename strings)"""
+        if self._type == 'postgresql':
+            results = await self.execute(POSTGRESQL_TABLES_STATEMENT)
+            return [
+                r['schemaname'] + '.' + r['tablename']
+                for r in results
+            ]
+        elif self._type == 'mysql':
+            return await self.execute("show tables")
+        return await self._inspect('get_table_names')
+
+    async def get_indexes(self, table, schema=None):
+        """Return a list of dicts containing info about indexes for table"""
+        if '.' in table and schema is None:
+            schema, table = table.split('.', 1)
+        if self._type == 'postgresql':
+            return await self.execute(POSTGRESQL_INDEXES_STATEMENT, {'table': table})
+        elif self._type == 'mysql':
+            return await self.execute("SHOW INDEXES FROM {}".format(table))
+        return await self._inspect('get_indexes', table, schema=schema)
+
+    async def get_primary_key(self, table, schema=None):
+        """Return a list of the primary key column names for table"""
+        if '.' in table and schema is None:
+            schema, table = table.split('.', 1)
+        constraint = await self._inspect('get_pk_constraint', table, schema=schema)
+        return list(constraint.get('constrained_columns') or [])
+
+    async def get_columns(self, table, schema=None, name_only=False, sort=False, **kwargs):
+        """Return a list of dicts containing info about columns for table
+
+        - name_only: if True, only return the names of columns, not full dict of
+          info per column
+        - sort: if True, results will be sorted by name
+
+        Additional kwargs are passed to the inspector's get_columns
+        """
+        if '.' in table and schema is None:
+            schema, table = table.split('.', 1)
+        results = await self._inspect('get_columns', table, schema=schema, **kwargs)
+        return _filter_columns(results, lambda column: True, name_only=name_only, sort=sort)
+
+    async def get_timestamp_columns(self, table, schema=None, name_only=False,
+                                    sort=False, **kwargs):
+        """Return a list of columns that are DATE, DATETIME, TIME, or TIMESTAMP
+
+        - name_only: if True, only return the names of columns, not full dict of
+          info per column
+        - sort: if True, results will be sorted by name
+        """
+        return _filter_columns(
+            await self.get_columns(table, schema=schema, **kwargs),
+            _is_timestamp_column, name_only=name_only, sort=sort
+        )
+
+    async def get_autoincrement_columns(self, table, schema=None, name_only=False,
+                                        sort=False, **kwargs):
+        """Return a list of dicts containing info about autoincrement columns
+
+        - name_only: if True, only return the names of columns, not full dict of
+          info per column
+        - sort: if True, results will be sorted by name
+        """
+        return _filter_columns(
+            await self.get_columns(table, schema=schema, **kwargs),
+            _is_autoincrement_column, name_only=name_only, sort=sort
+        )
+
+    async def get_required_columns(self, table, schema=None, name_only=False,
+                                   sort=False, **kwargs):
+        """Return a list of dicts containing info about required columns
+
+        - name_only: if True, only return the names of columns, not full dict of
+          info per column
+        - sort: if True, results will be sorted by name
+        """
+        return _filter_columns(
+            await self.get_columns(table, schema=schema, **kwargs),
+            _is_required_column, name_only=name_only, sort=sort
+        )
+
+    async def get_non_nullable_columns(self, table, schema=None, name_only=False,
+                                       sort=False, **kwargs):
+        """Return a list of dicts containing info about non-nullable columns
+
+        - name_only: if True, only return the names of columns, not full dict of
+          info per column
+        - sort: if True, results will be sorted by name
+        """
+        return _filter_columns(
+            await self.get_columns(table, schema=schema, **kwargs),
+            _is_non_nullable_column, name_only=name_only, sort=sort
+        )
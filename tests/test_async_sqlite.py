@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+import sql_helper as sqh
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+
+loop = asyncio.new_event_loop()
+sqlite_url = sqh.SETTINGS.get('sqlite_url')
+try:
+    sql = sqh.AsyncSQL(sqlite_url)
+    num_tables = len(loop.run_until_complete(sql.get_tables()))
+except (sqh.OperationalError, ValueError, TypeError):
+    sql = None
+    num_tables = 0
+
+
+def run(coro):
+    return loop.run_until_complete(coro)
+
+
+async def collect(agen):
+    return [item async for item in agen]
+
+
+async def agen_rows(n):
+    for i in range(n):
+        yield {'first': i, 'second': i / 2}
+
+
+@pytest.mark.skipif(num_tables != 0, reason='Database is not empty, has {} table(s)'.format(num_tables))
+@pytest.mark.skipif(sql is None, reason='Not connected to sqlite with aiosqlite')
+@pytest.mark.skipif(aiosqlite is None, reason='aiosqlite is not installed')
+@pytest.mark.skipif(sqh.AsyncSQL is None, reason='sqlalchemy asyncio extension not available')
+@pytest.mark.skipif(not sqlite_url, reason='No sqlite_url in settings')
+class TestAsyncSqlite:
+    def test_empty_sqlite(self):
+        assert sql._engine.url.drivername == 'sqlite+aiosqlite'
+        assert run(sql.get_tables()) == []
+
+    def test_execute_create_table(self):
+        run(sql.execute('create table async_stuff (first int, second float, third date, fourth datetime)'))
+        assert run(sql.get_tables()) == ['async_stuff']
+        assert run(sql.get_columns('async_stuff', name_only=True)) == ['first', 'second', 'third', 'fourth']
+        assert run(sql.get_timestamp_columns('async_stuff', name_only=True)) == ['third', 'fourth']
+
+    def test_insert_and_execute(self):
+        statement = run(sql.insert('async_stuff', [{'first': 1, 'second': 0.5}, {'first': 2, 'second': 1.0}]))
+        assert statement == 'insert into async_stuff (first, second) values (:first, :second)'
+        assert run(sql.execute('select count(*) from async_stuff')) == 2
+        assert run(sql.execute('select first from async_stuff order by first')) == [1, 2]
+        assert run(sql.execute('select first, second from async_stuff where first = 1')) == [{'first': 1, 'second': 0.5}]
+        assert run(sql.execute('select first, second from async_stuff where first in (1)')) == {'first': 1, 'second': 0.5}
+        run(sql.execute('delete from async_stuff'))
+
+    def test_bulk_insert(self):
+        stats = run(sql.bulk_insert('async_stuff', ({'first': i, 'second': i / 2} for i in range(250)), chunk_size=100))
+        assert stats['rows'] == 250
+        assert stats['chunks'] == 3
+        stats = run(sql.bulk_insert('async_stuff', agen_rows(50), chunk_size=100))
+        assert stats['rows'] == 50
+        assert stats['chunks'] == 1
+        assert run(sql.execute('select count(*) from async_stuff')) == 300
+        assert run(sql.bulk_insert('async_stuff', []))['rows'] == 0
+
+    def test_iter_execute(self):
+        rows = run(collect(sql.iter_execute('select first from async_stuff order by first', batch_size=64)))
+        assert len(rows) == 300
+        assert rows[:3] == [0, 0, 1]
+        batches = run(collect(sql.iter_execute('select first, second from async_stuff', batch_size=64, batches=True)))
+        assert [len(b) for b in batches] == [64, 64, 64, 64, 44]
+        assert set(batches[0][0].keys()) == {'first', 'second'}
+
+    def test_row_formats(self):
+        statement = 'select first, second from async_stuff where first < 2 order by first'
+        assert run(sql.execute(statement, row_format='tuple')) == [('first', 'second'), (0, 0.0), (0, 0.0), (1, 0.5), (1, 0.5)]
+        assert run(sql.execute(statement, row_format='record'))[2].second == 0.5
+        assert list(run(sql.execute(statement, row_format='columns'))['first']) == [0, 0, 1, 1]
+        rows = run(collect(sql.iter_execute(statement, batch_size=3, row_format='tuple')))
+        assert rows[0] == ('first', 'second')
+        assert len(rows) == 5
+        chunks = run(collect(sql.iter_execute(statement, batch_size=3, row_format='columns')))
+        assert [len(c['first']) for c in chunks] == [3, 1]
+
+    def test_primary_key_and_procedures(self):
+        run(sql.execute('create table async_keyed (id integer primary key, name text)'))
+        assert run(sql.get_primary_key('async_keyed')) == ['id']
+        assert run(sql.get_primary_key('async_stuff')) == []
+        assert run(sql.get_procedure_names()) == []
+        assert run(sql.get_procedure_code('nope')) == ''
+        with pytest.raises(NotImplementedError):
+            run(sql.call_procedure('nope'))
+        run(sql.execute('drop table async_keyed'))
+
+    def test_clear_db(self):
+        """This MUST be the final test since it's the new teardown"""
+        run(sql.execute('drop table async_stuff'))
+        assert run(sql.get_tables()) == []
+        run(sql.dispose())
@@ -1,3 +1,4 @@
+import json
 import pytest
 import sql_helper as sqh
 from datetime import date, datetime
@@ -75,6 +76,265 @@ class TestPostgresql:
         results3 = sql.execute("select max(fourth) from stuff where fourth > '2022-05-07'")
         assert type(results3) == datetime
 
+    def test_iter_execute(self):
+        rows = sql.iter_execute('select first from stuff', batch_size=2)
+        assert not isinstance(rows, list)
+        assert list(rows) == [5, 10, -1, 7, 25, 20, -10]
+        batches = list(sql.iter_execute('select first, third from stuff', batch_size=3, batches=True))
+        assert [len(batch) for batch in batches] == [3, 3, 1]
+        assert batches[2][0]['first'] == -10
+        assert type(batches[2][0]['third']) == date
+
+    def test_bulk_insert(self):
+        rows = ({'first': i, 'second': 0.5} for i in range(1000, 3500))
+        stats = sql.bulk_insert('stuff', rows, chunk_size=1000)
+        assert stats['rows'] == 2500
+        assert stats['chunks'] == 3
+        assert sql.execute('select count(*) from stuff where first >= 1000') == 2500
+        sql.execute('delete from stuff where first >= 1000')
+        assert sql.execute('select count(*) from stuff') == 7
+
+    def test_load(self, tmp_path):
+        csv_path = str(tmp_path / 'stuff.csv')
+        with open(csv_path, 'w') as fp:
+            fp.write('second,first,third\n1.5,1001,2022-06-01\n,1002,\n')
+        stats = sql.load('stuff', csv_path)
+        assert stats['method'] == 'copy'
+        assert stats['rows'] == 2
+        assert sql.execute('select second from stuff where first > 1000 order by first') == [1.5, None]
+        stats = sql.load('stuff', ({'first': i, 'third': date(2022, 6, 2)} for i in range(1003, 1010)), chunk_size=3)
+        assert stats['rows'] == 7
+        assert sql.execute('select count(*) from stuff where first > 1000') == 9
+        with pytest.raises(ValueError):
+            sql.load('stuff', [{'first': 1, 'bogus': 2}])
+        sql.execute('delete from stuff where first > 1000')
+
+    def test_load_null_empty_bytes(self):
+        sql.execute('create table blobs (id int, name text, data bytea)')
+        rows = [
+            {'id': 1, 'name': None, 'data': None},
+            {'id': 2, 'name': '', 'data': b''},
+            {'id': 3, 'name': 'a "b", c', 'data': b'\x00\xff\n'},
+        ]
+        stats = sql.load('blobs', rows)
+        assert stats['method'] == 'copy'
+        results = sql.execute('select id, name, data from blobs order by id')
+        assert [r['name'] for r in results] == [None, '', 'a "b", c']
+        assert [bytes(r['data']) if r['data'] is not None else None for r in results] == [None, b'', b'\x00\xff\n']
+        sql.execute('drop table blobs')
+
+    def test_load_csv_empty_fields(self, tmp_path):
+        sql.execute('create table emptied (id int, name varchar(20))')
+        csv_path = str(tmp_path / 'emptied.csv')
+        with open(csv_path, 'w') as fp:
+            fp.write('id,name\n1,""\n2,\n3,x\n')
+        assert sql.load('emptied', csv_path)['method'] == 'copy'
+        with open(csv_path) as fp:
+            sql.load('emptied', fp)
+        assert sql.execute('select name from emptied order by id, name') == ['', '', None, None, 'x', 'x']
+        sql.execute('drop table emptied')
+
+    def test_export(self, tmp_path):
+        csv_path = str(tmp_path / 'stuff.csv')
+        stats = sql.export('select first, third from stuff order by first', csv_path)
+        assert stats['method'] == 'copy'
+        assert stats['rows'] == 7
+        with open(csv_path) as fp:
+            lines = fp.read().splitlines()
+        assert lines[0] == 'first,third'
+        assert lines[1] == '-10,2022-05-10'
+        stats = sql.export('select first from stuff where first > :x', str(tmp_path / 'stuff.jsonl.gz'), params={'x': 0})
+        assert stats['method'] == 'cursor'
+        assert stats['rows'] == 5
+
+    def test_describe_all(self):
+        expected_columns = sql.get_columns('stuff')
+        snapshot = sql.describe_all()
+        assert snapshot.get_tables() == ['public.stuff']
+        columns = sql.get_columns('stuff')
+        assert [c['name'] for c in columns] == [c['name'] for c in expected_columns]
+        assert [c['nullable'] for c in columns] == [c['nullable'] for c in expected_columns]
+        assert [type(c['type']) for c in columns] == [type(c['type']) for c in expected_columns]
+        assert sql.get_timestamp_columns('stuff', name_only=True) == ['third', 'fourth']
+        assert snapshot.get_primary_key('stuff') == []
+        sql.refresh_metadata_cache()
+        assert sql._schema is None
+
+    def test_transaction(self):
+        with sql.transaction():
+            sql.insert('stuff', {'first': 1001})
+            with pytest.raises(ZeroDivisionError):
+                with sql.transaction(savepoint=True):
+                    sql.insert('stuff', {'first': 1002})
+                    1 / 0
+            sql.bulk_insert('stuff', [{'first': 1003}])
+            assert sql.execute('select count(*) from stuff where first > 1000') == 2
+        assert sql.execute('select first from stuff where first > 1000 order by first') == [1001, 1003]
+        with pytest.raises(ZeroDivisionError):
+            with sql.transaction():
+                sql.execute('delete from stuff where first > 1000')
+                1 / 0
+        assert sql.execute('select count(*) from stuff where first > 1000') == 2
+        sql.execute('delete from stuff where first > 1000')
+
+    def test_to_arrow(self):
+        pa = pytest.importorskip('pyarrow')
+        table = sql.to_arrow('stuff')
+        assert table.num_rows == 7
+        assert table.schema.field('first').type == pa.int64()
+        assert table.schema.field('third').type == pa.date32()
+        chunks = list(sql.to_arrow('select first from stuff where first > :x', {'x': 0}, chunksize=3))
+        assert [chunk.num_rows for chunk in chunks] == [3, 2]
+        pytest.importorskip('pandas')
+        df = sql.to_dataframe('select first, third from stuff order by first')
+        assert len(df) == 7
+        assert df['first'].iloc[0] == -10
+
+    def test_explain(self):
+        explained = sql.explain('select * from stuff where first > :x', {'x': 0})
+        assert explained['db_type'] == 'postgresql'
+        assert explained['full_scans'] == ['stuff']
+        nodes = [explained['plan']] + explained['plan']['children']
+        scan = [node for node in nodes if node['relation'] == 'stuff'][0]
+        assert scan['operation'] == 'Seq Scan'
+        assert scan['rows'] is not None
+        assert scan['cost'] is not None or explained['plan']['cost'] is not None
+        explained = sql.explain('delete from stuff', analyze=True)
+        assert explained['plan']['actual_seconds'] is not None
+        assert sql.execute('select count(*) from stuff') == 7
+
+    def test_run_script(self, tmp_path):
+        script_path = str(tmp_path / 'migration.sql')
+        with open(script_path, 'w') as fp:
+            fp.write('create table script_stuff (a int, b text);\n')
+            fp.write("insert into script_stuff values (1, 'semi;colon 50%');\n")
+            fp.write("insert into script_stuff values (2, E'it\\'s; \\\\here');\n")
+            fp.write('create function script_stuff_count() returns bigint as $body$\n')
+            fp.write('begin\n  return (select count(*) from script_stuff);\nend;\n$body$ language plpgsql;\n')
+        stats = sql.run_script(script_path)
+        assert stats['statements'] == 4
+        assert sql.execute('select script_stuff_count()') == 2
+        assert sql.execute('select b from script_stuff where a = 2') == ["it's; \\here"]
+        sql.execute('drop function script_stuff_count()')
+        sql.execute('drop table script_stuff')
+
+    def test_execute_many_parallel(self):
+        statements = ['select pg_sleep(0.5)'] * 4
+        stats = sql.execute_many_parallel(statements + ['select count(*) from stuff'], max_workers=5)
+        assert stats['errors'] == 0
+        assert stats['results'][-1]['result'] == 7
+        assert stats['seconds'] < stats['statement_seconds']
+        stats = sql.execute_many_parallel(['select pg_sleep(2)', 'select count(*) from stuff'], timeout=0.5)
+        assert stats['results'][0]['error'].startswith('Timed out')
+        assert stats['results'][1]['result'] == 7
+
+    def test_iter_table(self):
+        sql.execute('create table paged (a int, b int, c varchar(10), primary key (a, b))')
+        sql.bulk_insert('paged', [{'a': i // 10, 'b': i % 10, 'c': str(i)} for i in range(95)])
+        assert sql.get_primary_key('paged') == ['a', 'b']
+        pages = sql.iter_table('paged', batch_size=20)
+        batches = list(pages)
+        assert [len(batch) for batch in batches] == [20, 20, 20, 20, 15]
+        assert [row['c'] for batch in batches for row in batch] == [str(i) for i in range(95)]
+        pages = sql.iter_table('paged', batch_size=30, where='b < :b', params={'b': 5})
+        first = next(iter(pages))
+        resumed = list(sql.iter_table('paged', batch_size=30, where='b < :b', params={'b': 5}, start_after=pages.token))
+        assert [row['c'] for row in first + resumed[0]] == [str(i) for i in range(95) if i % 10 < 5]
+        with pytest.raises(ValueError):
+            sql.iter_table('stuff')
+        sql.execute('drop table paged')
+
+    def test_extract_incremental(self, tmp_path):
+        state_path = str(tmp_path / 'state.json')
+        sql.execute('create table events (id int primary key, name varchar(10), updated_at timestamp)')
+        sql.execute('create index ix_events_updated_at on events (updated_at)')
+        sql.bulk_insert('events', [
+            {'id': i, 'name': 'e{}'.format(i), 'updated_at': '2024-01-01 00:00:{:02d}'.format(i // 2)}
+            for i in range(20)
+        ])
+        assert sql.get_watermark_column('events') == 'updated_at'
+        batches = list(sql.extract_incremental('events', state_path, batch_size=7))
+        assert [len(batch) for batch in batches] == [7, 7, 6]
+        with open(state_path) as fp:
+            assert json.load(fp)['events']['watermark'] == {'type': 'datetime', 'value': '2024-01-01T00:00:09'}
+        sql.insert('events', {'id': 20, 'name': 'late', 'updated_at': '2024-01-01 00:00:08.500000'})
+        assert list(sql.extract_incremental('events', state_path)) == []
+        rows = [row for batch in sql.extract_incremental('events', state_path, overlap=1) for row in batch]
+        assert sorted(row['name'] for row in rows) == ['e18', 'e19', 'late']
+        sql.execute('drop table events')
+
+    def test_copy_table_to(self, tmp_path):
+        dest = sqh.SQL('sqlite:///' + str(tmp_path / 'dest.db'))
+        stats = sql.copy_table_to(dest, 'stuff', batch_size=3)
+        assert (stats['rows'], stats['batches'], stats['created']) == (7, 3, True)
+        assert dest.execute('select count(*) from stuff') == 7
+        stats = dest.copy_table_to(sql, 'stuff', dest_table='stuff_copy')
+        assert stats['method'] == 'copy'
+        assert sql.execute('select first, second, third, fourth from stuff_copy order by first', row_format='tuple') == sql.execute(
+            'select first, second, third, fourth from stuff order by first', row_format='tuple'
+        )
+        sql.execute('drop table stuff_copy')
+        dest.dispose()
+
+    def test_copy_table_to_nulls_and_blobs(self, tmp_path):
+        source = sqh.SQL('sqlite:///' + str(tmp_path / 'source.db'))
+        source.execute('create table blobby (id integer primary key, name text, data blob)')
+        source.bulk_insert('blobby', [
+            {'id': 1, 'name': None, 'data': None},
+            {'id': 2, 'name': '', 'data': b''},
+            {'id': 3, 'name': 'a "b", c', 'data': b'\x00\xff\n'},
+        ])
+        stats = source.copy_table_to(sql, 'blobby')
+        assert stats['method'] == 'copy'
+        results = sql.execute('select name, data from blobby order by id')
+        assert [r['name'] for r in results] == [None, '', 'a "b", c']
+        assert [bytes(r['data']) if r['data'] is not None else None for r in results] == [None, b'', b'\x00\xff\n']
+        sql.execute('drop table blobby')
+        source.dispose()
+
+    def test_table_checksums(self):
+        for table in ('summed', 'summed_copy'):
+            sql.execute('create table {} (id int primary key, code varchar(10), amount float, note text)'.format(table))
+            sql.bulk_insert(table, [
+                {'id': i, 'code': 'c{:04d}'.format(i), 'amount': i / 4, 'note': None if i % 7 else 'seven'}
+                for i in range(2500)
+            ])
+        checksums = sql.table_checksums('summed', chunk_size=1000)
+        assert [c['rows'] for c in checksums] == [1000, 1000, 500]
+        assert sql.table_checksums('summed_copy', chunk_size=1000) == checksums
+        sql.execute("update summed_copy set note = 'changed' where id = 1500")
+        diff = sql.diff_tables(sql, 'summed', other_table='summed_copy', chunk_size=1000)
+        assert diff['differing_chunks'] == [1]
+        assert diff['rows_fetched'] == 2000
+        assert [(a['id'], b['note']) for a, b in diff['changed']] == [(1500, 'changed')]
+        sql.execute('drop table summed')
+        sql.execute('drop table summed_copy')
+
+    def test_estimate_counts(self):
+        sql.execute('analyze stuff')
+        counts = sql.estimate_counts()
+        table = 'public.stuff'
+        assert counts[table]['estimated'] is True
+        assert counts[table]['rows'] is not None
+        assert sql.estimate_counts(['stuff'])['stuff']['rows'] == counts[table]['rows']
+        assert sql.estimate_counts([table], exact=True)[table]['rows'] == 7
+        sizes = sql.table_sizes([table])[table]
+        assert sizes['total_bytes'] > 0
+        assert sizes['total_bytes'] >= sizes['table_bytes'] + sizes['index_bytes']
+
+    def test_sample(self):
+        sql.execute('create table sampled (id int primary key, name varchar(10))')
+        sql.bulk_insert('sampled', [{'id': i, 'name': 'n{}'.format(i)} for i in range(1, 5001)])
+        rows = sql.sample('sampled', n=50, method='keyset', seed=7)
+        assert len(set(row['id'] for row in rows)) == 50
+        assert sql.sample('sampled', n=50, method='keyset', seed=7) == rows
+        sql.execute('analyze sampled')
+        rows = sql.sample('sampled', n=100, method='bernoulli', seed=1)
+        assert 0 < len(rows) <= 100
+        assert sql.sample('sampled', n=100, method='bernoulli', seed=1) == rows
+        assert len(sql.sample('sampled', fraction=1, method='system')) == 5000
+        sql.execute('drop table sampled')
+
     def test_clear_db(self):
         """This MUST be the final test since it's the new teardown"""
         sql.execute('drop table stuff')
@@ -1,5 +1,13 @@
+import gzip
+import json
 import pytest
+import subprocess
+import sys
+import threading
 import sql_helper as sqh
+from datetime import date
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 
 
 sqlite_url = sqh.SETTINGS.get('sqlite_url')
@@ -33,6 +41,828 @@ class TestSqlite:
         timestamp_columns = sql.get_timestamp_columns('stuff', name_only=True)
         assert timestamp_columns == ['third', 'fourth']
 
+    def test_iter_execute(self):
+        sql.insert('stuff', [{'first': i, 'second': i / 2} for i in range(2500)])
+        rows = sql.iter_execute('select first from stuff', batch_size=1000)
+        assert not isinstance(rows, list)
+        assert list(rows) == list(range(2500))
+        batches = list(sql.iter_execute('select first, second from stuff', batch_size=1000, batches=True))
+        assert [len(batch) for batch in batches] == [1000, 1000, 500]
+        assert batches[2][-1] == {'first': 2499, 'second': 1249.5}
+        assert list(sql.iter_execute('select first from stuff where first < :x', {'x': 3})) == [0, 1, 2]
+        assert list(sql.iter_execute('delete from stuff')) == []
+        assert sql.execute('select count(*) from stuff') == 0
+
+    def test_bulk_insert(self):
+        rows = ({'first': i, 'second': i * 1.5} for i in range(12345))
+        stats = sql.bulk_insert('stuff', rows, chunk_size=5000)
+        assert stats['rows'] == 12345
+        assert stats['chunks'] == 3
+        assert stats['rows_per_second'] > 0
+        assert stats['statement'] == 'insert into stuff (first, second) values (:first, :second)'
+        assert sql.execute('select count(*) from stuff') == 12345
+        assert sql.execute('select second from stuff where first = 10') == [15.0]
+        assert sql.bulk_insert('stuff', [])['rows'] == 0
+        sql.execute('delete from stuff')
+
+    def test_load(self, tmp_path):
+        csv_path = str(tmp_path / 'stuff.csv')
+        with open(csv_path, 'w') as fp:
+            fp.write('second,first\n1.5,1\n,2\n3.5,3\n')
+        stats = sql.load('stuff', csv_path, chunk_size=2)
+        assert stats['format'] == 'csv'
+        assert stats['method'] == 'executemany'
+        assert stats['rows'] == 3
+        assert sql.execute('select first, second from stuff order by first') == [
+            {'first': 1, 'second': 1.5},
+            {'first': 2, 'second': None},
+            {'first': 3, 'second': 3.5},
+        ]
+        jsonl_path = str(tmp_path / 'stuff.jsonl')
+        with open(jsonl_path, 'w') as fp:
+            fp.write('{"first": 4, "third": "2022-05-05"}\n{"first": 5}\n')
+        assert sql.load('stuff', jsonl_path)['rows'] == 2
+        assert sql.load('stuff', ({'first': i} for i in range(6, 10)))['rows'] == 4
+        assert sql.execute('select count(*) from stuff') == 9
+        with pytest.raises(ValueError):
+            sql.load('stuff', [{'first': 1, 'bogus': 2}])
+        sql.execute('delete from stuff')
+
+    def test_load_csv_empty_fields(self, tmp_path):
+        sql.execute('create table emptied (id int, name varchar(20))')
+        csv_path = str(tmp_path / 'emptied.csv')
+        with open(csv_path, 'w') as fp:
+            fp.write('id,name\n1,""\n2,\n3,x\n')
+        assert sql.load('emptied', csv_path)['method'] == 'executemany'
+        with open(csv_path) as fp:
+            sql.load('emptied', fp)
+        assert sql.execute('select name from emptied order by id, name') == [None, None, None, None, 'x', 'x']
+        sql.execute('drop table emptied')
+
+    def test_export(self, tmp_path):
+        sql.bulk_insert('stuff', ({'first': i, 'second': i / 4} for i in range(2500)))
+        csv_path = str(tmp_path / 'stuff.csv.gz')
+        stats = sql.export('stuff', csv_path, chunk_size=1000)
+        assert stats['format'] == 'csv'
+        assert stats['rows'] == 2500
+        assert stats['bytes'] > 0
+        with gzip.open(csv_path, 'rt') as fp:
+            lines = fp.read().splitlines()
+        assert lines[0] == 'first,second,third,fourth'
+        assert lines[2] == '1,0.25,,'
+        assert len(lines) == 2501
+        jsonl_path = str(tmp_path / 'stuff.jsonl')
+        stats = sql.export('select first from stuff where first < :x', jsonl_path, params={'x': 3})
+        assert stats['rows'] == 3
+        with open(jsonl_path) as fp:
+            assert [json.loads(line) for line in fp] == [{'first': 0}, {'first': 1}, {'first': 2}]
+        with pytest.raises(ValueError):
+            sql.export('stuff', str(tmp_path / 'stuff.xlsx'))
+        empty_path = str(tmp_path / 'empty.csv')
+        stats = sql.export('select first, second from stuff where first < 0', empty_path)
+        assert stats['rows'] == 0
+        with open(empty_path) as fp:
+            assert fp.read().splitlines() == ['first,second']
+
+    def test_export_parquet(self, tmp_path):
+        pq = pytest.importorskip('pyarrow.parquet')
+        parquet_path = str(tmp_path / 'stuff.parquet')
+        stats = sql.export('select first, second from stuff', parquet_path, chunk_size=1000)
+        assert stats['rows'] == 2500
+        table = pq.read_table(parquet_path)
+        assert table.num_rows == 2500
+        assert table.column_names == ['first', 'second']
+        assert table.column('second')[10].as_py() == 2.5
+        sql.execute("update stuff set third = '2024-01-02' where first = 2400")
+        stats = sql.export('stuff', parquet_path, chunk_size=1000)
+        assert stats['rows'] == 2500
+        table = pq.read_table(parquet_path)
+        assert [v for v in table.column('third').to_pylist() if v is not None] == [date(2024, 1, 2)]
+        empty_path = str(tmp_path / 'empty.parquet')
+        stats = sql.export('select first, second from stuff where first < 0', empty_path)
+        assert stats['rows'] == 0
+        table = pq.read_table(empty_path)
+        assert (table.num_rows, table.column_names) == (0, ['first', 'second'])
+        sql.execute('delete from stuff')
+
+    def test_metadata_cache(self):
+        cached = sqh.SQL(sqlite_url, metadata_cache=True, metadata_cache_size=2)
+        cached.execute('create table meta_stuff (a int, b date)')
+        assert 'meta_stuff' in cached.get_tables()
+        assert cached.get_columns('meta_stuff', name_only=True) == ['a', 'b']
+        assert cached.get_timestamp_columns('meta_stuff', name_only=True) == ['b']
+        stats = cached.get_cache_stats()['metadata']
+        assert (stats['hits'], stats['misses']) == (1, 2)
+        cached.execute('alter table meta_stuff add column c datetime')
+        assert cached.get_columns('meta_stuff', name_only=True) == ['a', 'b', 'c']
+        cached.get_indexes('meta_stuff').append({'name': 'bogus'})
+        assert cached.get_indexes('meta_stuff') == []
+        cached.execute('create index ix_meta_stuff_a on meta_stuff (a)')
+        cached.get_indexes('meta_stuff')[0]['column_names'].append('bogus')
+        assert cached.get_indexes('meta_stuff')[0]['column_names'] == ['a']
+        cached.get_columns('meta_stuff')[0]['name'] = 'bogus'
+        assert cached.get_columns('meta_stuff', name_only=True) == ['a', 'b', 'c']
+        cached.get_tables()
+        assert cached.get_cache_stats()['metadata']['evictions'] == 1
+        cached.execute('drop table meta_stuff')
+        assert 'meta_stuff' not in cached.get_tables()
+        assert 'metadata' not in sql.get_cache_stats()
+
+    def test_describe_all(self):
+        sql.execute('create table described (id integer primary key, a int not null, b varchar(20) default \'x\', c datetime)')
+        sql.execute('create unique index ix_described_b on described (b)')
+        expected_columns = sql.get_columns('described')
+        snapshot = sql.describe_all()
+        assert sorted(snapshot.get_tables()) == ['described', 'stuff']
+        assert snapshot.get_primary_key('described') == ['id']
+        assert snapshot.get_indexes('described') == [{'name': 'ix_described_b', 'column_names': ['b'], 'unique': 1}]
+        snapshot.get_indexes('described')[0]['column_names'].append('bogus')
+        assert snapshot.get_indexes('described')[0]['column_names'] == ['b']
+        columns = sql.get_columns('described')
+        assert [c['name'] for c in columns] == [c['name'] for c in expected_columns]
+        assert [c['nullable'] for c in columns] == [c['nullable'] for c in expected_columns]
+        assert [c['default'] for c in columns] == [c['default'] for c in expected_columns]
+        assert [type(c['type']) for c in columns] == [type(c['type']) for c in expected_columns]
+        assert sql.get_timestamp_columns('described', name_only=True) == ['c']
+        assert sql.get_required_columns('described', name_only=True) == ['a']
+        assert sql._schema is snapshot
+        sql.execute('drop table described')
+        assert sql._schema is None
+        assert sql.get_tables() == ['stuff']
+
+    def test_result_cache(self, tmp_path):
+        cached = sqh.SQL(sqlite_url, result_cache=True, result_cache_size=2)
+        sql.insert('stuff', [{'first': 1}, {'first': 2}])
+        assert cached.execute('select first from stuff') == [1, 2]
+        assert cached.execute('select  first\nfrom stuff') == [1, 2]
+        assert cached.get_cache_stats()['results']['hits'] == 1
+        sql.insert('stuff', {'first': 3})
+        assert cached.execute('select first from stuff') == [1, 2]
+        assert cached.execute('select first from stuff', cache=False) == [1, 2, 3]
+        cached.insert('stuff', {'first': 4})
+        assert cached.execute('select first from stuff') == [1, 2, 3, 4]
+        assert cached.execute('select first from stuff where first > :x', {'x': 2}) == [3, 4]
+        assert cached.execute('select first from stuff where first > :x', {'x': 3}) == [4]
+        assert cached.get_cache_stats()['results']['evictions'] == 1
+        assert cached.execute('select count(*) from stuff', cache_ttl=0) == 4
+        assert cached.execute('select count(*) from stuff', cache_ttl=0) == 4
+        assert cached.get_cache_stats()['results']['hits'] == 2
+        cached.execute('with doomed as (select 4 as x) delete from stuff where first in (select x from doomed)')
+        assert cached.execute('select count(*) from stuff', cache_ttl=0) == 3
+        sql.insert('stuff', {'first': 4})
+        assert cached.execute('select count(*) from stuff') == 4
+        with cached.transaction():
+            cached.insert('stuff', {'first': 5})
+            # another thread can still read (and cache) the rows from before the commit
+            reader = threading.Thread(target=cached.execute, args=('select count(*) from stuff',))
+            reader.start()
+            reader.join()
+        assert cached.execute('select count(*) from stuff') == 5
+        sql.execute('delete from stuff where first = 5')
+
+        cache_path = str(tmp_path / 'cache.db')
+        disk_cached = sqh.SQL(sqlite_url, result_cache_path=cache_path)
+        assert disk_cached.execute('select first from stuff where first < 3') == [1, 2]
+        disk_cached2 = sqh.SQL(sqlite_url, result_cache_path=cache_path)
+        assert disk_cached2.execute('select first from stuff where first < 3') == [1, 2]
+        assert disk_cached2.get_cache_stats()['results']['hits'] == 1
+        other_db = sqh.SQL('sqlite:///' + str(tmp_path / 'other.db'), result_cache_path=cache_path)
+        other_db.execute('create table stuff (first int)')
+        assert other_db.execute('select first from stuff where first < 3') == []
+        other_db.dispose()
+        disk_cached2.execute('delete from stuff')
+        assert disk_cached2.get_cache_stats()['results']['size'] == 0
+
+        tagged = sqh._SqliteCache(str(tmp_path / 'tagged.db'), 10, 60)
+        tagged.set('a', b'1', tags=['userxlog'])
+        tagged.set('b', b'2', tags=['user_log', 'other'])
+        tagged.set('c', b'3', tags=['user%'])
+        assert tagged.invalidate_tags(['user_log']) == 1
+        assert tagged.invalidate_tags(['user%']) == 1
+        assert tagged.keys() == ['a']
+
+    def test_transaction(self):
+        with sql.transaction() as conn:
+            sql.insert('stuff', {'first': 1})
+            sql.bulk_insert('stuff', [{'first': 2}, {'first': 3}], chunk_size=1)
+            assert sql.execute('select count(*) from stuff') == 3
+            assert list(sql.iter_execute('select first from stuff')) == [1, 2, 3]
+            with sql.transaction() as inner_conn:
+                assert inner_conn is conn
+        assert sql.execute('select first from stuff') == [1, 2, 3]
+        with pytest.raises(ZeroDivisionError):
+            with sql.transaction():
+                sql.execute('delete from stuff')
+                assert sql.execute('select count(*) from stuff') == 0
+                1 / 0
+        assert sql.execute('select count(*) from stuff') == 3
+
+    def test_connection(self):
+        checkouts = []
+
+        def on_checkout(*args):
+            checkouts.append(1)
+
+        event.listen(sql._engine, 'checkout', on_checkout)
+        with pytest.raises(ZeroDivisionError):
+            with sql.connection():
+                sql.execute('delete from stuff where first = 1')
+                sql.insert('stuff', {'first': 4})
+                assert sql.execute('select first from stuff') == [2, 3, 4]
+                1 / 0
+        event.remove(sql._engine, 'checkout', on_checkout)
+        assert len(checkouts) == 1
+        assert sql.execute('select first from stuff') == [2, 3, 4]
+        with sql.connection():
+            for first in sql.iter_execute('select first from stuff where first < 10', batch_size=2):
+                sql.insert('stuff', {'first': first * 10})
+                assert list(sql.iter_execute('select first from stuff where first = 2')) == [2]
+        assert sql.execute('select first from stuff') == [2, 3, 4, 20, 30, 40]
+        sql.execute('delete from stuff')
+
+    def test_statement_cache(self, tmp_path, monkeypatch):
+        checked = []
+        monkeypatch.setattr(sqh, 'isfile', lambda path: checked.append(path) or False)
+        statement_cache = sqh.SQL(sqlite_url)._statement_cache
+        monkeypatch.setattr(sql, '_statement_cache', statement_cache)
+        for i in range(3):
+            sql.insert('stuff', {'first': i})
+            assert sql.execute('select count(*) from stuff where first = :i', {'i': i}) == 1
+        assert checked == []
+        stats = sql.get_cache_stats()['statements']
+        assert stats['hits'] == 6
+        assert stats['misses'] == 3
+        script_path = str(tmp_path / 'script.sql')
+        with open(script_path, 'w') as fp:
+            fp.write('select first from stuff')
+        monkeypatch.undo()
+        assert sql.execute_script(script_path) == [0, 1, 2]
+        assert sql.execute(script_path) == [0, 1, 2]
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'load').mkdir()
+        for name in ('create.sql', 'load/select.sql'):
+            with open(name, 'w') as fp:
+                fp.write('select first from stuff')
+            assert sql.execute(name) == [0, 1, 2]
+        monkeypatch.undo()
+        sql.execute('delete from stuff')
+
+    def test_row_formats(self):
+        sql.insert('stuff', [{'first': i, 'second': i / 2, 'third': '2024-01-0{}'.format(i + 1)} for i in range(3)])
+        statement = 'select first, second, third from stuff order by first'
+        assert sql.execute(statement, row_format='tuple') == [
+            ('first', 'second', 'third'),
+            (0, 0.0, '2024-01-01'), (1, 0.5, '2024-01-02'), (2, 1.0, '2024-01-03'),
+        ]
+        records = sql.execute(statement, row_format='record')
+        assert [r.first for r in records] == [0, 1, 2]
+        assert records[1]._asdict() == {'first': 1, 'second': 0.5, 'third': '2024-01-02'}
+        assert sql.execute('select count(*) from stuff', row_format='record')[0][0] == 3
+        assert sql.execute('select first from stuff where first in (1)', row_format='dict') == [{'first': 1}]
+        columns = sql.execute(statement, row_format='columns')
+        assert list(columns.keys()) == ['first', 'second', 'third']
+        assert columns['first'].typecode == 'q'
+        assert list(columns['first']) == [0, 1, 2]
+        assert columns['second'].typecode == 'd'
+        assert columns['third'] == ['2024-01-01', '2024-01-02', '2024-01-03']
+        assert sql.execute('select first from stuff where first > 5', row_format='tuple') == [('first',)]
+        assert sql.execute('select first from stuff where first > 5', row_format='columns') == {'first': []}
+        assert sql.execute('update stuff set fourth = null', row_format='tuple') == []
+        with pytest.raises(ValueError):
+            sql.execute(statement, row_format='nope')
+
+        rows = list(sql.iter_execute(statement, batch_size=2, row_format='tuple'))
+        assert rows[0] == ('first', 'second', 'third')
+        assert len(rows) == 4
+        batches = list(sql.iter_execute(statement, batch_size=2, row_format='record', batches=True))
+        assert [len(b) for b in batches] == [2, 1]
+        assert batches[1][0].third == '2024-01-03'
+        chunks = list(sql.iter_execute(statement, batch_size=2, row_format='columns'))
+        assert [list(c['first']) for c in chunks] == [[0, 1], [2]]
+        sql.execute('delete from stuff')
+
+    def test_to_arrow(self):
+        pa = pytest.importorskip('pyarrow')
+        sql.insert('stuff', [
+            {'first': i, 'second': i / 2, 'third': '2024-01-0{}'.format(i + 1)}
+            for i in range(3)
+        ] + [{'first': None, 'second': None, 'third': None}])
+        table = sql.to_arrow('stuff')
+        assert table.column_names == ['first', 'second', 'third', 'fourth']
+        assert table.num_rows == 4
+        assert table.schema.field('first').type == pa.int64()
+        assert table.schema.field('second').type == pa.float64()
+        assert table.schema.field('third').type == pa.date32()
+        assert table.column('first').null_count == 1
+        table = sql.to_arrow('select first, second * 2 as double from stuff where first is not null order by first')
+        assert table.schema.field('first').type == pa.int64()
+        assert table.column('double').to_pylist() == [0.0, 1.0, 2.0]
+        chunks = list(sql.to_arrow('select first from stuff where first >= :low', {'low': 0}, chunksize=2))
+        assert [chunk.num_rows for chunk in chunks] == [2, 1]
+        assert chunks[1].schema == chunks[0].schema
+        empty = sql.to_arrow('select first, third from stuff where first > 100')
+        assert empty.num_rows == 0
+        assert empty.schema.field('third').type == pa.date32()
+
+    def test_to_dataframe(self, monkeypatch):
+        pytest.importorskip('pandas')
+        df = sql.to_dataframe('stuff')
+        assert list(df.columns) == ['first', 'second', 'third', 'fourth']
+        assert len(df) == 4
+        chunks = list(sql.to_dataframe('select first from stuff order by first', chunksize=3))
+        assert [len(chunk) for chunk in chunks] == [3, 1]
+        monkeypatch.setitem(sys.modules, 'pyarrow', None)
+        df = sql.to_dataframe('select first, second, third from stuff order by first')
+        assert str(df['first'].dtype) == 'Int64'
+        assert df['first'].isna().sum() == 1
+        assert str(df['second'].dtype) == 'float64'
+        assert str(df['third'].dtype).startswith('datetime64')
+        chunks = list(sql.to_dataframe('stuff', chunksize=3))
+        assert [len(chunk) for chunk in chunks] == [3, 1]
+        sql.execute('delete from stuff')
+
+    def test_stats(self, caplog):
+        assert sql.stats() == {}
+        exported = []
+        instrumented = sqh.SQL(sqlite_url, slow_query_seconds=0, stats_exporter=exported.append)
+        for i in range(5):
+            instrumented.insert('stuff', {'first': i})
+            instrumented.execute('select first from stuff where first = {}'.format(i))
+        with pytest.raises(sqh.OperationalError):
+            instrumented.execute('select nope from stuff')
+        assert len(list(instrumented.iter_execute('select second from stuff', batch_size=2))) == 5
+        stats = instrumented.stats()
+        assert stats['select second from stuff']['rows'] == 5
+        select_stats = stats['select first from stuff where first = ?']
+        assert select_stats['calls'] == 5
+        assert select_stats['rows'] == 5
+        assert select_stats['p50'] <= select_stats['p95'] <= select_stats['p99'] <= select_stats['max_seconds']
+        assert select_stats['pool_wait_p99'] is not None
+        insert_stats = stats['insert into stuff (first) values (?)']
+        assert insert_stats['calls'] == 5
+        assert insert_stats['rows'] == 5
+        assert stats['select nope from stuff']['errors'] == 1
+        assert len(exported) == 12
+        assert exported[0]['slow'] is True
+        assert any(record.message.startswith('Slow query') for record in caplog.records)
+        assert instrumented.stats(reset=True)
+        assert instrumented.stats() == {}
+        instrumented._engine.dispose()
+        sql.execute('delete from stuff')
+
+    def test_explain(self, caplog):
+        sql.insert('stuff', [{'first': i, 'second': i / 2} for i in range(10)])
+        explained = sql.explain('select * from stuff where first = :first', {'first': 3})
+        assert explained['db_type'] == 'sqlite'
+        assert explained['full_scans'] == ['stuff']
+        assert explained['indexes'] == []
+        scan = explained['plan']['children'][0]
+        assert scan['operation'] == 'SCAN'
+        assert scan['relation'] == 'stuff'
+        assert scan['full_scan'] is True
+        sql.execute('create index stuff_first_idx on stuff (first)')
+        explained = sql.explain('select * from stuff where first = :first', {'first': 3}, analyze=True)
+        assert explained['full_scans'] == []
+        assert explained['indexes'] == ['stuff_first_idx']
+        assert explained['plan']['children'][0]['operation'] == 'SEARCH'
+        assert explained['plan']['children'][0]['uses_index'] is True
+        assert explained['plan']['actual_rows'] == 1
+        explained = sql.explain('delete from stuff', analyze=True)
+        assert sql.execute('select count(*) from stuff') == 10
+
+        slow = sqh.SQL(sqlite_url, explain_slow_seconds=0)
+        slow.execute('select first from stuff where second > :x', {'x': 1})
+        slow.execute('drop index stuff_first_idx')
+        plans = slow.slow_plans(clear=True)
+        assert len(plans) == 1
+        assert plans[0]['explain']['full_scans'] == ['stuff']
+        assert plans[0]['params'] == {'x': 1}
+        assert slow.slow_plans() == []
+        assert any(record.message.startswith('Slow statement') for record in caplog.records)
+        slow._engine.dispose()
+        sql.execute('delete from stuff')
+
+    def test_lazy_startup(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, sql_helper as sqh; '
+            'sql = sqh.SQL("sqlite:///" + sys.argv[1], connect_timeout=5, pool_options={}); '
+            'print(sorted(m for m in ("bg_helper", "settings_helper", "sqlalchemy.ext.asyncio") if m in sys.modules)); '
+            'print(sql._inspector_instance is None)',
+            sql._engine.url.database
+        ])
+        assert output.decode('utf-8').split() == ['[]', 'True']
+        lazy = sqh.SQL(sqlite_url)
+        assert lazy._inspector_instance is None
+        assert lazy.warm(connections=2) is lazy
+        assert lazy._inspector_instance is not None
+        assert lazy.get_columns('stuff', name_only=True) == ['first', 'second', 'third', 'fourth']
+        lazy._engine.dispose()
+
+    def test_run_script(self, tmp_path):
+        script_path = str(tmp_path / 'seed.sql.gz')
+        with gzip.open(script_path, 'wt') as fp:
+            fp.write('-- seed data\n')
+            fp.write('create table script_stuff (a int, b text);\n')
+            for i in range(25):
+                fp.write("insert into script_stuff values ({}, 'semi;colon :not_a_param {}');\n".format(i, i))
+            fp.write("/* block; comment */ insert into script_stuff values (100, 'it''s;\nmultiline');\n")
+        stats = sql.run_script(script_path, batch_size=10)
+        assert stats['statements'] == 27
+        assert stats['batches'] == 3
+        assert stats['errors'] == []
+        assert sql.execute('select count(*) from script_stuff') == 26
+        assert sql.execute('select b from script_stuff where a = 100') == ["it's;\nmultiline"]
+        assert 'script_stuff' in sql.get_tables()
+
+        bad_path = str(tmp_path / 'bad.sql')
+        with open(bad_path, 'w') as fp:
+            fp.write('insert into script_stuff values (200, 0);\n')
+            fp.write('insert into nope values (1);\n')
+            fp.write('insert into script_stuff values (201, 0);\n')
+        with pytest.raises(sqh.ScriptError) as excinfo:
+            sql.run_script(bad_path)
+        assert excinfo.value.line_number == 2
+        assert excinfo.value.statement == 'insert into nope values (1)'
+        assert sql.execute('select count(*) from script_stuff where a >= 200') == 0
+        stats = sql.run_script(bad_path, stop_on_error=False)
+        assert stats['statements'] == 2
+        assert [error['line_number'] for error in stats['errors']] == [2]
+        assert sql.execute('select count(*) from script_stuff where a >= 200') == 2
+        sql.execute('drop table script_stuff')
+
+    def test_execute_many_parallel(self):
+        statements = [
+            'select count(*) from stuff',
+            ('select :x as x', {'x': 5}),
+            'select * from no_such_table',
+            'select first from stuff',
+        ]
+        stats = sql.execute_many_parallel(statements, max_workers=3)
+        assert [item['index'] for item in stats['results']] == [0, 1, 2, 3]
+        assert [item['result'] for item in stats['results']] == [0, [5], None, []]
+        assert stats['errors'] == 1
+        assert 'no_such_table' in stats['results'][2]['error']
+        assert stats['results'][1]['params'] == {'x': 5}
+        assert all(item['seconds'] is not None for item in stats['results'])
+        assert stats['statement_seconds'] > 0
+        assert stats['speedup'] is not None
+
+        slow = (
+            'with recursive c(x) as (select 1 union all select x + 1 from c where x < 3000000) '
+            'select count(*) from c'
+        )
+        slow_seconds = sql.execute_many_parallel([slow])['statement_seconds']
+        invalidations = sql.pool_stats()['invalidations']
+        stats = sql.execute_many_parallel([slow, 'select 1', slow], max_workers=2, ordered=False, timeout=0.2)
+        assert [item['index'] for item in stats['results']] == [1, 0, 2]
+        assert stats['results'][0]['result'] == [1]
+        assert stats['results'][1]['error'].startswith('Timed out')
+        assert stats['results'][2]['error'].startswith('Timed out')
+        # the slow statements were interrupted instead of running to the end
+        assert stats['seconds'] < slow_seconds
+        assert not [t for t in threading.enumerate() if t.name.startswith('sql-helper-parallel')]
+        assert sql.pool_stats()['invalidations'] == invalidations + 2
+        assert sql.execute_many_parallel([]) == {
+            'results': [], 'errors': 0, 'seconds': 0.0, 'statement_seconds': 0.0,
+            'speedup': None,
+        }
+
+    def test_iter_table(self):
+        sql.execute('create table paged (a int, b int, c text, primary key (a, b))')
+        sql.bulk_insert('paged', [{'a': i // 10, 'b': i % 10, 'c': str(i)} for i in range(95)])
+        assert sql.get_primary_key('paged') == ['a', 'b']
+        pages = sql.iter_table('paged', batch_size=20)
+        assert pages.token is None
+        batches = list(pages)
+        assert [len(batch) for batch in batches] == [20, 20, 20, 20, 15]
+        assert [row['c'] for batch in batches for row in batch] == [str(i) for i in range(95)]
+        assert pages.rows == 95
+        assert json.loads(pages.token) == {'table': 'paged', 'key': ['a', 'b'], 'after': [9, 4]}
+
+        pages = sql.iter_table('paged', batch_size=30, where='b < :b', params={'b': 5}, columns=['c'])
+        first = next(iter(pages))
+        assert list(first[0].keys()) == ['a', 'b', 'c']
+        resumed = list(sql.iter_table('paged', batch_size=30, where='b < :b', params={'b': 5}, start_after=pages.token))
+        assert [row['c'] for row in first + resumed[0]] == [str(i) for i in range(95) if i % 10 < 5]
+        tail = list(sql.iter_table('paged', key=['a', 'b'], start_after=[9, 1], batch_size=5))
+        assert [row['c'] for row in tail[0]] == ['92', '93', '94']
+        with pytest.raises(ValueError):
+            sql.iter_table('paged', key='a', start_after=pages.token)
+
+        rows = [row for batch in sql.iter_table('stuff', batch_size=2) for row in batch]
+        assert rows == sql.execute('select * from stuff', row_format='dict')
+        sql.execute('drop table paged')
+
+        sql.execute('create table unkeyed (name text, amount int)')
+        sql.bulk_insert('unkeyed', [{'name': 'n{}'.format(i), 'amount': i} for i in range(25)])
+        pages = sql.iter_table('unkeyed', batch_size=10)
+        batches = list(pages)
+        assert [len(batch) for batch in batches] == [10, 10, 5]
+        assert [row['amount'] for batch in batches for row in batch] == list(range(25))
+        assert list(batches[0][0].keys()) == ['rowid', 'name', 'amount']
+        assert json.loads(pages.token)['after'] == [25]
+        sql.execute('drop table unkeyed')
+
+    def test_extract_incremental(self, tmp_path):
+        state_path = str(tmp_path / 'state.json')
+        sql.execute('create table events (id integer primary key, name text, updated_at datetime)')
+        sql.execute('create index ix_events_updated_at on events (updated_at)')
+        sql.bulk_insert('events', [
+            {'id': i, 'name': 'e{}'.format(i), 'updated_at': '2024-01-01 00:00:{:02d}.000000'.format(i // 2)}
+            for i in range(20)
+        ])
+        assert sql.get_watermark_column('events') == 'updated_at'
+        batches = list(sql.extract_incremental('events', state_path, batch_size=7))
+        assert [len(batch) for batch in batches] == [7, 7, 6]
+        state = json.loads(open(state_path).read())['events']
+        assert state['column'] == 'updated_at'
+        assert state['watermark']['value'] == '2024-01-01 00:00:09.000000'
+        assert state['rows'] == 20
+        assert list(sql.extract_incremental('events', state_path)) == []
+
+        sql.insert('events', [
+            {'id': 20, 'name': 'new', 'updated_at': '2024-01-01 00:00:10.000000'},
+            {'id': 21, 'name': 'late', 'updated_at': '2024-01-01 00:00:08.500000'},
+        ])
+        rows = [row for batch in sql.extract_incremental('events', state_path) for row in batch]
+        assert [row['name'] for row in rows] == ['new']
+        sql.execute("update events set updated_at = '2024-01-01 00:00:10.500000' where id = 21")
+        sql.insert('events', {'id': 22, 'name': 'late2', 'updated_at': '2024-01-01 00:00:09.500000'})
+        rows = [row for batch in sql.extract_incremental('events', state_path, overlap=1, columns=['name']) for row in batch]
+        assert [row['name'] for row in rows] == ['late2', 'new', 'late']
+        assert list(rows[0].keys()) == ['updated_at', 'name']
+
+        interrupted = sql.extract_incremental('events', str(tmp_path / 'other.json'), batch_size=3)
+        next(interrupted)
+        next(interrupted)
+        interrupted.close()
+        saved = json.loads(open(str(tmp_path / 'other.json')).read())['events']
+        assert saved['watermark']['value'] == '2024-01-01 00:00:00.000000'
+        rows = [row for batch in sql.extract_incremental('events', str(tmp_path / 'other.json'), column='updated_at') for row in batch]
+        assert rows[0]['id'] == 2
+        with pytest.raises(ValueError):
+            list(sql.extract_incremental('events', str(tmp_path / 'other.json'), column='id'))
+        assert sql.get_watermark_column('stuff') == 'third'
+        sql.execute('drop table events')
+
+    def test_save_state_processes(self, tmp_path):
+        state_path = str(tmp_path / 'state.json')
+        code = (
+            'import sys, sql_helper as sqh\n'
+            'for i in range(30):\n'
+            '    sqh._save_state(sys.argv[1], sys.argv[2], {"count": i + 1})\n'
+        )
+        processes = [
+            subprocess.Popen([sys.executable, '-c', code, state_path, 'table{}'.format(i)])
+            for i in range(4)
+        ]
+        assert [process.wait() for process in processes] == [0, 0, 0, 0]
+        state = json.loads(open(state_path).read())
+        assert state == {'table{}'.format(i): {'count': 30} for i in range(4)}
+
+    def test_copy_table_to(self, tmp_path):
+        sql.execute('create table copied (id integer primary key, d date, dt datetime, n numeric(10, 2), s text)')
+        sql.bulk_insert('copied', [
+            {'id': i, 'd': '2024-01-{:02d}'.format(i % 28 + 1), 'dt': '2024-01-01 10:00:{:02d}.000000'.format(i % 60),
+             'n': i / 4, 's': 'row {}'.format(i)}
+            for i in range(250)
+        ])
+        dest = sqh.SQL('sqlite:///' + str(tmp_path / 'dest.db'))
+        stats = sql.copy_table_to(dest, 'copied', batch_size=40, queue_size=1, where='id >= :low', params={'low': 10})
+        assert stats['created'] is True
+        assert stats['method'] == 'executemany'
+        assert (stats['rows'], stats['batches']) == (240, 6)
+        assert dest.get_columns('copied', name_only=True) == ['id', 'd', 'dt', 'n', 's']
+        assert dest.get_primary_key('copied') == ['id']
+        assert dest.execute('select * from copied order by id', row_format='dict') == sql.execute(
+            'select * from copied where id >= 10 order by id', row_format='dict'
+        )
+        stats = sql.copy_table_to(dest, 'copied', dest_table='copied_again', where='id < 5')
+        assert stats['rows'] == 5
+        assert dest.execute('select count(*) from copied_again') == 5
+        stats = sql.copy_table_to(dest, 'copied', dest_table='copied_again', where='id = 5')
+        assert stats['created'] is False
+        assert dest.execute('select count(*) from copied_again') == 6
+        with pytest.raises(IntegrityError):
+            sql.copy_table_to(dest, 'copied', dest_table='copied_again', batch_size=10)
+        dest.dispose()
+        sql.execute('drop table copied')
+
+    def test_copy_table_to_nulls_and_blobs(self, tmp_path):
+        source = sqh.SQL('sqlite:///' + str(tmp_path / 'source.db'))
+        dest = sqh.SQL('sqlite:///' + str(tmp_path / 'dest.db'))
+        source.execute('create table blobby (id integer primary key, name text, data blob)')
+        source.bulk_insert('blobby', [
+            {'id': 1, 'name': None, 'data': None},
+            {'id': 2, 'name': '', 'data': b''},
+            {'id': 3, 'name': 'a "b", c', 'data': b'\x00\xff\n'},
+        ])
+        stats = source.copy_table_to(dest, 'blobby')
+        assert stats['method'] == 'executemany'
+        results = dest.execute('select name, data from blobby order by id')
+        assert [r['name'] for r in results] == [None, '', 'a "b", c']
+        assert [bytes(r['data']) if r['data'] is not None else None for r in results] == [None, b'', b'\x00\xff\n']
+        dest.dispose()
+        source.dispose()
+
+    def test_copy_table_to_memory(self, tmp_path):
+        source = sqh.SQL('sqlite://')
+        source.execute('create table remembered (id integer primary key, name text)')
+        source.bulk_insert('remembered', [{'id': i, 'name': 'n{}'.format(i)} for i in range(25)])
+        dest = sqh.SQL('sqlite:///' + str(tmp_path / 'dest.db'))
+        stats = source.copy_table_to(dest, 'remembered', batch_size=10)
+        assert (stats['rows'], stats['batches']) == (25, 3)
+        assert dest.execute('select * from remembered order by id') == source.execute(
+            'select * from remembered order by id'
+        )
+        memory_dest = sqh.SQL('sqlite://')
+        assert source.copy_table_to(memory_dest, 'remembered')['rows'] == 25
+        assert memory_dest.execute('select count(*) from remembered') == 25
+        memory_dest.dispose()
+        dest.dispose()
+        source.dispose()
+
+    def test_table_checksums(self, tmp_path, monkeypatch):
+        sql.execute('create table summed (id integer primary key, code varchar(10), amount float, note text)')
+        sql.bulk_insert('summed', [
+            {'id': i, 'code': 'c{:04d}'.format(i), 'amount': i / 3, 'note': None if i % 7 else 'seven'}
+            for i in range(-5, 2500)
+        ])
+        checksums = sql.table_checksums('summed', chunk_size=1000)
+        assert [c['chunk'] for c in checksums] == [-1, 0, 1, 2]
+        assert [c['rows'] for c in checksums] == [5, 1000, 1000, 500]
+        assert (checksums[1]['min_key'], checksums[1]['max_key']) == (0, 999)
+
+        replica = sqh.SQL('sqlite:///' + str(tmp_path / 'replica.db'))
+        sql.copy_table_to(replica, 'summed')
+        assert replica.table_checksums('summed', chunk_size=1000) == checksums
+        diff = sql.diff_tables(replica, 'summed', chunk_size=1000)
+        assert (diff['chunks'], diff['differing_chunks'], diff['rows_fetched']) == (4, [], 0)
+
+        replica.execute("update summed set note = 'changed' where id = 1500")
+        replica.execute('delete from summed where id = 10')
+        replica.insert('summed', {'id': 5000, 'code': 'new'})
+        diff = sql.diff_tables(replica, 'summed', chunk_size=1000)
+        assert diff['differing_chunks'] == [0, 1, 5]
+        assert diff['rows_fetched'] == 1000 + 999 + 1000 + 1000 + 1
+        assert [row['id'] for row in diff['missing']] == [10]
+        assert [row['id'] for row in diff['extra']] == [5000]
+        assert [(a['note'], b['note']) for a, b in diff['changed']] == [(None, 'changed')]
+
+        checksums = sql.table_checksums('summed', key='code', chunk_size=1000)
+        assert [c['rows'] for c in checksums] == [1000, 1000, 505]
+        codes = sorted('c{:04d}'.format(i) for i in range(-5, 2500))
+        assert sql._checksum_boundaries('summed', 'code', 1000) == [codes[1000], codes[2000]]
+        execute = sql._execute
+
+        def no_window_functions(statement, *args, **kwargs):
+            if 'OVER (' in statement:
+                raise sqh.OperationalError(statement, {}, Exception('near "(": syntax error'))
+            return execute(statement, *args, **kwargs)
+
+        monkeypatch.setattr(sql, '_execute', no_window_functions)
+        assert sql._checksum_boundaries('summed', 'code', 1000) == [codes[1000], codes[2000]]
+        assert sql._checksum_boundaries('summed', 'code', 2505) == []
+        monkeypatch.undo()
+        diff = sql.diff_tables(replica, 'summed', key='code', chunk_size=1000)
+        assert diff['differing_chunks'] == [0, 1, 2]
+        assert sorted(row['id'] for row in diff['extra']) == [5000]
+        replica.dispose()
+        sql.execute('drop table summed')
+
+    def test_estimate_counts(self, monkeypatch):
+        sql.execute('create table counted (id integer primary key, name text)')
+        sql.execute('create index ix_counted_name on counted (name)')
+        sql.bulk_insert('counted', [{'id': i, 'name': 'n{}'.format(i)} for i in range(1, 301)])
+        counts = sql.estimate_counts()
+        assert set(counts) == {'counted', 'stuff'}
+        assert counts['counted'] == {
+            'rows': 300, 'estimated': True, 'analyzed': None,
+            'modified_since_analyze': None, 'stale': True,
+        }
+        assert counts['stuff']['rows'] == 0
+        execute = sql._execute
+
+        def no_dbstat(statement, *args, **kwargs):
+            if 'dbstat' in statement:
+                raise sqh.OperationalError(statement, {}, Exception('no such table: dbstat'))
+            return execute(statement, *args, **kwargs)
+
+        monkeypatch.setattr(sql, '_execute', no_dbstat)
+        counts = sql.estimate_counts(['counted', 'stuff'])
+        assert (counts['counted']['rows'], counts['stuff']['rows']) == (300, 0)
+        monkeypatch.undo()
+        sql.execute('analyze')
+        counts = sql.estimate_counts(['counted'])
+        assert (counts['counted']['rows'], counts['counted']['stale']) == (300, False)
+        exact = sql.estimate_counts(['counted', 'stuff'], exact=True)
+        assert exact['counted']['rows'] == 300
+        assert exact['stuff'] == {
+            'rows': 0, 'estimated': False, 'analyzed': None,
+            'modified_since_analyze': None, 'stale': False,
+        }
+        sizes = sql.table_sizes(['counted'])['counted']
+        assert sizes['rows'] == 300
+        if sizes['total_bytes'] is not None:
+            assert sizes['total_bytes'] == sizes['table_bytes'] + sizes['index_bytes']
+            assert sizes['index_bytes'] > 0
+        sql.execute('drop table counted')
+        sql.execute('drop table if exists sqlite_stat1')
+
+    def test_sample(self):
+        sql.execute('create table sampled (id integer primary key, name text)')
+        sql.bulk_insert('sampled', [{'id': i, 'name': 'n{}'.format(i)} for i in range(1, 5001)])
+        statements = []
+
+        @event.listens_for(sql._engine, 'before_cursor_execute')
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        try:
+            rows = sql.sample('sampled', n=50, seed=7)
+        finally:
+            event.remove(sql._engine, 'before_cursor_execute', capture)
+        assert len(rows) == 50
+        assert len(set(row['id'] for row in rows)) == 50
+        assert [row['id'] for row in rows] == sorted(row['id'] for row in rows)
+        assert not any('random()' in statement.lower() for statement in statements)
+        assert sql.sample('sampled', n=50, seed=7) == rows
+        assert sql.sample('sampled', n=50, seed=8) != rows
+        rows = sql.sample('sampled', fraction=0.01, seed=1, columns=['name'])
+        assert len(rows) == 50
+        assert list(rows[0].keys()) == ['id', 'name']
+        assert len(sql.sample('sampled', n=10000)) == 5000
+
+        sql.execute('delete from sampled where id between 2 and 4999')
+        rows = sql.sample('sampled', n=2, seed=3)
+        assert [row['id'] for row in rows] == [1, 5000]
+        with pytest.raises(ValueError):
+            sql.sample('sampled', n=5, method='system')
+        with pytest.raises(ValueError):
+            sql.sample('sampled')
+        sql.execute('drop table sampled')
+
+    def test_engine_registry(self):
+        shared = sqh.SQL(sqlite_url)
+        assert shared._engine is sql._engine
+        own = sqh.SQL(sqlite_url, share_engine=False)
+        assert own._engine is not sql._engine
+        instrumented = sqh.SQL(sqlite_url, instrument=True)
+        assert instrumented._engine is not sql._engine
+        other = sqh.SQL(sqlite_url, pool_options={'pool_pre_ping': True})
+        assert other._engine is not sql._engine
+
+        before = own.pool_stats()
+        assert before['shared'] is False
+        assert shared.pool_stats()['shared'] is True
+        own.execute('select count(*) from stuff')
+        own.execute('select count(*) from stuff')
+        after = own.pool_stats()
+        assert after['checkouts'] >= before['checkouts'] + 2
+        assert after['checkins'] >= before['checkins'] + 2
+        assert after['wait_p50'] is not None
+        for key in ('pool', 'size', 'checked_in', 'checked_out', 'overflow', 'connects', 'invalidations', 'wait_max'):
+            assert key in after
+        own.dispose()
+        instrumented.dispose()
+        other.dispose()
+
+    def test_engine_registry_memory(self):
+        for url in ('sqlite://', 'sqlite:///:memory:', 'sqlite:///file:mem?mode=memory&uri=true'):
+            first = sqh.SQL(url)
+            second = sqh.SQL(url)
+            assert first._engine is not second._engine
+            assert first.pool_stats()['shared'] is False
+            first.execute('create table only_first (id int)')
+            assert second.get_tables() == []
+            first.dispose()
+            second.dispose()
+
+        options = {'pool_size': 3, 'max_overflow': 2, 'pool_recycle': 60}
+        assert sqh._pool_options('sqlite://', options) == {'pool_recycle': 60}
+        if sqh.sa_version_tuple >= (2, 0):
+            assert sqh._pool_options(sqlite_url, options) == options
+
+    @pytest.mark.skipif(not hasattr(sqh.os, 'fork'), reason='No os.fork')
+    def test_engine_after_fork(self):
+        engine = sqh.SQL(sqlite_url, share_engine=False)
+        assert engine.execute('select count(*) from stuff') == 0
+        connects = engine.pool_stats()['connects']
+        pid = sqh.os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                if engine.execute('select count(*) from stuff') == 0:
+                    code = 0
+            finally:
+                sqh.os._exit(code)
+        _, status = sqh.os.waitpid(pid, 0)
+        assert status == 0
+        assert engine.execute('select count(*) from stuff') == 0
+        assert engine.pool_stats()['connects'] == connects
+        engine.dispose()
+
     def test_clear_db(self):
         """This MUST be the final test since it's the new teardown"""
         sql.execute('drop table stuff')